@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Stress test of the FrameBroadcaster fan-out.
+
+Publishes frames at a fixed rate to 1, 10, 100 and 500 client threads and
+reports the wakeup latency and the CPU usage of the process.
+
+Usage:
+    python -m benchmarks.broadcaster_stress [--fps 30] [--duration 3] [--clients 1 10 100 500]
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from lib.frame_broadcaster import FrameBroadcaster
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Returns:
+        float: The value at the given fraction of the sorted values.
+    """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(client_count: int, fps: float, duration: float) -> dict:
+    """
+    Runs the broadcaster with the given number of clients.
+
+    Returns:
+        dict: The measured wakeup latencies [ms], CPU usage [%] and delivery statistics.
+    """
+    broadcaster = FrameBroadcaster()
+    running = True
+    latencies = [[] for _ in range(client_count)]
+    received = [0] * client_count
+
+    def client(index: int):
+        while running:
+            frame = broadcaster.wait_for_frame(timeout=1)
+            if frame is None:
+                continue
+            latencies[index].append(time.time() - frame.timestamp)
+            received[index] += 1
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(client_count)]
+    for thread in threads:
+        thread.start()
+
+    data = b'\xff' * 1024
+    published = 0
+    cpu_start = time.process_time()
+    wall_start = time.time()
+    next_frame = wall_start
+    while time.time() - wall_start < duration:
+        broadcaster.publish(data)
+        published += 1
+        next_frame += 1 / fps
+        time.sleep(max(0.0, next_frame - time.time()))
+    cpu = time.process_time() - cpu_start
+    wall = time.time() - wall_start
+
+    running = False
+    for thread in threads:
+        thread.join()
+
+    all_latencies = [latency * 1000 for client_latencies in latencies for latency in client_latencies]
+    return {
+        'clients': client_count,
+        'published': published,
+        'delivered_ratio': sum(received) / (published * client_count),
+        'latency_p50_ms': percentile(all_latencies, 0.5),
+        'latency_p99_ms': percentile(all_latencies, 0.99),
+        'latency_mean_ms': statistics.mean(all_latencies) if all_latencies else float('nan'),
+        'cpu_percent': 100 * cpu / wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='FrameBroadcaster stress test')
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--duration', type=float, default=3)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 100, 500])
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'clients', 'delivered', 'p50 [ms]', 'p99 [ms]', 'mean [ms]', 'cpu [%]'))
+    for client_count in args.clients:
+        result = run(client_count, args.fps, args.duration)
+        print('{clients:>8} {delivered_ratio:>10.3f} {latency_p50_ms:>10.3f} {latency_p99_ms:>10.3f} '
+              '{latency_mean_ms:>10.3f} {cpu_percent:>10.1f}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
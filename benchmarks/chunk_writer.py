@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Check of the write-behind chunk writer of lib.chunk_writer against throttled fake drives.
+
+An encoder writes random bytes at a constant bitrate in small pieces and
+switches to a new chunk every few seconds, like the H.264 encoder of the
+Pi. The first of two drives stalls for a while in the middle of the
+recording. The check verifies that the encoder never waits for the drive,
+that the writer fails over to the second drive, and that the chunks
+contain every byte in order. A block written again after a failover is
+only counted once. For comparison, the encoder writes directly into a
+file of the stalling drive like before.
+
+Usage:
+    python -m benchmarks.chunk_writer [--bitrate 17] [--duration 10] [--stall 5] [--stall-after 4]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from lib.chunk_writer import ChunkWriter
+from lib.recordings_folder import RecordingsFolder
+from lib.storage_manager import StorageManager
+
+
+class ThrottledFile(object):
+    """
+    Fake unbuffered file of a drive with a limited bandwidth that stalls once.
+
+    Attributes:
+        drive: The drive the file is written to
+        data: The written bytes
+    """
+
+    def __init__(self, drive):
+        """ constructor """
+        self.drive = drive
+        self.data = bytearray()
+
+    def write(self, data) -> int:
+        self.drive.throttle(len(data))
+        self.data += data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class ThrottledDrive(object):
+    """
+    Attributes:
+        bandwidth: Bytes per second of the drive
+        stall_after: The drive stalls once after this many bytes, None never
+        stall_seconds: Duration of the stall
+        written: Bytes written to the drive
+    """
+
+    def __init__(self, bandwidth: float, stall_after: int = None, stall_seconds: float = 0):
+        """ constructor """
+        self.bandwidth = bandwidth
+        self.stall_after = stall_after
+        self.stall_seconds = stall_seconds
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def throttle(self, length: int):
+        with self.lock:
+            time.sleep(length / self.bandwidth)
+            self.written += length
+            if self.stall_after is not None and self.written >= self.stall_after:
+                self.stall_after = None
+                time.sleep(self.stall_seconds)
+
+
+def merge_chunks(chunks: list, overlap: int) -> bytes:
+    """
+    Returns:
+        bytes: The chunks concatenated, a block at the start of a chunk that ends the previous one is taken once.
+    """
+    stream = bytearray()
+    for chunk in chunks:
+        skip = 0
+        for length in range(min(overlap, len(chunk), len(stream)), 0, -1):
+            if stream.endswith(chunk[:length]):
+                skip = length
+                break
+        stream += chunk[skip:]
+    return bytes(stream)
+
+
+def encode(output_for_chunk, bitrate: float, duration: float, chunk_seconds: float, seed: int) -> tuple:
+    """
+    Writes random bytes at the bitrate like an encoder.
+
+    Returns:
+        tuple: All written bytes and the longest write in seconds.
+    """
+    generator = random.Random(seed)
+    piece = int(bitrate / 30)
+    stream = bytearray()
+    longest = 0
+    started = time.perf_counter()
+    deadline = started
+    chunk_started = started
+    output = output_for_chunk()
+    while deadline - started < duration:
+        if deadline - chunk_started >= chunk_seconds:
+            next_output = output_for_chunk()
+            output.close()
+            output = next_output
+            chunk_started = deadline
+        data = generator.getrandbits(8 * piece).to_bytes(piece, 'little')
+        write_started = time.perf_counter()
+        output.write(data)
+        longest = max(longest, time.perf_counter() - write_started)
+        stream += data
+        deadline += 1 / 30
+        time.sleep(max(0.0, deadline - time.perf_counter()))
+    output.close()
+    return bytes(stream), longest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check of the chunk writer against throttled fake drives')
+    parser.add_argument('--bitrate', type=float, default=17, help='Megabits per second of the encoder')
+    parser.add_argument('--bandwidth', type=float, default=20, help='Megabytes per second of the drives')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--chunk-seconds', type=float, default=3)
+    parser.add_argument('--stall', type=float, default=5, help='Seconds the first drive stalls')
+    parser.add_argument('--stall-after', type=float, default=4, help='Megabytes after which the first drive stalls')
+    parser.add_argument('--block-kb', type=int, default=256)
+    args = parser.parse_args()
+
+    bitrate = args.bitrate * 1000 * 1000 / 8
+    block_bytes = args.block_kb * 1024
+    errors = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        base_paths = [os.path.join(directory, name) for name in ('usb0', 'usb1')]
+        drives = {
+            base_paths[0]: ThrottledDrive(args.bandwidth * 1024 * 1024, int(args.stall_after * 1024 * 1024),
+                                          args.stall),
+            base_paths[1]: ThrottledDrive(args.bandwidth * 1024 * 1024),
+        }
+        files = []
+
+        def opener(path: str) -> ThrottledFile:
+            # the chunk exists on disk like a real one, only its bytes are kept in memory
+            open(path, 'wb').close()
+            file = ThrottledFile(next(drive for base_path, drive in drives.items() if path.startswith(base_path)))
+            files.append((path, file))
+            return file
+
+        storage_manager = StorageManager(base_paths, min_free_bytes=0)
+        folder = RecordingsFolder(';'.join(base_paths), storage_manager=storage_manager)
+        writer = ChunkWriter(folder, block_bytes=block_bytes, stall_seconds=1, max_delay=1, opener=opener)
+        stream, longest = encode(writer.open_chunk, bitrate, args.duration, args.chunk_seconds, 0)
+        if not writer.close(timeout=args.stall + 10):
+            errors.append('the buffer was not written')
+        status = writer.get_status()
+        # the abandoned write of the stalled drive returns after the stall
+        time.sleep(max(0.0, args.stall - args.duration + 1))
+
+        if len({path for path, _ in files}) != len(files):
+            errors.append('a chunk path was used twice')
+        merged = merge_chunks([bytes(file.data) for _, file in files], block_bytes)
+        if merged != stream:
+            errors.append('the chunks contain {} of {} bytes'.format(len(merged), len(stream)))
+        if status['dropped_bytes']:
+            errors.append('{} bytes were dropped'.format(status['dropped_bytes']))
+        if args.stall > 1 and not status['failovers']:
+            errors.append('the writer did not fail over')
+
+        print('write-behind: {} chunks, {} failovers, longest encoder write {:.1f} ms'.format(
+            len(files), status['failovers'], longest * 1000))
+        for path, file in files:
+            print('  {:<60} {:>10} bytes'.format(os.path.relpath(path, directory), len(file.data)))
+        for target in storage_manager.get_status():
+            print('  {}: {:.1f} MB/s, latency {:.1f} ms, max {:.1f} ms, {} stalls'.format(
+                os.path.basename(target['path']), (target['bandwidth'] or 0) / 1024 / 1024,
+                (target['write_latency'] or 0) * 1000, target['max_write_latency'] * 1000, target['stalls']))
+
+        # like picamera writing into the file of the chunk itself
+        direct = ThrottledDrive(args.bandwidth * 1024 * 1024, int(args.stall_after * 1024 * 1024), args.stall)
+        _, longest = encode(lambda: ThrottledFile(direct), bitrate, args.duration, args.chunk_seconds, 0)
+        print('direct: longest encoder write {:.1f} ms'.format(longest * 1000))
+
+    for error in errors:
+        print('Error: ' + error)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Check of the HLS segmenter of lib.hls against a canned H.264 stream, no camera needed.
+
+Feeds a raw Annex-B .h264 file, e.g. recorded by the Pi with
+    raspivid -t 10000 -w 640 -h 480 -b 500000 -g 60 -ih -o sample.h264
+in pieces of random size into the segmenter, like the encoder writes its
+output, and checks that the transport stream packets are well formed, that
+every segment starts with a keyframe and decodes on its own with OpenCV,
+and that no frame is lost. Finally the bandwidth of the segments is
+compared with the MJPEG stream of the same frames.
+
+Usage:
+    python -m benchmarks.hls_segmenter sample.h264 [--fps 30] [--segment-seconds 2] [--quality 85]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import cv2
+
+from lib.hls import H264Segmenter, SegmentRing, TS_PACKET_SIZE, VIDEO_PID
+
+
+def check_packets(data: bytes, counters: dict) -> list:
+    """
+    Returns:
+        list: The errors of the sync bytes and continuity counters of the packets of the segment.
+    """
+    errors = []
+    if len(data) % TS_PACKET_SIZE:
+        errors.append('length {} is no multiple of the packet size'.format(len(data)))
+    for offset in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        packet = data[offset:offset + TS_PACKET_SIZE]
+        if packet[0] != 0x47:
+            errors.append('no sync byte at {}'.format(offset))
+            continue
+        pid = (packet[1] & 0x1F) << 8 | packet[2]
+        counter = packet[3] & 0x0F
+        if pid in counters and counter != (counters[pid] + 1) & 0x0F:
+            errors.append('continuity counter of pid {} jumps from {} to {}'.format(pid, counters[pid], counter))
+        counters[pid] = counter
+    if data[:1] != b'\x47' or (data[1] & 0x1F) << 8 | data[2] != 0:
+        errors.append('the segment does not start with the program association table')
+    return errors
+
+
+def decode_segment(data: bytes) -> list:
+    """
+    Returns:
+        list: The frames of the segment decoded by OpenCV.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.ts', delete=False) as file:
+        file.write(data)
+    try:
+        capture = cv2.VideoCapture(file.name)
+        frames = []
+        while True:
+            ok, image = capture.read()
+            if not ok:
+                return frames
+            frames.append(image)
+    finally:
+        os.unlink(file.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check of the HLS segmenter against a canned H.264 stream')
+    parser.add_argument('stream', type=str, help='Raw Annex-B H.264 file')
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--segment-seconds', type=float, default=2)
+    parser.add_argument('--quality', type=int, default=85, help='JPG quality of the MJPEG comparison')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.stream, 'rb') as file:
+        stream = file.read()
+
+    ring = SegmentRing(max_segments=1000)
+    segmenter = H264Segmenter(ring, args.fps, args.segment_seconds)
+    generator = random.Random(args.seed)
+    position = 0
+    while position < len(stream):
+        size = generator.randint(1, 64 * 1024)
+        segmenter.write(stream[position:position + size])
+        position += size
+    segmenter.flush()
+
+    errors = []
+    counters = {}
+    decoded = 0
+    jpeg_bytes = 0
+    for segment in ring.segments:
+        errors += ['segment {}: {}'.format(segment.sequence, error) for error in check_packets(segment.data, counters)]
+        # the first PES packet of every segment is a keyframe
+        first_video = next(offset for offset in range(0, len(segment.data), TS_PACKET_SIZE)
+                           if (segment.data[offset + 1] & 0x1F) << 8 | segment.data[offset + 2] == VIDEO_PID)
+        if not segment.data[first_video + 5] & 0x40:
+            errors.append('segment {} does not start with a keyframe'.format(segment.sequence))
+        frames = decode_segment(segment.data)
+        if len(frames) != round(segment.duration * args.fps):
+            errors.append('segment {} decodes to {} instead of {} frames'.format(
+                segment.sequence, len(frames), round(segment.duration * args.fps)))
+        decoded += len(frames)
+        jpeg_bytes += sum(len(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, args.quality])[1])
+                          for frame in frames)
+
+    duration = sum(segment.duration for segment in ring.segments)
+    hls_bytes = sum(len(segment.data) for segment in ring.segments)
+    print(ring.get_playlist(), end='')
+    print('segments: {}, frames: {} muxed, {} decoded, {:.1f} s'.format(
+        len(ring), segmenter.frames, decoded, duration))
+    if duration:
+        print('HLS: {:.0f} kB/s, MJPEG at quality {}: {:.0f} kB/s, {:.1f}x'.format(
+            hls_bytes / 1024 / duration, args.quality, jpeg_bytes / 1024 / duration, jpeg_bytes / hls_bytes))
+    for error in errors[:20]:
+        print('Error: ' + error)
+    if errors or not len(ring):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
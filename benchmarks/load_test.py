@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Load test of the MJPEG stream with many concurrent viewers.
+
+Either tests a running server via --url, or starts the gunicorn/gevent
+(lib.api) and the uvicorn (lib.asgi) server with the given camera driver
+and compares both modes.
+
+Usage:
+    python -m benchmarks.load_test --url http://localhost:9090/camerapi/stream/ --clients 100
+    python -m benchmarks.load_test --compare --camera mock --clients 10 100 500
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+from lib.mjpeg import BOUNDARY
+
+SERVERS = {
+    'wsgi': ['gunicorn', '--config', 'gunicorn.conf.py', '--worker-class', 'gevent', '--threads', '20',
+             '--workers', '1', '--bind', '127.0.0.1:{port}', 'lib.api:provider'],
+    'asgi': ['uvicorn', '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning', 'lib.asgi:app'],
+}
+
+
+async def stream_client(host: str, port: int, path: str, duration: float) -> int:
+    """
+    Reads the MJPEG stream for the given duration.
+
+    Returns:
+        int: The number of received frames, -1 if the connection failed.
+    """
+    delimiter = b'--' + BOUNDARY + b'\r\n'
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        return -1
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(path, host).encode())
+    frames = 0
+    tail = b''
+    deadline = time.time() + duration
+    try:
+        while time.time() < deadline:
+            try:
+                chunk = await asyncio.wait_for(reader.read(65536), deadline - time.time())
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            data = tail + chunk
+            frames += data.count(delimiter)
+            tail = data[-(len(delimiter) - 1):]
+    except OSError:
+        pass
+    finally:
+        writer.close()
+    return frames
+
+
+async def run_clients(url: str, client_count: int, duration: float) -> dict:
+    """
+    Returns:
+        dict: The delivered frame rates of the clients.
+    """
+    parsed = urlparse(url)
+    results = await asyncio.gather(*[
+        stream_client(parsed.hostname, parsed.port or 80, parsed.path, duration) for _ in range(client_count)])
+    connected = [frames for frames in results if frames >= 0]
+    return {
+        'clients': client_count,
+        'connected': len(connected),
+        'fps_min': min(connected) / duration if connected else 0,
+        'fps_mean': sum(connected) / len(connected) / duration if connected else 0,
+    }
+
+
+def read_process_cpu_seconds(pid: int) -> float:
+    """
+    Returns:
+        float: The user and system CPU seconds of the process and its direct children, read from /proc.
+    """
+    cpu = 0.0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return cpu
+
+
+def run_server(mode: str, camera: str, port: int, client_counts: list, duration: float) -> list:
+    """
+    Starts the server in the given mode and runs the load test against it.
+
+    Returns:
+        list: The results per client count.
+    """
+    command = [part.format(port=port) for part in SERVERS[mode]]
+    env = dict(os.environ, CAMERA=camera, MOCK_SCENE_SECONDS='0')
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}/camerapi/stream/'.format(port)
+    results = []
+    try:
+        time.sleep(5)
+        for client_count in client_counts:
+            cpu_start = read_process_cpu_seconds(server.pid)
+            result = asyncio.run(run_clients(url, client_count, duration))
+            result['mode'] = mode
+            result['server_cpu_percent'] = 100 * (read_process_cpu_seconds(server.pid) - cpu_start) / duration
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def print_results(results: list):
+    print('{:>6} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'mode', 'clients', 'connected', 'fps min', 'fps mean', 'cpu [%]'))
+    for result in results:
+        print('{mode:>6} {clients:>8} {connected:>10} {fps_min:>10.2f} {fps_mean:>10.2f} '
+              '{server_cpu_percent:>10.1f}'.format(**result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MJPEG stream load test')
+    parser.add_argument('--url', type=str, help='Stream url of a running server')
+    parser.add_argument('--compare', action='store_true', help='Start and compare the WSGI and ASGI server')
+    parser.add_argument('--camera', type=str, default='mock', help='Camera driver used with --compare')
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    if args.compare:
+        results = run_server('wsgi', args.camera, 9191, args.clients, args.duration)
+        results += run_server('asgi', args.camera, 9192, args.clients, args.duration)
+    elif args.url:
+        results = []
+        for client_count in args.clients:
+            result = asyncio.run(run_clients(args.url, client_count, args.duration))
+            result['mode'] = '-'
+            result['server_cpu_percent'] = float('nan')
+            results.append(result)
+    else:
+        parser.print_usage()
+        sys.exit(1)
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
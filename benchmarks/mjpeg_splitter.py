@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Check and benchmark of the MJPEG frame splitter of the Pi camera output.
+
+Feeds an MJPEG byte stream in pieces of random size into the
+MJPEGFrameSplitter and verifies that exactly the original frames come out.
+The stream is a recorded .mjpeg chunk, which is split by the JPG markers
+as reference, or is built from the sample frames including a frame with an
+embedded thumbnail and garbage between the frames. Also measures the
+throughput when every write is one complete frame like from the Pi
+encoder, in which case the frames are passed on without copying.
+
+Usage:
+    python -m benchmarks.mjpeg_splitter [--repeat 200] [recording.mjpeg ...]
+"""
+import argparse
+import pathlib
+import random
+import struct
+import sys
+import time
+
+from lib.data_provider import get_data_path
+from lib.mjpeg import MJPEGFrameSplitter
+
+
+def with_thumbnail(jpeg: bytes, thumbnail: bytes) -> bytes:
+    """
+    Returns:
+        bytes: The JPG with an APP1 segment that contains the thumbnail, i.e. a second end of image marker.
+    """
+    segment = b'Exif\0\0' + thumbnail
+    return jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(segment) + 2) + segment + jpeg[2:]
+
+
+def build_stream(files: list) -> tuple:
+    """
+    Returns:
+        tuple: The expected frames and the MJPEG stream.
+    """
+    if files:
+        frames = []
+        for file in files:
+            MJPEGFrameSplitter(frames.append).write(pathlib.Path(file).read_bytes())
+        return frames, b''.join(frames)
+
+    images = [pathlib.Path(get_data_path(), f + '.jpg').read_bytes() for f in ['1', '2', '3']]
+    frames = images + [with_thumbnail(images[0], images[1])]
+    stream = b'garbage\xff' + b'\xff\x00'.join(frames)
+    return frames, stream
+
+
+def check(frames: list, stream: bytes, rounds: int) -> bool:
+    """
+    Returns:
+        bool: True if the stream split into pieces of random size always results in the frames.
+    """
+    generator = random.Random(0)
+    for _ in range(rounds):
+        received = []
+        splitter = MJPEGFrameSplitter(received.append)
+        position = 0
+        while position < len(stream):
+            size = generator.choice([1, 2, 3, 100, 4096, 65536])
+            splitter.write(stream[position:position + size])
+            position += size
+        if received != frames:
+            print('Mismatch: {} of {} frames'.format(len(received), len(frames)))
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MJPEG frame splitter check and benchmark')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+
+    frames, stream = build_stream(args.files)
+    if not frames or not check(frames, stream, args.rounds):
+        sys.exit(1)
+    print('split {} frames correctly in {} rounds of random writes'.format(len(frames), args.rounds))
+
+    received = []
+    splitter = MJPEGFrameSplitter(received.append)
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        for frame in frames:
+            splitter.write(frame)
+    duration = time.perf_counter() - started
+    copied = sum(1 for frame, original in zip(received, frames * args.repeat) if frame is not original)
+    print('whole frame writes: {:.0f} frames/s, {:.0f} MB/s, {} copies'.format(
+        len(received) / duration, sum(map(len, received)) / duration / 1024 / 1024, copied))
+
+    started = time.perf_counter()
+    received.clear()
+    for _ in range(args.repeat):
+        for position in range(0, len(stream), 65536):
+            splitter.write(stream[position:position + 65536])
+    duration = time.perf_counter() - started
+    print('64 KiB writes:      {:.0f} frames/s, {:.0f} MB/s'.format(
+        len(received) / duration, len(stream) * args.repeat / duration / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Benchmark of the motion detection on recorded sample frames.
+
+Replays the sample frames from misc/ (or the given JPG files), optionally
+upscaled to the Pi stream resolution, through the MotionDetector and
+reports the time and the bytes allocated per analyzed frame.
+
+Usage:
+    python -m benchmarks.motion_detection [--resolution 1200 900] [--frames 300] [files ...]
+"""
+import argparse
+import pathlib
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from lib.data_provider import get_data_path
+from lib.motion_detector import MotionDetector
+
+
+def load_frames(files: list, resolution: tuple) -> list:
+    """
+    Returns:
+        list: The JPG encoded sample frames, resized to the given resolution.
+    """
+    frames = []
+    for file in files:
+        image = cv2.imread(str(file))
+        if resolution:
+            image = cv2.resize(image, resolution)
+        frames.append(cv2.imencode('.jpg', image)[1].tobytes())
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Motion detection benchmark')
+    parser.add_argument('--resolution', type=int, nargs=2, default=[1200, 900])
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+
+    files = args.files or [pathlib.Path(get_data_path(), f + '.jpg') for f in ['1', '2', '3']]
+    frames = load_frames(files, tuple(args.resolution))
+    detector = MotionDetector()
+
+    # warm up and allocate the reused arrays
+    for frame in frames:
+        detector.detect(frame)
+
+    durations = []
+    scores = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(args.frames):
+        start = time.perf_counter()
+        scores.append(detector.detect(frames[i % len(frames)]))
+        durations.append(time.perf_counter() - start)
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    durations = np.array(durations) * 1000
+    print('frames:             {}'.format(args.frames))
+    print('resolution:         {}x{}'.format(*args.resolution))
+    print('detect mean [ms]:   {:.3f}'.format(durations.mean()))
+    print('detect p99 [ms]:    {:.3f}'.format(np.percentile(durations, 99)))
+    print('max fps per core:   {:.0f}'.format(1000 / durations.mean()))
+    print('retained bytes:     {}'.format(retained))
+    print('mean changed:       {:.3f}'.format(float(np.mean(scores))))
+
+
+if __name__ == '__main__':
+    main()
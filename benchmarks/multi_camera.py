@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Check of two mock cameras that are streamed concurrently by one process.
+
+Configures the cameras a and b with CAMERAS, starts the provider app
+in-process and connects clients to the streams of both cameras at the same
+time. Every camera has to deliver its own frames, report its own status
+and record into its own subdirectory of the recordings path.
+
+Usage:
+    python -m benchmarks.multi_camera [--clients 5] [--fps 15] [--duration 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import urllib.request
+
+from benchmarks.streaming import stream_client, summarize, start_inprocess
+from lib.camera_mock import Camera as MockCamera
+
+CAMERA_IDS = ('a', 'b')
+
+
+def request(port: int, path: str, data: dict = None) -> dict:
+    body = json.dumps(data).encode() if data is not None else None
+    http_request = urllib.request.Request('http://127.0.0.1:{}{}'.format(port, path), data=body,
+                                          headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(http_request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+async def run_clients(port: int, clients: int, duration: float) -> dict:
+    """
+    Returns:
+        dict: The summary of the clients of every camera.
+    """
+    tasks = [stream_client(port, duration, False, '/camerapi/{}/stream/'.format(camera_id))
+             for camera_id in CAMERA_IDS for _ in range(clients)]
+    results = await asyncio.gather(*tasks)
+    return {camera_id: summarize(results[i * clients:(i + 1) * clients], duration)
+            for i, camera_id in enumerate(CAMERA_IDS)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Two mock cameras streamed concurrently')
+    parser.add_argument('--port', type=int, default=9194)
+    parser.add_argument('--clients', type=int, default=5, help='Number of clients per camera')
+    parser.add_argument('--fps', type=float, default=15, help='Frame rate of the mock cameras')
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    recordings = tempfile.mkdtemp(prefix='camerapi-')
+    os.environ.update({
+        'CAMERAS': ','.join(camera_id + ':mock' for camera_id in CAMERA_IDS),
+        'RECORDINGS': recordings,
+        'TIMELAPSE_INTERVAL': '0',
+    })
+    # the mock camera module is already imported, its configuration was read from the environment
+    MockCamera.fps = args.fps
+    MockCamera.scene_seconds = 0
+
+    from lib.utils import read_password
+    password = read_password()
+    server = start_inprocess(args.port)
+    failures = []
+    try:
+        print('cameras: {}'.format(request(args.port, '/camerapi/cameras')['cameras']))
+        request(args.port, '/camerapi/a/start_recording', {'password': password})
+        results = asyncio.run(run_clients(args.port, args.clients, args.duration))
+        request(args.port, '/camerapi/a/stop_recording', {'password': password})
+
+        for camera_id, summary in results.items():
+            status = request(args.port, '/camerapi/{}/status'.format(camera_id))
+            print('{}: connected {connected}/{clients}, fps min {fps_min:.1f} mean {fps_mean:.1f}, '
+                  'latency p50 {latency_p50_ms:.1f} ms, starts {starts}, recording {recording}'.format(
+                    camera_id, starts=status['starts'], recording=status['recording'], **summary))
+            if summary['connected'] != args.clients or summary['fps_min'] < args.fps / 2:
+                failures.append('camera {} did not deliver its frames'.format(camera_id))
+            if status['camera'] != camera_id:
+                failures.append('camera {} reported the status of {}'.format(camera_id, status['camera']))
+
+        # the recorder writes the queued frames after the stop
+        time.sleep(1)
+        sessions = {camera_id: os.listdir(os.path.join(recordings, camera_id))
+                    if os.path.isdir(os.path.join(recordings, camera_id)) else [] for camera_id in CAMERA_IDS}
+        chunks = request(args.port, '/camerapi/a/recordings')['chunks']
+        print('recordings: {}, chunks of a: {}'.format(sessions, len(chunks)))
+        if not chunks or not all(chunk['path'].startswith(os.path.join(recordings, 'a')) for chunk in chunks):
+            failures.append('camera a did not record into its subdirectory')
+        if request(args.port, '/camerapi/b/recordings')['chunks']:
+            failures.append('camera b has recordings of camera a')
+    finally:
+        server.shutdown()
+
+    print('\n'.join(failures) or 'OK')
+    # the camera threads are not daemons
+    os._exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Measures the bytes allocated per frame by the MJPEG stream fan-out.
+
+Compares building the multipart part for every client (the previous
+behaviour) with building it once per frame in the camera thread and
+sharing it with all clients.
+
+Usage:
+    python -m benchmarks.multipart_allocations [--frame-size 300000] [--frames 30] [--clients 1 10 100 500]
+"""
+import argparse
+import os
+import tracemalloc
+
+from lib.frame_broadcaster import FrameBroadcaster
+from lib.mjpeg import encode_part
+
+
+def per_client_parts(broadcaster: FrameBroadcaster, client_count: int):
+    frame = broadcaster.get_latest_frame()
+    return [b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame.data + b'\r\n' for _ in range(client_count)]
+
+
+def shared_parts(broadcaster: FrameBroadcaster, client_count: int):
+    frame = broadcaster.get_latest_frame()
+    return [frame.part for _ in range(client_count)]
+
+
+def measure(strategy, client_count: int, frames: list) -> float:
+    """
+    Publishes the frames and hands each of them to all clients.
+
+    Returns:
+        float: The mean number of bytes allocated per frame.
+    """
+    broadcaster = FrameBroadcaster()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    allocated = 0
+    for data in frames:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        if strategy is shared_parts:
+            broadcaster.publish(data, encode_part(data))
+        else:
+            broadcaster.publish(data)
+        strategy(broadcaster, client_count)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return allocated / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MJPEG multipart allocation benchmark')
+    parser.add_argument('--frame-size', type=int, default=300000)
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 100, 500])
+    args = parser.parse_args()
+
+    frames = [os.urandom(args.frame_size) for _ in range(args.frames)]
+
+    print('{:>8} {:>20} {:>20}'.format('clients', 'per client [KB]', 'shared [KB]'))
+    for client_count in args.clients:
+        print('{:>8} {:>20.1f} {:>20.1f}'.format(
+            client_count,
+            measure(per_client_parts, client_count, frames) / 1024,
+            measure(shared_parts, client_count, frames) / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Benchmark of the OpenCV camera pipeline against a synthetic capture source.
+
+Compares the former sequential loop, i.e. a blocking read followed by the
+encoding of every frame, with the capture thread and encoder pool of
+lib.camera_opencv. Like a camera device without frame queue, the
+synthetic source blocks every read() for one frame period while the frame
+is exposed and transferred. Alternatively a video file is replayed as
+fast as it can be decoded.
+
+Usage:
+    python -m benchmarks.opencv_pipeline [--resolution 1280 720] [--capture-fps 30] [--frames 150]
+    python -m benchmarks.opencv_pipeline --video sample.mp4 --quality 80 --threads 2
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from lib.camera_opencv import FrameEncoder, encoded_frames
+
+
+class SyntheticCapture(object):
+    """
+    Generated frames, every read blocks for one frame period like a camera device.
+
+    Attributes:
+        fps: Frames per second of the source, 0 delivers the frames without delay
+    """
+
+    def __init__(self, width: int, height: int, fps: float, count: int = 8):
+        """ constructor """
+        self.fps = fps
+        gradient = np.add.outer(np.arange(height) // 4, np.arange(width) // 4).astype(np.uint8)
+        noise = np.random.default_rng(0).integers(0, 32, (count, height, width, 3), dtype=np.uint8)
+        self.images = [cv2.merge([gradient, np.flipud(gradient), gradient // 2]) + noise[i] for i in range(count)]
+        self.index = 0
+
+    def isOpened(self) -> bool:
+        return True
+
+    def set(self, property_id: int, value: float) -> bool:
+        # the resolution is fixed, the encoder resizes
+        return False
+
+    def read(self, image=None):
+        if self.fps > 0:
+            time.sleep(1 / self.fps)
+        source = self.images[self.index % len(self.images)]
+        self.index += 1
+        if image is None or image.shape != source.shape:
+            image = np.empty_like(source)
+        np.copyto(image, source)
+        return True, image
+
+    def release(self):
+        pass
+
+
+def open_source(args):
+    if args.video:
+        return cv2.VideoCapture(args.video)
+    return SyntheticCapture(args.resolution[0], args.resolution[1], args.capture_fps)
+
+
+def sequential_frames(capture):
+    """The former loop of the OpenCV camera."""
+    while True:
+        _, image = capture.read()
+        yield cv2.imencode('.jpg', image)[1].tobytes()
+
+
+def measure(frames, count: int) -> dict:
+    """
+    Returns:
+        dict: Frames per second, wall and CPU milliseconds per frame and the mean frame size.
+    """
+    sizes = []
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for frame in frames:
+        sizes.append(len(frame))
+        if len(sizes) == count:
+            break
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    frames.close()
+    return {
+        'fps': count / wall,
+        'wall_ms': wall / count * 1000,
+        'cpu_ms': cpu / count * 1000,
+        'kb': np.mean(sizes) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenCV camera pipeline benchmark')
+    parser.add_argument('--resolution', type=int, nargs=2, default=[1280, 720])
+    parser.add_argument('--capture-fps', type=float, default=30, help='Frame rate of the synthetic source')
+    parser.add_argument('--video', type=str, help='Replay a video file instead of the synthetic source')
+    parser.add_argument('--frames', type=int, default=150)
+    parser.add_argument('--quality', type=int, default=95)
+    parser.add_argument('--threads', type=int, default=2)
+    args = parser.parse_args()
+
+    results = {
+        'sequential': measure(sequential_frames(open_source(args)), args.frames),
+        'pipeline': measure(encoded_frames(open_source(args), FrameEncoder(args.quality), 0, args.threads),
+                            args.frames),
+    }
+
+    print('{:>12} {:>8} {:>10} {:>10} {:>8}'.format('mode', 'fps', 'wall [ms]', 'cpu [ms]', 'kB'))
+    for mode, result in results.items():
+        print('{:>12} {fps:>8.1f} {wall_ms:>10.2f} {cpu_ms:>10.2f} {kb:>8.1f}'.format(mode, **result))
+    print('speedup: {:.2f}x'.format(results['pipeline']['fps'] / results['sequential']['fps']))
+
+
+if __name__ == '__main__':
+    main()
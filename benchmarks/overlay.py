@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Benchmark of the timestamp overlay.
+
+Compares drawing the anti-aliased text with cv2.putText per frame, like
+the OpenCV annotation examples do, with alpha-blending the cached glyph
+masks of lib.overlay.
+
+Usage:
+    python -m benchmarks.overlay [--resolution 1280 720] [--frames 500]
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from lib.overlay import TextOverlay, get_overlay_scale
+from lib.utils import get_datetime_now_log_string
+
+LINES = (get_datetime_now_log_string(), 'Garden 48.3C')
+
+
+def put_text(frame, lines: tuple, scale: float):
+    """Draws the lines with cv2.putText."""
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    sizes = [cv2.getTextSize(line, font, scale, 1) for line in lines]
+    line_height = max(height + baseline for (_, height), baseline in sizes) + 2
+    for i, line in enumerate(lines):
+        cv2.putText(frame, line, (8, 8 + line_height * (i + 1) - sizes[i][1]), font, scale, (255, 255, 255), 1,
+                    cv2.LINE_AA)
+
+
+def measure(draw, frame, count: int) -> float:
+    """
+    Returns:
+        float: The microseconds per frame.
+    """
+    started = time.perf_counter()
+    for _ in range(count):
+        draw(frame)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timestamp overlay benchmark')
+    parser.add_argument('--resolution', type=int, nargs=2, default=[1280, 720])
+    parser.add_argument('--frames', type=int, default=500)
+    args = parser.parse_args()
+
+    width, height = args.resolution
+    frame = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    scale = get_overlay_scale(width)
+    overlay = TextOverlay(scale)
+
+    results = {
+        'putText': measure(lambda image: put_text(image, LINES, scale), frame, args.frames),
+        'glyph cache': measure(lambda image: overlay.draw(image, LINES), frame, args.frames),
+    }
+    for mode, microseconds in results.items():
+        print('{:>12} {:>10.1f} us/frame'.format(mode, microseconds))
+    print('speedup: {:.1f}x'.format(results['putText'] / results['glyph cache']))
+
+
+if __name__ == '__main__':
+    main()
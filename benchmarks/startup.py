@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Benchmark of the startup of the provider app.
+
+Measures the time to import lib.api in a fresh interpreter, with the
+slowest imported packages from python -X importtime, and the time from
+launching gunicorn until the first request is answered and until the
+camera is ready. The mock camera can simulate the warm up of the Pi camera.
+
+Usage:
+    python -m benchmarks.startup [--warm-up 2] [--runs 3]
+    python -m benchmarks.startup --path /camerapi/status
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.load_test import SERVERS
+
+
+def measure_import(env: dict, top: int) -> tuple:
+    """
+    Returns:
+        tuple: The seconds to import lib.api and the (seconds, name) of the slowest imports of lib.api.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import lib.api'],
+                            env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    total = 0
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        try:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            cumulative = int(cumulative) / 1e6
+        except ValueError:
+            continue
+        # the direct imports of lib.api are indented by one level
+        if name.startswith('  ') and not name.startswith('    '):
+            imports.append((cumulative, name.strip()))
+        if name.strip() == 'lib.api':
+            total = cumulative
+    return total, sorted(imports, reverse=True)[:top]
+
+
+def wait_for(url: str, deadline: float) -> float:
+    """
+    Returns:
+        float: The time when the url answered with 200, None if it did not before the deadline.
+    """
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def measure_first_request(env: dict, port: int, path: str, timeout: float) -> dict:
+    """
+    Returns:
+        dict: Seconds from the launch of gunicorn to the first answered request and to the ready camera.
+    """
+    command = [part.format(port=port) for part in SERVERS['wsgi']]
+    launched = time.perf_counter()
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = launched + timeout
+        first = wait_for('http://127.0.0.1:{}{}'.format(port, path), deadline)
+        ready = wait_for('http://127.0.0.1:{}/camerapi/ready'.format(port), deadline)
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'first_request': first - launched if first else None,
+        'ready': ready - launched if ready else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark of the provider app')
+    parser.add_argument('--port', type=int, default=9195)
+    parser.add_argument('--warm-up', type=float, default=2, help='Warm up of the mock camera in seconds')
+    parser.add_argument('--path', type=str, default='/camerapi/health', help='Route of the first request')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=8, help='Number of the slowest imports that are listed')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    env = dict(os.environ, CAMERA='mock', MOCK_WARM_UP=str(args.warm_up), TIMELAPSE_INTERVAL='0')
+
+    total, imports = measure_import(env, args.top)
+    print('import lib.api: {:.3f} s'.format(total))
+    for seconds, name in imports:
+        print('  {:>8.3f} s  {}'.format(seconds, name))
+
+    print('{:>4} {:>20} {:>12}'.format('run', 'first request [s]', 'ready [s]'))
+    for run in range(args.runs):
+        result = measure_first_request(env, args.port, args.path, args.timeout)
+        print('{:>4} {:>20} {:>12}'.format(run, *(
+            '{:.3f}'.format(result[key]) if result[key] is not None else 'timeout' for key in ('first_request', 'ready'))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Reproducible streaming benchmark on the synthetic mock camera.
+
+Starts the provider app in-process (werkzeug threaded server) or under
+gunicorn/gevent with the mock camera at the given frame rate and size,
+connects fast and deliberately slow MJPEG clients and reports the
+delivered frame rates, the glass-to-client latency percentiles, i.e. from
+the capture time embedded in the frame to its arrival at the client, and
+the CPU and RSS of the server. In-process, the CPU and RSS include the
+clients.
+
+The results can be stored as JSON baseline in benchmarks/baselines/ and
+later runs compared against it, so regressions show up as a diff.
+
+Usage:
+    python -m benchmarks.streaming --server inprocess --clients 20 --slow 2 --fps 30 --frame-bytes 100000
+    python -m benchmarks.streaming --server gunicorn --clients 100 --save mock_gunicorn
+    python -m benchmarks.streaming --server gunicorn --clients 100 --baseline mock_gunicorn
+    python -m benchmarks.streaming --static --clients 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.load_test import SERVERS, read_process_cpu_seconds
+from lib.camera_mock import Camera as MockCamera, TIMESTAMP_MARKER, parse_frame_timestamp
+from lib.mjpeg import BOUNDARY
+
+BASELINES_PATH = pathlib.Path(__file__).parent / 'baselines'
+PATH = '/camerapi/stream/'
+
+# a slow client reads this many bytes per read and pauses in between
+SLOW_READ_BYTES = 4096
+SLOW_READ_PAUSE = 0.05
+
+
+def read_process_rss_bytes(pid: int) -> int:
+    """
+    Returns:
+        int: The resident set size of the process and its direct children, read from /proc.
+    """
+    rss = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:
+            rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return rss
+
+
+async def stream_client(port: int, duration: float, slow: bool, path: str = PATH) -> dict:
+    """
+    Reads the MJPEG stream for the given duration.
+
+    Returns:
+        dict: The number of received frames and bytes and the latencies of the frames,
+            None if the connection failed.
+    """
+    delimiter = b'--' + BOUNDARY + b'\r\n'
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    except OSError:
+        return None
+    writer.write('GET {} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.format(path).encode())
+
+    frames = 0
+    received_bytes = 0
+    latencies = []
+    last_timestamp = 0
+    tail = b''
+    # the marker and the timestamp fit into the kept tail
+    keep = len(TIMESTAMP_MARKER) + 32
+    deadline = time.time() + duration
+    try:
+        while time.time() < deadline:
+            try:
+                chunk = await asyncio.wait_for(reader.read(SLOW_READ_BYTES if slow else 65536),
+                                               deadline - time.time())
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            received = time.time()
+            received_bytes += len(chunk)
+            data = tail + chunk
+            frames += data.count(delimiter) - tail.count(delimiter)
+
+            position = data.find(TIMESTAMP_MARKER, 0)
+            while position >= 0:
+                timestamp = parse_frame_timestamp(data[position:position + keep])
+                if timestamp is None:
+                    # the timestamp continues in the next chunk
+                    break
+                # markers in the tail were already seen with the previous chunk
+                if timestamp > last_timestamp:
+                    latencies.append(received - timestamp)
+                    last_timestamp = timestamp
+                position = data.find(TIMESTAMP_MARKER, position + 1)
+            tail = data[-keep:]
+
+            if slow:
+                await asyncio.sleep(SLOW_READ_PAUSE)
+    except OSError:
+        pass
+    finally:
+        writer.close()
+    return {'frames': frames, 'bytes': received_bytes, 'latencies': latencies}
+
+
+def summarize(results: list, duration: float) -> dict:
+    """
+    Returns:
+        dict: The delivered frame rates, bandwidth and latency percentiles of the clients.
+    """
+    connected = [result for result in results if result is not None]
+    fps = [result['frames'] / duration for result in connected]
+    kbps = [result['bytes'] / 1024 / duration for result in connected]
+    latencies = np.array([latency for result in connected for latency in result['latencies']]) * 1000
+    summary = {
+        'clients': len(results),
+        'connected': len(connected),
+        'fps_min': min(fps) if fps else 0,
+        'fps_mean': float(np.mean(fps)) if fps else 0,
+        'kbytes_per_second_mean': float(np.mean(kbps)) if kbps else 0,
+    }
+    for percentile in (50, 90, 99):
+        summary['latency_p{}_ms'.format(percentile)] = \
+            float(np.percentile(latencies, percentile)) if len(latencies) else None
+    return summary
+
+
+async def run_clients(port: int, clients: int, slow_clients: int, duration: float) -> dict:
+    """
+    Returns:
+        dict: The summaries of the fast and of the slow clients.
+    """
+    tasks = [stream_client(port, duration, False) for _ in range(clients)] + \
+            [stream_client(port, duration, True) for _ in range(slow_clients)]
+    results = await asyncio.gather(*tasks)
+    return {
+        'fast': summarize(results[:clients], duration),
+        'slow': summarize(results[clients:], duration) if slow_clients else None,
+    }
+
+
+def start_inprocess(port: int):
+    """
+    Starts the provider app with the threaded werkzeug server in this process.
+
+    Returns:
+        The server, its shutdown stops it.
+    """
+    from werkzeug.serving import make_server
+    from lib.api import provider
+
+    server = make_server('127.0.0.1', port, provider, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(args) -> dict:
+    """
+    Returns:
+        dict: The configuration and the results of the benchmark.
+    """
+    os.environ.update({
+        'CAMERA': 'mock',
+        'MOCK_FPS': str(args.fps),
+        'MOCK_FRAME_BYTES': str(args.frame_bytes),
+        'MOCK_STATIC': str(int(args.static)),
+        'MOCK_SCENE_SECONDS': '0',
+    })
+    port = args.port
+    if args.server == 'inprocess':
+        # the mock camera module is already imported, its configuration was read from the environment
+        MockCamera.fps = args.fps
+        MockCamera.frame_bytes = args.frame_bytes
+        MockCamera.static = args.static
+        MockCamera.scene_seconds = 0
+        server = start_inprocess(port)
+        pid = os.getpid()
+    else:
+        command = [part.format(port=port) for part in SERVERS['wsgi']]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pid = server.pid
+
+    try:
+        time.sleep(args.warm_up)
+        cpu_start = read_process_cpu_seconds(pid)
+        results = asyncio.run(run_clients(port, args.clients, args.slow, args.duration))
+        results['server_cpu_percent'] = 100 * (read_process_cpu_seconds(pid) - cpu_start) / args.duration
+        results['server_rss_mb'] = read_process_rss_bytes(pid) / 1024 / 1024
+    finally:
+        if args.server == 'inprocess':
+            server.shutdown()
+        else:
+            server.terminate()
+            server.wait()
+
+    return {'config': get_config(args), 'results': results}
+
+
+def get_config(args) -> dict:
+    """
+    Returns:
+        dict: The parameters of the benchmark that have to match the baseline.
+    """
+    return {
+        'server': args.server,
+        'clients': args.clients,
+        'slow': args.slow,
+        'fps': args.fps,
+        'frame_bytes': args.frame_bytes,
+        'static': args.static,
+        'duration': args.duration,
+    }
+
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    """
+    Returns:
+        dict: The nested results with keys joined by dots, e.g. fast.fps_mean.
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif value is not None:
+            flat[prefix + key] = value
+    return flat
+
+
+def print_comparison(current: dict, baseline: dict = None):
+    current = flatten(current['results'])
+    baseline = flatten(baseline['results']) if baseline else {}
+    print('{:<28} {:>12} {:>12} {:>9}'.format('metric', 'current', 'baseline', 'change'))
+    for key, value in current.items():
+        if key not in baseline:
+            print('{:<28} {:>12.2f}'.format(key, value))
+            continue
+        change = (value - baseline[key]) / baseline[key] * 100 if baseline[key] else float('nan')
+        print('{:<28} {:>12.2f} {:>12.2f} {:>8.1f}%'.format(key, value, baseline[key], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming benchmark on the synthetic mock camera')
+    parser.add_argument('--server', choices=['inprocess', 'gunicorn'], default='inprocess')
+    parser.add_argument('--port', type=int, default=9193)
+    parser.add_argument('--clients', type=int, default=10, help='Number of fast clients')
+    parser.add_argument('--slow', type=int, default=0, help='Number of additional slow clients')
+    parser.add_argument('--fps', type=float, default=30, help='Frame rate of the mock camera')
+    parser.add_argument('--frame-bytes', type=int, default=100000, help='Size of the mock frames')
+    parser.add_argument('--static', action='store_true', help='The mock camera films a static scene')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warm-up', type=float, default=3)
+    parser.add_argument('--save', type=str, help='Store the result as baseline with this name')
+    parser.add_argument('--baseline', type=str, help='Compare the result with the baseline of this name')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(BASELINES_PATH / (args.baseline + '.json')) as file:
+            baseline = json.load(file)
+        if baseline['config'] != get_config(args):
+            print('Warning: the configuration differs from the baseline: {}'.format(baseline['config']))
+
+    result = run(args)
+    print_comparison(result, baseline)
+
+    if args.save:
+        BASELINES_PATH.mkdir(exist_ok=True)
+        with open(BASELINES_PATH / (args.save + '.json'), 'w') as file:
+            json.dump(result, file, indent=2, sort_keys=True)
+            file.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+Headless client of the WebSocket stream of lib.asgi.
+
+Starts the ASGI app under uvicorn with the mock camera, connects fast and
+deliberately slow viewers that acknowledge every frame, a slow viewer
+only after it "displayed" the frame for the given delay, and reports the
+delivered frame rates and the latency percentiles from the publication of
+a frame to its arrival and to its acknowledgement.
+
+The flow control is verified on the way: the sequence numbers have to
+increase and the server must never have more than window frames
+unacknowledged. For a slow viewer this means it gets the newest frame
+after every acknowledgement, so its arrival latency stays at about a frame
+period instead of growing with a backlog.
+
+Usage:
+    python -m benchmarks.websocket_client --clients 5 --slow 2 --delay 0.2
+    python -m benchmarks.websocket_client --url ws://raspberrypi:9090/camerapi/ws --clients 1
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import struct
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from benchmarks.streaming import summarize
+from lib.asgi import WEBSOCKET_HEADER
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+class WebSocket(object):
+    """
+    Minimal WebSocket client on asyncio streams, just enough for the stream.
+
+    Attributes:
+        reader: The stream reader of the connection
+        writer: The stream writer of the connection
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ constructor """
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, url: str):
+        """
+        Returns:
+            WebSocket: The connection after the opening handshake.
+
+        Raises:
+            ConnectionError: If the server does not switch to the WebSocket protocol.
+        """
+        parts = urlsplit(url)
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n'
+                     .format(path, parts.netloc, key).encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+            writer.close()
+            raise ConnectionError(response.split(b'\r\n', 1)[0].decode())
+        return cls(reader, writer)
+
+    def send(self, opcode: int, payload: bytes = b''):
+        """Sends a single masked frame, as required for clients."""
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        mask = os.urandom(4)
+        masked = (np.frombuffer(payload, dtype=np.uint8) ^ np.resize(np.frombuffer(mask, dtype=np.uint8), length))
+        self.writer.write(header + mask + masked.tobytes())
+
+    def send_text(self, text: str):
+        self.send(OPCODE_TEXT, text.encode())
+
+    async def receive(self) -> tuple:
+        """
+        Returns:
+            tuple: The opcode and the payload of the next message, pings are answered on the way.
+        """
+        message_opcode = None
+        payload = b''
+        while True:
+            first, second = await self.reader.readexactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            data = await self.reader.readexactly(length)
+            if opcode == OPCODE_PING:
+                self.send(OPCODE_PONG, data)
+                continue
+            if opcode != OPCODE_CONTINUATION:
+                message_opcode = opcode
+            payload += data
+            if first & 0x80:
+                return message_opcode, payload
+
+    def close(self):
+        try:
+            self.send(OPCODE_CLOSE, struct.pack('!H', 1000))
+        finally:
+            self.writer.close()
+
+
+async def viewer(url: str, duration: float, delay: float, window: int) -> dict:
+    """
+    Receives and acknowledges the frames for the given duration.
+
+    Returns:
+        dict: The number of received frames and bytes, the latencies and the flow control violations,
+            None if the connection failed.
+    """
+    try:
+        websocket = await WebSocket.connect(url)
+    except (OSError, ConnectionError):
+        return None
+
+    frames = 0
+    received_bytes = 0
+    latencies = []
+    ack_latencies = []
+    violations = []
+    last_seq = 0
+    unacknowledged = 0
+    deadline = time.time() + duration
+    try:
+        while time.time() < deadline:
+            try:
+                opcode, payload = await asyncio.wait_for(websocket.receive(), deadline - time.time())
+            except asyncio.TimeoutError:
+                break
+            if opcode == OPCODE_CLOSE:
+                break
+            if opcode != OPCODE_BINARY:
+                continue
+            received = time.time()
+            seq, timestamp = WEBSOCKET_HEADER.unpack_from(payload)
+            frames += 1
+            received_bytes += len(payload)
+            latencies.append(received - timestamp)
+            if seq <= last_seq:
+                violations.append('frame {} after frame {}'.format(seq, last_seq))
+            last_seq = seq
+            unacknowledged += 1
+            if unacknowledged > window:
+                violations.append('{} frames unacknowledged'.format(unacknowledged))
+
+            if delay:
+                await asyncio.sleep(delay)
+            # with a window, acknowledge only when the last frame is reached to test cumulative acks
+            if unacknowledged >= window or delay:
+                websocket.send_text(json.dumps({'ack': seq}))
+                ack_latencies.append(time.time() - timestamp)
+                unacknowledged = 0
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        websocket.close()
+    return {'frames': frames, 'bytes': received_bytes, 'latencies': latencies,
+            'ack_latencies': ack_latencies, 'violations': violations}
+
+
+def summarize_viewers(results: list, duration: float) -> dict:
+    """
+    Returns:
+        dict: The summary of the MJPEG clients, the acknowledgement latency percentiles and the violations.
+    """
+    summary = summarize(results, duration)
+    connected = [result for result in results if result is not None]
+    latencies = np.array([latency for result in connected for latency in result['ack_latencies']]) * 1000
+    for percentile in (50, 90, 99):
+        summary['ack_latency_p{}_ms'.format(percentile)] = \
+            float(np.percentile(latencies, percentile)) if len(latencies) else None
+    summary['violations'] = sum(len(result['violations']) for result in connected)
+    return summary
+
+
+async def run_viewers(url: str, clients: int, slow_clients: int, delay: float, window: int,
+                      duration: float) -> dict:
+    """
+    Returns:
+        dict: The summaries of the fast and of the slow viewers.
+    """
+    tasks = [viewer(url, duration, 0, window) for _ in range(clients)] + \
+            [viewer(url, duration, delay, window) for _ in range(slow_clients)]
+    results = await asyncio.gather(*tasks)
+    for result in results:
+        if result is not None:
+            for violation in result['violations'][:3]:
+                print('Flow control violated: ' + violation)
+    return {
+        'fast': summarize_viewers(results[:clients], duration),
+        'slow': summarize_viewers(results[clients:], duration) if slow_clients else None,
+    }
+
+
+def start_server(port: int, fps: float, frame_bytes: int) -> subprocess.Popen:
+    """
+    Returns:
+        subprocess.Popen: uvicorn serving lib.asgi:app with the mock camera.
+    """
+    env = dict(os.environ, CAMERA='mock', MOCK_FPS=str(fps), MOCK_FRAME_BYTES=str(frame_bytes), MOCK_SCENE_SECONDS='0')
+    return subprocess.Popen([sys.executable, '-m', 'uvicorn', '--host', '127.0.0.1', '--port', str(port),
+                             '--log-level', 'warning', 'lib.asgi:app'],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless client of the WebSocket stream')
+    parser.add_argument('--url', type=str, help='Stream of a running server, by default uvicorn is started')
+    parser.add_argument('--port', type=int, default=9194)
+    parser.add_argument('--clients', type=int, default=5, help='Number of fast viewers')
+    parser.add_argument('--slow', type=int, default=1, help='Number of additional slow viewers')
+    parser.add_argument('--delay', type=float, default=0.2, help='Seconds a slow viewer takes per frame')
+    parser.add_argument('--window', type=int, default=1, help='Frames the server may send unacknowledged')
+    parser.add_argument('--fps', type=float, default=30, help='Frame rate of the mock camera')
+    parser.add_argument('--frame-bytes', type=int, default=100000, help='Size of the mock frames')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warm-up', type=float, default=3)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_server(args.port, args.fps, args.frame_bytes)
+        url = 'ws://127.0.0.1:{}/camerapi/ws'.format(args.port)
+        time.sleep(args.warm_up)
+    url += ('&' if '?' in url else '?') + 'window={}'.format(args.window)
+
+    try:
+        results = asyncio.run(run_viewers(url, args.clients, args.slow, args.delay, args.window, args.duration))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print('{:<6} {:>9} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'viewer', 'connected', 'fps', 'kB/s', 'p50 [ms]', 'p99 [ms]', 'ack p50', 'violations'))
+    for name, summary in results.items():
+        if summary is None:
+            continue
+        print('{:<6} {connected:>9} {fps_mean:>8.1f} {kbytes_per_second_mean:>8.0f} {:>10.1f} {:>10.1f} {:>10.1f} '
+              '{violations:>10}'.format(name, summary['latency_p50_ms'] or 0, summary['latency_p99_ms'] or 0,
+                                        summary['ack_latency_p50_ms'] or 0, **summary))
+    if any(summary and summary['violations'] for summary in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
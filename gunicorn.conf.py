@@ -0,0 +1,9 @@
+"""
+Hooks of gunicorn, e.g. gunicorn --config gunicorn.conf.py lib.api:provider.
+"""
+
+
+def post_worker_init(worker):
+    """Starts the cameras in the worker once it runs, importing lib.api does not start them."""
+    from lib.api import start_cameras
+    start_cameras()
@@ -1,30 +1,68 @@
 #!/usr/bin/env python
-import os
-from importlib import import_module
-from pathlib import Path
-from typing import Generator
 import logging
+import os
+import threading
+import time
+from datetime import datetime
 
 from flask import Flask, Response, redirect, jsonify, url_for, request
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import wrap_file
 from flask_cors import CORS
 
+from lib import metrics
+from lib.camera_registry import get_registry, CameraUnavailable
+from lib.chunk_stream import MIMETYPES, CONCATENABLE_EXTENSIONS, FileRange, find_chunk, open_chunks
+from lib.hls import PLAYLIST_MIMETYPE, SEGMENT_MIMETYPE
+from lib.mjpeg import MIMETYPE, encode_part
+from lib.recordings_index import query_recordings
+from lib.stream_client import StreamClient, get_client_stats
+from lib.stream_tiers import get_stream_tier, FULL_QUALITY
+from lib.timelapse import find_archive, list_days, make_thumbnail
+from lib.utils import read_password
+
 logging.basicConfig(format='[%(asctime)s] [CameraPi] [%(levelname)s] %(message)s', level=logging.DEBUG)
 
 provider = Flask(__name__)
 CORS(provider)
 
-# import camera driver
-if os.environ.get('CAMERA'):
-    Camera = import_module('lib.camera_' + os.environ['CAMERA']).Camera
-else:
-    from lib.camera_base import Camera
+started_at = time.time()
+
+# the cameras by their id, they start in the background once the server runs, see start_cameras
+registry = get_registry()
+cameras_started = False
+cameras_lock = threading.Lock()
+
+password = None
+
+
+def start_cameras():
+    """
+    Creates the cameras in the background, so the server answers right away.
+    Invoked by the gunicorn hook in gunicorn.conf.py, other servers start them on the first request.
+    """
+    global cameras_started
+    with cameras_lock:
+        if cameras_started:
+            return
+        cameras_started = True
+    registry.start_background()
 
-camera = Camera()
 
-current_path = Path(__file__).parent.parent
-with open(os.path.join(current_path, '.password')) as password_file:
-    password = password_file.read()
-password = password.strip()
+@provider.before_request
+def start_cameras_on_first_request():
+    start_cameras()
+
+
+def get_recording_password() -> str:
+    """
+    Returns:
+        str: The password of the recording control, read on first use.
+    """
+    global password
+    if password is None:
+        password = read_password()
+    return password
 
 
 def get_base_path() -> str:
@@ -47,29 +85,444 @@ def get_stream_path() -> str:
     return get_base_path() + 'stream/'
 
 
-def video_feed_generator(camera) -> Generator[str, None, None]:
+def get_camera_path() -> str:
     """
-    
+
     Returns:
-        Generator[str, None, None]: JPG camera images encoded as bitstring.
+        str: The base url path of the routes of a single camera, the routes without it serve the default camera.
+
     """
-    while True:
-        frame = camera.get_frame()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+    return get_base_path() + '<camera_id>/'
 
 
-@provider.route(get_stream_path())
-def video_feed() -> Response:
-    global camera
-    camera = Camera()
+def unknown_camera() -> Response:
+    return Response('Unknown camera', 404)
+
+
+@provider.errorhandler(CameraUnavailable)
+def camera_unavailable(e: CameraUnavailable) -> Response:
+    return Response(str(e), 503)
+
+
+@provider.route(get_base_path() + 'cameras', methods=['GET'])
+def cameras() -> Response:
+    """
+
+    Returns:
+        Response: The configured cameras by their id.
+    """
+    return jsonify({'cameras': registry.get_status()})
+
+
+@provider.route(get_base_path() + 'health', methods=['GET'])
+def health() -> Response:
+    """
+
+    Returns:
+        Response: Always 200 while the server is up, with the startup state of the cameras.
+    """
+    return jsonify({'status': 'ok', 'uptime': time.time() - started_at, 'cameras': registry.get_status()})
+
 
+@provider.route(get_base_path() + 'ready', methods=['GET'])
+def ready() -> Response:
     """
 
+    Returns:
+        Response: 200 once all cameras delivered a frame, 503 before.
+    """
+    is_ready = registry.is_ready()
+    response = jsonify({'ready': is_ready, 'cameras': registry.get_status()})
+    response.status_code = 200 if is_ready else 503
+    return response
+
+
+@provider.route(get_stream_path())
+@provider.route(get_camera_path() + 'stream/')
+def video_feed(camera_id: str = None) -> Response:
+    """
+
+    Query parameters:
+        max_fps: Maximal frames per second sent to the client.
+        quality: One of low, medium or full (default).
+
     Returns:
         Response: JPG camera images encoded as HTML response for streaming to the web.
     """
-    return Response(video_feed_generator(camera), mimetype='multipart/x-mixed-replace; boundary=frame')
+    camera = registry.get(camera_id)
+    if camera is None:
+        return unknown_camera()
+    try:
+        tier = get_stream_tier(camera, request.args.get('quality', FULL_QUALITY))
+    except ValueError as e:
+        return Response(str(e), 400)
+
+    client = StreamClient(tier or camera, address=request.remote_addr,
+                          max_fps=request.args.get('max_fps', type=float))
+    return Response(client.frames(), mimetype=MIMETYPE)
+
+
+@provider.route(get_base_path() + 'live.m3u8', methods=['GET'])
+@provider.route(get_camera_path() + 'live.m3u8', methods=['GET'])
+def live_playlist(camera_id: str = None) -> Response:
+    """
+
+    Returns:
+        Response: The HLS playlist of the low-bandwidth H.264 live stream, 404 if the camera has none.
+    """
+    camera = registry.get(camera_id)
+    if camera is None:
+        return unknown_camera()
+    if camera.live_segments is None:
+        return Response('No H.264 live stream, it needs the Pi camera with HLS=1', 404)
+
+    # the players reload the playlist every segment, which keeps the camera thread running
+    camera.start()
+    if not camera.live_segments.wait_for_segment(timeout=10):
+        return Response('No segment available', 503)
+
+    response = Response(camera.live_segments.get_playlist('live/{}.ts'), mimetype=PLAYLIST_MIMETYPE)
+    response.cache_control.no_cache = True
+    return response
+
+
+@provider.route(get_base_path() + 'live/<int:sequence>.ts', methods=['GET'])
+@provider.route(get_camera_path() + 'live/<int:sequence>.ts', methods=['GET'])
+def live_segment(sequence: int, camera_id: str = None) -> Response:
+    """
+
+    Returns:
+        Response: The MPEG-TS segment of the H.264 live stream, 404 if it was already dropped.
+    """
+    camera = registry.get(camera_id)
+    if camera is None:
+        return unknown_camera()
+    segment = camera.live_segments.get(sequence) if camera.live_segments is not None else None
+    if segment is None:
+        return Response('Unknown segment', 404)
+
+    response = Response(segment.data, mimetype=SEGMENT_MIMETYPE)
+    # a segment never changes
+    response.cache_control.max_age = 60
+    return response
+
+
+@provider.route(get_base_path() + 'snapshot', methods=['GET'])
+@provider.route(get_camera_path() + 'snapshot', methods=['GET'])
+def snapshot(camera_id: str = None) -> Response:
+    """
+
+    Query parameters:
+        max_age: Maximal age in seconds of a cached frame that is returned without waking the camera.
+
+    Returns:
+        Response: The latest JPG camera image, 304 if it matches the If-None-Match header.
+    """
+    camera = registry.get(camera_id)
+    if camera is None:
+        return unknown_camera()
+    frame = camera.get_snapshot(max_age=request.args.get('max_age', type=float))
+    if frame is None:
+        return Response('No frame available', 503)
+
+    response = Response(frame.data, mimetype='image/jpeg')
+    response.set_etag('{}-{}'.format(camera.broadcaster.epoch, frame.seq))
+    response.last_modified = frame.timestamp
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@provider.route(get_base_path() + 'clients', methods=['GET'])
+def stream_clients() -> Response:
+    """
+
+    Returns:
+        Response: The delivery statistics, e.g. the dropped frames, of all connected stream clients.
+    """
+    return jsonify({'clients': get_client_stats()})
+
+
+@provider.route(get_base_path() + 'status', methods=['GET'])
+@provider.route(get_camera_path() + 'status', methods=['GET'])
+def status(camera_id: str = None) -> Response:
+    """
+
+    Returns:
+        Response: The lifecycle state of the camera, e.g. the time to the first frame after the last start.
+    """
+    camera = registry.get(camera_id)
+    if camera is None:
+        return unknown_camera()
+    return jsonify(camera.get_status())
+
+
+def parse_time(value: str):
+    """
+    Parses a time given as unix timestamp or ISO 8601 string, e.g. 2021-05-01T12:00:00.
+
+    Returns:
+        float: The unix timestamp, None if no time is given.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+@provider.route(get_base_path() + 'metrics', methods=['GET'])
+def metrics_text() -> Response:
+    """
+
+    Returns:
+        Response: The metrics of the frame pipeline in the Prometheus text format.
+    """
+    return Response(metrics.render({
+        'camerapi_stream_clients': ('Connected stream clients.', len(get_client_stats())),
+        'camerapi_recording': ('Number of cameras that are recording.',
+                               sum(bool(camera.is_recording()) for camera in registry.get_cameras())),
+    }), mimetype=metrics.CONTENT_TYPE)
+
+
+@provider.route(get_base_path() + 'metrics', methods=['POST'])
+def toggle_metrics() -> Response:
+    """
+
+    Enables or disables the collection of the metrics, e.g. {"password": "...", "enabled": true}.
+
+    Returns:
+        Response: True if the password was correct.
+    """
+    if get_password() != get_recording_password():
+        logging.info('Password incorrect')
+        return jsonify({'success': False})
+
+    metrics.set_enabled((request.get_json(silent=True) or {}).get('enabled', True))
+    return jsonify({'success': True, 'enabled': metrics.enabled})
+
+
+@provider.route(get_base_path() + 'recordings', methods=['GET'])
+@provider.route(get_camera_path() + 'recordings', methods=['GET'])
+def recordings(camera_id: str = None) -> Response:
+    """
+
+    Query parameters:
+        from: Start of the time range as unix timestamp or ISO 8601 string.
+        to: End of the time range as unix timestamp or ISO 8601 string.
+
+    Returns:
+        Response: The recorded chunks of all recordings targets that overlap the time range, ordered by their start.
+    """
+    base_paths = registry.get_recordings_paths(camera_id)
+    if base_paths is None:
+        return unknown_camera()
+    try:
+        start = parse_time(request.args.get('from'))
+        end = parse_time(request.args.get('to'))
+    except ValueError as e:
+        return Response(str(e), 400)
+
+    chunks = query_recordings(base_paths, start, end)
+    for chunk in chunks:
+        chunk['url'] = url_for('recording_chunk', camera_id=camera_id, session=chunk['session'],
+                               name=os.path.basename(chunk['path']))
+    return jsonify({'chunks': chunks})
+
+
+def send_range(file, length: int, mimetype: str) -> Response:
+    """
+    Sends the file or the single byte range given in the Range header.
+
+    The file is handed to the WSGI server's file wrapper, i.e. gunicorn sends it with sendfile.
+    Multiple ranges are not supported, the whole file is sent instead.
+
+    Returns:
+        Response: 200 with the whole file, 206 with the requested range or 416 if the range is not satisfiable.
+    """
+    start, stop = 0, length
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) == 1:
+        range_tuple = byte_range.range_for_length(length)
+        if range_tuple is None:
+            file.close()
+            return Response(status=416, headers={'Content-Range': 'bytes */{}'.format(length)})
+        start, stop = range_tuple
+    else:
+        byte_range = None
+
+    file.seek(start)
+    response = Response(wrap_file(request.environ, FileRange(file, stop - start), buffer_size=64 * 1024),
+                        status=206 if byte_range else 200, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = stop - start
+    response.accept_ranges = 'bytes'
+    if byte_range:
+        response.content_range = ContentRange('bytes', start, stop, length)
+    return response
+
+
+@provider.route(get_base_path() + 'recordings/<session>/<name>', methods=['GET'])
+@provider.route(get_camera_path() + 'recordings/<session>/<name>', methods=['GET'])
+def recording_chunk(session: str, name: str, camera_id: str = None) -> Response:
+    """
+
+    Returns:
+        Response: The recorded chunk, supports Range requests for resumable downloads and seeking.
+    """
+    base_paths = registry.get_recordings_paths(camera_id)
+    if base_paths is None:
+        return unknown_camera()
+    path = find_chunk(base_paths, session, name)
+    if path is None:
+        return Response('Unknown chunk', 404)
+
+    file = open(path, 'rb')
+    response = send_range(file, os.fstat(file.fileno()).st_size, MIMETYPES[os.path.splitext(path)[1]])
+    response.last_modified = os.path.getmtime(path)
+    return response
+
+
+@provider.route(get_base_path() + 'recordings/concatenated', methods=['GET'])
+@provider.route(get_camera_path() + 'recordings/concatenated', methods=['GET'])
+def recordings_concatenated(camera_id: str = None) -> Response:
+    """
+
+    Query parameters:
+        from: Start of the time range as unix timestamp or ISO 8601 string.
+        to: End of the time range as unix timestamp or ISO 8601 string.
+
+    Returns:
+        Response: All chunks that overlap the time range as one continuous video, supports Range requests.
+    """
+    base_paths = registry.get_recordings_paths(camera_id)
+    if base_paths is None:
+        return unknown_camera()
+    try:
+        start = parse_time(request.args.get('from'))
+        end = parse_time(request.args.get('to'))
+    except ValueError as e:
+        return Response(str(e), 400)
+
+    chunks = query_recordings(base_paths, start, end)
+    if not chunks:
+        return Response('No recordings in the time range', 404)
+
+    # only chunks of the format of the first chunk are continuous
+    extension = os.path.splitext(chunks[0]['path'])[1]
+    if extension not in CONCATENABLE_EXTENSIONS:
+        return Response('Chunks of format {} cannot be concatenated'.format(extension), 400)
+    file = open_chunks([chunk['path'] for chunk in chunks if chunk['path'].endswith(extension)])
+    return send_range(file, file.length, MIMETYPES[extension])
+
+
+@provider.route(get_base_path() + 'timelapse', methods=['GET'])
+@provider.route(get_camera_path() + 'timelapse', methods=['GET'])
+def timelapse_days(camera_id: str = None) -> Response:
+    """
+
+    Returns:
+        Response: The days with a timelapse archive and their number of frames.
+    """
+    base_paths = registry.get_recordings_paths(camera_id)
+    if base_paths is None:
+        return unknown_camera()
+    return jsonify({'days': list_days(base_paths)})
+
+
+@provider.route(get_base_path() + 'timelapse/<day>', methods=['GET'])
+@provider.route(get_camera_path() + 'timelapse/<day>', methods=['GET'])
+def timelapse_frames(day: str, camera_id: str = None) -> Response:
+    """
+
+    Query parameters:
+        page: The page of frames, starting at 0.
+        per_page: Number of frames per page, defaults to 50.
+
+    Returns:
+        Response: The timestamps and the thumbnail urls of the frames on the page.
+    """
+    base_paths = registry.get_recordings_paths(camera_id)
+    if base_paths is None:
+        return unknown_camera()
+    archive = find_archive(base_paths, day)
+    if archive is None:
+        return Response('Unknown day', 404)
+
+    per_page = max(1, min(500, request.args.get('per_page', 50, type=int)))
+    start = max(0, request.args.get('page', 0, type=int)) * per_page
+    frames = [{
+        'index': index,
+        'timestamp': timestamp,
+        'size': size,
+        'url': url_for('timelapse_frame', camera_id=camera_id, day=day, index=index),
+        'thumbnail': url_for('timelapse_frame', camera_id=camera_id, day=day, index=index, thumbnail=1),
+    } for index, timestamp, size in archive.get_entries(start, start + per_page)]
+    return jsonify({'day': day, 'total': len(archive), 'per_page': per_page, 'frames': frames})
+
+
+@provider.route(get_base_path() + 'timelapse/<day>/<int:index>', methods=['GET'])
+@provider.route(get_camera_path() + 'timelapse/<day>/<int:index>', methods=['GET'])
+def timelapse_frame(day: str, index: int, camera_id: str = None) -> Response:
+    """
+
+    Query parameters:
+        thumbnail: 1 for a downscaled frame.
+
+    Returns:
+        Response: The JPG frame of the timelapse.
+    """
+    base_paths = registry.get_recordings_paths(camera_id)
+    if base_paths is None:
+        return unknown_camera()
+    archive = find_archive(base_paths, day)
+    frame = archive.read_frame(index) if archive is not None else None
+    if frame is None:
+        return Response('Unknown frame', 404)
+
+    timestamp, data = frame
+    if request.args.get('thumbnail', 0, type=int):
+        data = make_thumbnail(data)
+    response = Response(data, mimetype='image/jpeg')
+    response.last_modified = timestamp
+    response.cache_control.max_age = 24 * 60 * 60
+    return response
+
+
+@provider.route(get_base_path() + 'timelapse/<day>/render', methods=['GET'])
+@provider.route(get_camera_path() + 'timelapse/<day>/render', methods=['GET'])
+def timelapse_render(day: str, camera_id: str = None) -> Response:
+    """
+
+    Query parameters:
+        fps: Frames per second of the rendered timelapse, defaults to 10.
+        start: Index of the first frame.
+        stop: Index after the last frame.
+
+    Returns:
+        Response: The frames of the timelapse as MJPEG stream.
+    """
+    base_paths = registry.get_recordings_paths(camera_id)
+    if base_paths is None:
+        return unknown_camera()
+    archive = find_archive(base_paths, day)
+    if archive is None:
+        return Response('Unknown day', 404)
+
+    delay = 1 / max(0.1, request.args.get('fps', 10, type=float))
+    start = max(0, request.args.get('start', 0, type=int))
+    stop = request.args.get('stop', len(archive), type=int)
+
+    def render():
+        deadline = time.time()
+        for index in range(start, min(stop, len(archive))):
+            frame = archive.read_frame(index)
+            if frame is None:
+                break
+            yield encode_part(frame[1])
+            deadline += delay
+            time.sleep(max(0.0, deadline - time.time()))
+
+    return Response(render(), mimetype=MIMETYPE)
 
 
 @provider.route('/')
@@ -107,8 +560,8 @@ def get_password() -> str:
 
 
 @provider.route(get_base_path() + 'start_recording', methods=['POST'])
-def start_recording() -> Response:
-    global camera
+@provider.route(get_camera_path() + 'start_recording', methods=['POST'])
+def start_recording(camera_id: str = None) -> Response:
     """
 
     Starts the recording of the camera to disk on the server.
@@ -116,9 +569,11 @@ def start_recording() -> Response:
     Returns:
         Response: Endpoint for the video stream.
     """
-    global password
     logging.info('Start recording requested')
-    if get_password() != password:
+    camera = registry.get(camera_id)
+    if camera is None:
+        return unknown_camera()
+    if get_password() != get_recording_password():
         logging.info('Password incorrect')
         return jsonify({'success': False})
 
@@ -128,7 +583,8 @@ def start_recording() -> Response:
 
 
 @provider.route(get_base_path() + 'stop_recording', methods=['POST'])
-def stop_recording() -> Response:
+@provider.route(get_camera_path() + 'stop_recording', methods=['POST'])
+def stop_recording(camera_id: str = None) -> Response:
     """
 
     Stops the recording of the camera to disk on the server.
@@ -136,9 +592,11 @@ def stop_recording() -> Response:
     Returns:
         Response: Endpoint for the video stream.
     """
-    global password
     logging.info('Stop recording requested')
-    if get_password() != password:
+    camera = registry.get(camera_id)
+    if camera is None:
+        return unknown_camera()
+    if get_password() != get_recording_password():
         logging.info('Password incorrect')
         return jsonify({'success': False})
     
@@ -148,7 +606,8 @@ def stop_recording() -> Response:
 
 
 @provider.route(get_base_path() + 'is_recording', methods=['GET'])
-def is_recording() -> Response:
+@provider.route(get_camera_path() + 'is_recording', methods=['GET'])
+def is_recording(camera_id: str = None) -> Response:
     """
 
     Stops the recording of the camera to disk on the server.
@@ -157,6 +616,9 @@ def is_recording() -> Response:
         Response: Endpoint for the video stream.
     """
     logging.info('Is recording requested')
+    camera = registry.get(camera_id)
+    if camera is None:
+        return unknown_camera()
     return jsonify({'success': camera.is_recording()})
 
 
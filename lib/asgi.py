@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+"""
+Asyncio (ASGI) alternative to the Flask provider in lib.api.
+
+The camera thread hands every frame to the event loop, all stream clients
+are coroutines waiting on the same future. Run with e.g.
+    uvicorn --host 0.0.0.0 --port 9090 lib.asgi:app
+
+Besides the MJPEG stream, the frames are served as binary WebSocket
+messages on /camerapi/ws and /camerapi/<camera_id>/ws, see
+CameraApp.websocket_feed. uvicorn needs the websockets or wsproto package
+for WebSockets.
+"""
+import asyncio
+import json
+import logging
+import struct
+from urllib.parse import parse_qs
+
+from lib.camera_registry import get_registry, CameraUnavailable
+from lib.mjpeg import MIMETYPE, KEEPALIVE_PART
+from lib.stream_client import StreamClient, get_client_stats
+from lib.stream_tiers import get_stream_tier, FULL_QUALITY
+from lib.utils import read_password
+
+logging.basicConfig(format='[%(asctime)s] [CameraPi] [%(levelname)s] %(message)s', level=logging.DEBUG)
+
+base_path = '/camerapi/'
+stream_path = base_path + 'stream/'
+websocket_path = base_path + 'ws'
+
+# Header of every binary WebSocket message: the sequence number of the frame
+# and the time it was published by the camera in seconds since the epoch,
+# in network byte order.
+WEBSOCKET_HEADER = struct.Struct('!Qd')
+# Maximal number of frames a WebSocket client may leave unacknowledged.
+MAX_WEBSOCKET_WINDOW = 8
+
+
+class AsyncFrameRelay(object):
+    """
+    Relays the frames published by the camera thread into the event loop.
+
+    Attributes:
+        frame: The latest frame
+        waiter: Future that is resolved with the next frame
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        """ constructor """
+        self.loop = loop
+        self.frame = None
+        self.waiter = loop.create_future()
+
+    def on_frame(self, frame):
+        """Invoked by the camera thread with every published frame."""
+        self.loop.call_soon_threadsafe(self.set_frame, frame)
+
+    def set_frame(self, frame):
+        """Invoked in the event loop, wakes all waiting clients at once."""
+        self.frame = frame
+        waiter, self.waiter = self.waiter, self.loop.create_future()
+        waiter.set_result(frame)
+
+    async def next_frame(self, after_seq: int = 0, timeout: float = 10):
+        """
+        Returns:
+            Frame: The newest frame with a sequence number larger than after_seq,
+                None if it did not arrive in time.
+        """
+        if self.frame is not None and self.frame.seq > after_seq:
+            return self.frame
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.waiter), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def split_camera_path(path: str, camera_ids) -> tuple:
+    """
+    Splits the camera id from a path like /camerapi/<camera_id>/stream/.
+
+    Returns:
+        tuple: The camera id, None for the default camera, and the path of the route without the camera id.
+    """
+    if path.startswith(base_path):
+        camera_id, _, rest = path[len(base_path):].partition('/')
+        if rest and camera_id in camera_ids:
+            return camera_id, base_path + rest
+    return None, path
+
+
+class CameraApp(object):
+    """
+    ASGI application serving the stream and recording control routes of lib.api.
+    """
+
+    def __init__(self):
+        """ constructor """
+        self.registry = None
+        self.relays = {}
+        self.password = None
+        self.startup_lock = None
+
+    async def startup(self):
+        """Starts the default camera, the frames of the cameras are connected to the event loop on demand."""
+        if self.startup_lock is None:
+            self.startup_lock = asyncio.Lock()
+        async with self.startup_lock:
+            if self.registry is not None:
+                return
+            self.registry = get_registry()
+            self.registry.start_background()
+
+    async def get_camera(self, camera_id: str = None):
+        """
+        Returns:
+            Camera: The camera of the id, it is created in an executor as importing its driver might block.
+        """
+        camera = self.registry.cameras.get(camera_id or self.registry.default_id)
+        if camera is None:
+            camera = await asyncio.get_event_loop().run_in_executor(None, self.registry.get, camera_id)
+        return camera
+
+    def get_relay(self, source) -> AsyncFrameRelay:
+        """
+        Returns:
+            AsyncFrameRelay: The relay of the frames of the given source, i.e. the camera or a stream tier.
+        """
+        if source not in self.relays:
+            relay = AsyncFrameRelay(asyncio.get_event_loop())
+            source.broadcaster.add_listener(relay.on_frame)
+            self.relays[source] = relay
+        return self.relays[source]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] not in ('http', 'websocket'):
+            return
+
+        await self.startup()
+        camera_id, path = split_camera_path(scope['path'], self.registry)
+        if scope['type'] == 'websocket':
+            await self.websocket_route(camera_id, path, scope, receive, send)
+            return
+        if path in ('/', base_path):
+            await send_response(send, 302, b'', headers=[(b'location', stream_path.encode())])
+        elif path == base_path + 'clients':
+            await send_json(send, {'clients': get_client_stats()})
+        elif path == base_path + 'cameras':
+            await send_json(send, {'cameras': self.registry.get_status()})
+        elif path == base_path + 'health':
+            await send_json(send, {'status': 'ok', 'cameras': self.registry.get_status()})
+        elif path == base_path + 'ready':
+            is_ready = self.registry.is_ready()
+            await send_json(send, {'ready': is_ready, 'cameras': self.registry.get_status()},
+                            status=200 if is_ready else 503)
+        elif path in (stream_path, base_path + 'status', base_path + 'is_recording', base_path + 'start_recording',
+                      base_path + 'stop_recording'):
+            try:
+                camera = await self.get_camera(camera_id)
+            except CameraUnavailable as e:
+                await send_response(send, 503, str(e).encode())
+                return
+            await self.camera_route(camera, path, scope, receive, send)
+        else:
+            await send_response(send, 404, b'Not found')
+
+    async def camera_route(self, camera, path: str, scope, receive, send):
+        """Serves the routes of a single camera."""
+        if path == stream_path:
+            await self.video_feed(camera, scope, receive, send)
+        elif path == base_path + 'status':
+            await send_json(send, camera.get_status())
+        elif path == base_path + 'is_recording':
+            logging.info('Is recording requested')
+            await send_json(send, {'success': camera.is_recording()})
+        elif path == base_path + 'start_recording' and scope['method'] == 'POST':
+            logging.info('Start recording requested')
+            await self.recording_control(receive, send, camera.record)
+        elif path == base_path + 'stop_recording' and scope['method'] == 'POST':
+            logging.info('Stop recording requested')
+            await self.recording_control(receive, send, camera.stop_recording)
+        else:
+            await send_response(send, 404, b'Not found')
+
+    async def websocket_route(self, camera_id: str, path: str, scope, receive, send):
+        """Serves the WebSocket stream, other WebSocket paths are rejected."""
+        if path != websocket_path:
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        try:
+            camera = await self.get_camera(camera_id)
+        except CameraUnavailable as e:
+            logging.info(str(e))
+            await send({'type': 'websocket.close', 'code': 1011})
+            return
+        await self.websocket_feed(camera, scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def recording_control(self, receive, send, action):
+        """Runs the recording action if the request contains the correct password."""
+        body = await read_body(receive)
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            data = None
+        received_password = str(data['password']).strip() if isinstance(data, dict) and 'password' in data else ''
+        if self.password is None:
+            self.password = read_password()
+        if received_password != self.password:
+            logging.info('Password incorrect')
+            await send_json(send, {'success': False})
+            return
+
+        logging.info('Password correct')
+        await asyncio.get_event_loop().run_in_executor(None, action)
+        await send_json(send, {'success': True})
+
+    async def video_feed(self, camera, scope, receive, send):
+        """Streams the frames of the camera as MJPEG with the same delivery policy as StreamClient."""
+        query = parse_qs(scope.get('query_string', b'').decode())
+        try:
+            max_fps = float(query['max_fps'][0]) if 'max_fps' in query else None
+        except ValueError:
+            max_fps = None
+        try:
+            tier = get_stream_tier(camera, query.get('quality', [FULL_QUALITY])[0])
+        except ValueError as e:
+            await send_response(send, 400, str(e).encode())
+            return
+        source = tier or camera
+        relay = self.get_relay(source)
+        client = StreamClient(source, address=(scope.get('client') or ('',))[0], max_fps=max_fps)
+
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', MIMETYPE.encode()), (b'cache-control', b'no-cache')]})
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        client.register()
+        try:
+            while not disconnected.done():
+                await asyncio.sleep(client.get_throttle_delay())
+                frame = await relay.next_frame(client.last_seq)
+                if frame is None:
+                    continue
+                part = client.accept(frame)
+                if part is None:
+                    continue
+
+                try:
+                    await asyncio.wait_for(
+                        send({'type': 'http.response.body', 'body': part, 'more_body': True}),
+                        client.stall_timeout)
+                except asyncio.TimeoutError:
+                    logging.info('Stream client {} stalled, disconnecting'.format(client.id))
+                    break
+                if not client.sent_frame():
+                    break
+        except OSError:
+            pass
+        finally:
+            client.unregister()
+            disconnected.cancel()
+
+    async def websocket_feed(self, camera, scope, receive, send):
+        """
+        Streams the frames of the camera as binary WebSocket messages with flow control by the client.
+
+        Every message is the WEBSOCKET_HEADER followed by the JPG. The
+        client acknowledges every frame with the text message {"ack": seq},
+        which also acknowledges all frames before it. At most window frames,
+        given in the query like quality and max_fps, are sent unacknowledged,
+        so a slow client is always sent the newest frame once it is ready
+        instead of a backlog. The time from the publication of a frame to its
+        acknowledgement is the end-to-end latency of the client. A client
+        that does not acknowledge within the stall timeout is disconnected.
+        """
+        if (await receive())['type'] != 'websocket.connect':
+            return
+        query = parse_qs(scope.get('query_string', b'').decode())
+        try:
+            max_fps = float(query['max_fps'][0]) if 'max_fps' in query else None
+        except ValueError:
+            max_fps = None
+        try:
+            window = min(MAX_WEBSOCKET_WINDOW, max(1, int(query.get('window', [1])[0])))
+        except ValueError:
+            window = 1
+        try:
+            tier = get_stream_tier(camera, query.get('quality', [FULL_QUALITY])[0])
+        except ValueError as e:
+            logging.info(str(e))
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        source = tier or camera
+        relay = self.get_relay(source)
+        client = StreamClient(source, address=(scope.get('client') or ('',))[0], max_fps=max_fps)
+
+        await send({'type': 'websocket.accept'})
+
+        # publication times of the unacknowledged frames by their sequence number
+        in_flight = {}
+        message = asyncio.ensure_future(receive())
+        frame = None
+        client.register()
+        try:
+            while True:
+                if frame is None and len(in_flight) < window:
+                    frame = asyncio.ensure_future(next_websocket_frame(client, relay))
+                done, _ = await asyncio.wait({message, frame} - {None}, timeout=client.stall_timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done and len(in_flight) >= window:
+                    logging.info('Stream client {} did not acknowledge, disconnecting'.format(client.id))
+                    break
+
+                if message in done:
+                    if not handle_websocket_ack(client, message.result(), in_flight):
+                        break
+                    message = asyncio.ensure_future(receive())
+
+                if frame in done:
+                    next_frame, frame = frame.result(), None
+                    if next_frame is None:
+                        continue
+                    await send({'type': 'websocket.send',
+                                'bytes': WEBSOCKET_HEADER.pack(next_frame.seq, next_frame.timestamp) + next_frame.data})
+                    in_flight[next_frame.seq] = next_frame.timestamp
+                    if not client.sent_frame():
+                        break
+        except OSError:
+            pass
+        finally:
+            client.unregister()
+            message.cancel()
+            if frame is not None:
+                frame.cancel()
+
+
+async def next_websocket_frame(client: StreamClient, relay: AsyncFrameRelay):
+    """
+    Returns:
+        Frame: The next frame the client accepts, None if no frame arrived in time.
+            Unchanged frames are skipped, the WebSocket itself keeps the connection alive.
+    """
+    while True:
+        await asyncio.sleep(client.get_throttle_delay())
+        frame = await relay.next_frame(client.last_seq)
+        if frame is None:
+            return None
+        part = client.accept(frame)
+        if part is not None and part is not KEEPALIVE_PART:
+            return frame
+
+
+def handle_websocket_ack(client: StreamClient, message: dict, in_flight: dict) -> bool:
+    """
+    Removes the acknowledged frames from the frames in flight.
+
+    Returns:
+        bool: False if the client disconnected.
+    """
+    if message['type'] == 'websocket.disconnect':
+        return False
+    try:
+        seq = int(json.loads(message.get('text') or '{}')['ack'])
+    except (ValueError, TypeError, KeyError):
+        logging.debug('Invalid acknowledgement of stream client {}: {}'.format(client.id, message))
+        return True
+    timestamp = in_flight.get(seq)
+    if timestamp is not None:
+        client.acknowledged(timestamp)
+    for acknowledged in [sent_seq for sent_seq in in_flight if sent_seq <= seq]:
+        del in_flight[acknowledged]
+    return True
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_response(send, status: int, body: bytes, content_type: bytes = b'text/plain', headers: list = None):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type),
+                            (b'content-length', str(len(body)).encode()),
+                            (b'access-control-allow-origin', b'*')] + (headers or [])})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data: dict, status: int = 200):
+    await send_response(send, status, json.dumps(data).encode(), content_type=b'application/json')
+
+
+app = CameraApp()
@@ -1,135 +1,341 @@
 import logging
+import os
 import pathlib
 import threading
 import time
 from abc import ABC
+from importlib import import_module
 
+from lib import metrics
 from lib.data_provider import get_data_path
+from lib.frame_recorder import FrameRecorder
+from lib.frame_broadcaster import FrameBroadcaster, Frame
+from lib.mjpeg import encode_part
+from lib.motion_detector import MotionMonitor, is_motion_detection_enabled
+from lib.pre_event_buffer import PreEventBuffer
+from lib.recordings_folder import RecordingsFolder
+from lib.timelapse import Timelapse, get_timelapse_interval
+from lib.utils import get_env_recordings_path
 
-try:
-    from greenlet import getcurrent as get_ident
-except ImportError:
-    try:
-        from thread import get_ident
-    except ImportError:
-        from _thread import get_ident
+
+def get_idle_timeout() -> float:
+    """
+    Returns:
+        float: Seconds without stream clients after which the camera thread is suspended.
+    """
+    if os.environ.get('CAMERA_IDLE_TIMEOUT'):
+        return float(os.environ['CAMERA_IDLE_TIMEOUT'])
+    return 10
 
 
-class CameraEvent(object):
-    """An Event-like class that signals all active clients when a new frame is
-    available.
+def get_encode_budget() -> int:
     """
+    Returns:
+        int: Maximal number of frames that are encoded at the same time by all cameras of the process,
+            ENCODE_BUDGET defaults to the number of CPUs.
+    """
+    if os.environ.get('ENCODE_BUDGET'):
+        return max(1, int(os.environ['ENCODE_BUDGET']))
+    return os.cpu_count() or 1
+
+
+# shared by the encoders of all cameras, bounds the CPU spent on encoding
+encode_budget = threading.BoundedSemaphore(get_encode_budget())
 
-    def __init__(self):
-        self.events = {}
-
-    def wait(self):
-        """Invoked from each client's thread to wait for the next frame."""
-        ident = get_ident()
-        if ident not in self.events:
-            # this is a new client
-            # add an entry for it in the self.events dict
-            # each entry has two elements, a threading.Event() and a timestamp
-            self.events[ident] = [threading.Event(), time.time()]
-        return self.events[ident][0].wait()
-
-    def set(self):
-        """Invoked by the camera thread when a new frame is available."""
-        now = time.time()
-        remove = None
-        for ident, event in self.events.items():
-            if not event[0].isSet():
-                # if this client's event is not set, then set it
-                # also update the last set timestamp to now
-                event[0].set()
-                event[1] = now
-            else:
-                # if the client's event is already set, it means the client
-                # did not process a previous frame
-                # if the event stays set for more than 5 seconds, then assume
-                # the client is gone and remove it
-                if now - event[1] > 5:
-                    remove = ident
-        if remove:
-            del self.events[remove]
-
-    def clear(self):
-        """Invoked from each client's thread after a frame was processed."""
-        self.events[get_ident()][0].clear()
+error_image = None
+
+
+def get_error_image() -> bytes:
+    """
+    Returns:
+        bytes: The image that is streamed if there is no camera driver, loaded on first use.
+    """
+    global error_image
+    if error_image is None:
+        error_image = pathlib.Path(get_data_path(), 'error-icon.png').read_bytes()
+    return error_image
 
 
 class Camera(object):
     """
     Base class for the cameras.
 
+    Every camera instance has its own camera thread, broadcaster and
+    recordings folder, so several cameras can be served by one process, see
+    lib.camera_registry.
+
+    The camera thread is suspended if there haven't been any clients for the
+    idle timeout and no recording is running. It is restarted as soon as a
+    client asks for a frame again.
+
     Attributes:
+        camera_id: The id of the camera in the routes and recordings
         thread: Background thread that reads frames from camera
-        frame: Current frame is stored here by background thread
+        broadcaster: Current frame is published here by background thread
+        recordings_folder: The recordings and timelapse archives of the camera
         last_access: Time of last client access to the camera
+        subscribers: Number of connected stream clients
+        idle_timeout: Seconds without clients after which the camera thread is suspended
+        starts: Number of times the camera thread was started
+        started_at: Time the camera thread was last started
+        time_to_first_frame: Seconds from the last start of the camera thread to its first frame
+        pre_event_buffer: The most recent frames that are added to the start of a recording
+        motion_monitor: Starts and stops recordings on motion if MOTION_DETECTION=1,
+            it keeps the camera thread running
+        recorder: Records the frames of the camera thread
+        timelapse: Samples a frame every TIMELAPSE_INTERVAL seconds into the timelapse archive
+        live_segments: The segments of the H.264 live stream served as HLS,
+            None if the camera has no H.264 encoder
     """
 
-    thread = None
-    frame = None
-    last_access = 0
-    event = CameraEvent()
-    error_image = open(pathlib.Path(get_data_path(), 'error-icon.png'), 'rb').read()
+    idle_timeout = get_idle_timeout()
+    live_segments = None
 
-    def __init__(self):
-        """Start the background camera thread if it isn't running yet."""
-        if Camera.thread is None:
-            Camera.last_access = time.time()
+    def __init__(self, camera_id: str = 'default', recordings_subdirectory: str = ''):
+        """
+        Start the background camera thread.
 
-            # start background frame thread
-            Camera.thread = threading.Thread(target=self._thread)
-            Camera.thread.start()
+        The constructor never blocks, e.g. on the warm up of the sensor. The
+        first frame arrives in the background, see is_ready.
+        """
+        self.camera_id = camera_id
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_access = 0
+        self.subscribers = 0
+        self.starts = 0
+        self.started_at = 0
+        self.time_to_first_frame = None
+        self.broadcaster = FrameBroadcaster()
+        self.pre_event_buffer = self.create_pre_event_buffer()
+        self.recordings_folder = RecordingsFolder(get_env_recordings_path(), subdirectory=recordings_subdirectory)
+        self.motion_monitor = None
+        self.recorder = None
+        self.timelapse = None
 
-            # wait until frames are available
-            while self.get_frame() is None:
-                time.sleep(0)
+        self.start()
+
+        if is_motion_detection_enabled():
+            self.motion_monitor = MotionMonitor(self)
+            self.motion_monitor.start()
+        if get_timelapse_interval() > 0:
+            self.timelapse = Timelapse(self, self.recordings_folder, get_timelapse_interval())
+            self.timelapse.start()
+
+    def create_pre_event_buffer(self) -> PreEventBuffer:
+        """
+        Returns:
+            PreEventBuffer: The buffer of the frames before a recording.
+        """
+        return PreEventBuffer()
+
+    def start(self):
+        """
+        Start the background camera thread if it isn't running yet.
+
+        Returns:
+            int: The sequence number of the last frame before the start, None if the thread was already running.
+        """
+        with self.lock:
+            self.last_access = time.time()
+            if self.thread is not None:
+                return None
+            return self.start_thread()
+
+    def start_thread(self) -> int:
+        """
+        Starts the background camera thread, invoked with the lock held.
+
+        Returns:
+            int: The sequence number of the last frame before the start.
+        """
+        latest_frame = self.broadcaster.get_latest_frame()
+        self.starts += 1
+        self.started_at = time.time()
+        self.time_to_first_frame = None
+
+        # start background frame thread
+        self.thread = threading.Thread(target=self._thread, name='camera-' + self.camera_id)
+        self.thread.start()
+        return latest_frame.seq if latest_frame else 0
+
+    def is_ready(self) -> bool:
+        """
+        Returns:
+            bool: True if the camera delivered a frame since the process started.
+        """
+        return self.broadcaster.get_latest_frame() is not None
 
     def get_frame(self):
         """Return the current camera frame."""
-        Camera.last_access = time.time()
+        frame = self.next_frame()
+        if frame is None:
+            return None
+        return frame.data
 
-        # wait for a signal from the camera thread
-        Camera.event.wait()
-        Camera.event.clear()
+    def next_frame(self, after_seq: int = None) -> Frame:
+        """
+        Return the newest frame of the camera thread, None if it did not arrive in time.
 
-        return Camera.frame
+        Args:
+            after_seq: Wait for a frame newer than this sequence number,
+                defaults to the last frame received by the calling client.
+        """
+        self.last_access = time.time()
+        if self.thread is None:
+            self.start()
 
-    @staticmethod
-    def frames():
+        # wait for the next frame of the camera thread
+        return self.broadcaster.wait_for_frame(after_seq=after_seq, timeout=10)
+
+    def get_snapshot(self, max_age: float = None) -> Frame:
+        """
+        Return the latest frame without streaming.
+
+        Args:
+            max_age: Maximal age in seconds of the latest frame that is returned
+                without waking the camera thread. By default the latest frame is
+                returned if the camera thread is running.
+
+        Returns:
+            Frame: The latest frame, None if no frame arrived in time.
+        """
+        latest_frame = self.broadcaster.get_latest_frame()
+        if latest_frame is not None:
+            if max_age is None and self.thread is not None:
+                return latest_frame
+            if max_age is not None and time.time() - latest_frame.timestamp <= max_age:
+                return latest_frame
+
+        return self.next_frame(after_seq=latest_frame.seq if latest_frame else 0)
+
+    def subscribe(self):
+        """Invoked when a stream client connects."""
+        self.subscribers += 1
+        self.start()
+
+    def unsubscribe(self):
+        """Invoked when a stream client disconnects."""
+        self.subscribers = max(0, self.subscribers - 1)
+        self.last_access = time.time()
+
+    def get_status(self) -> dict:
+        """
+        Returns:
+            dict: The lifecycle state of the camera thread.
+        """
+        return {
+            'camera': self.camera_id,
+            'ready': self.is_ready(),
+            'running': self.thread is not None,
+            'recording': self.is_recording(),
+            'subscribers': self.subscribers,
+            'idle_timeout': self.idle_timeout,
+            'starts': self.starts,
+            'started_at': self.started_at,
+            'time_to_first_frame': self.time_to_first_frame,
+            'pre_event_seconds': self.pre_event_buffer.get_duration(),
+            'motion': self.motion_monitor.get_status() if self.motion_monitor else None,
+            'recorder': self.recorder.get_status() if self.recorder else None,
+            'timelapse': self.timelapse.get_status() if self.timelapse else None,
+        }
+
+    def frames(self):
         """"Generator that returns frames from the camera."""
         while True:
             time.sleep(3)
-            yield Camera.error_image
+            yield get_error_image()
 
-    @classmethod
-    def _thread(cls):
+    def is_idle(self) -> bool:
+        """
+        Returns:
+            bool: True if there hasn't been any client within the idle timeout and no recording is running.
+        """
+        return self.subscribers == 0 \
+            and time.time() - self.last_access > self.idle_timeout \
+            and not self.is_recording()
+
+    def _thread(self):
         """Camera background thread."""
-        logging.info('Starting camera thread')
-        frames_iterator = cls.frames()
-        for frame in frames_iterator:
-            Camera.frame = frame
-            Camera.event.set()  # send signal to clients
-            time.sleep(0)
-
-            # if there hasn't been any clients asking for frames in
-            # the last 10 seconds then stop the thread
-            # if time.time() - Camera.last_access > 10:
-            #     frames_iterator.close()
-            #     logging.info('Stopping camera thread due to inactivity')
-            #     break
-        Camera.thread = None
-
-    @staticmethod
-    def record():
-        pass
-
-    @staticmethod
-    def stop_recording():
-        pass
-
-    @staticmethod
-    def is_recording():
-        return False
+        logging.info('Starting camera thread of {}'.format(self.camera_id))
+        frames_iterator = self.frames()
+        last_timestamp = None
+        fps = None
+        requested = time.perf_counter()
+        suspended = False
+        try:
+            for frame in frames_iterator:
+                if self.time_to_first_frame is None:
+                    self.time_to_first_frame = time.time() - self.started_at
+                    logging.info('First frame of {} after {:.3f} s'.format(self.camera_id, self.time_to_first_frame))
+
+                measure = metrics.enabled
+                if measure:
+                    produced = time.perf_counter()
+                    metrics.stage_seconds.observe(produced - requested, ('frame',))
+                # an unchanged image keeps the part of its first frame, so it is not encoded again
+                digest = self.broadcaster.get_digest(frame)
+                part = None if self.broadcaster.is_duplicate(frame, digest) else encode_part(frame)
+                published = self.broadcaster.publish(frame, part, digest)  # send signal to clients
+                if measure:
+                    metrics.stage_seconds.observe(time.perf_counter() - produced, ('publish',))
+                    labels = (self.camera_id,)
+                    metrics.frames_total.inc(labels=labels)
+                    metrics.frame_bytes_total.inc(len(frame), labels)
+                    metrics.frame_bytes.set(len(frame), labels)
+                    if last_timestamp is not None and published.timestamp > last_timestamp:
+                        current_fps = 1 / (published.timestamp - last_timestamp)
+                        fps = current_fps if fps is None else 0.9 * fps + 0.1 * current_fps
+                        metrics.capture_fps.set(fps, labels)
+                last_timestamp = published.timestamp
+                self.pre_event_buffer.append(published.timestamp, frame)
+                if self.recorder is not None:
+                    self.recorder.submit(published.timestamp, frame)
+                time.sleep(0)
+
+                # if there hasn't been any clients asking for frames in
+                # the idle timeout then stop the thread
+                if self.is_idle():
+                    logging.info('Suspending camera thread of {} due to inactivity'.format(self.camera_id))
+                    suspended = True
+                    break
+                requested = time.perf_counter()
+        finally:
+            # the thread stays set until the camera is closed, so no second thread opens it in the meantime
+            frames_iterator.close()
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+                    if suspended and not self.is_idle():
+                        # a client arrived while the camera was closed
+                        self.start_thread()
+            logging.info('Stopped camera thread of {}'.format(self.camera_id))
+
+    def record(self):
+        """Starts recording the frames, the first chunk starts with the pre-event frames."""
+        if self.recorder is None:
+            self.recorder = FrameRecorder(self.recordings_folder)
+        self.recorder.start(self.pre_event_buffer.drain())
+
+        # the recording keeps the camera thread running
+        self.start()
+
+    def stop_recording(self):
+        """Stops the recording."""
+        if self.recorder is not None:
+            self.recorder.stop()
+
+    def is_recording(self):
+        return self.recorder is not None and self.recorder.recording
+
+
+def get_camera_class(driver: str = None):
+    """
+    Returns:
+        The camera driver of the given name, by default selected by the CAMERA environment variable,
+            e.g. CAMERA=pi for lib.camera_pi.
+    """
+    driver = os.environ.get('CAMERA') if driver is None else driver
+    if driver:
+        return import_module('lib.camera_' + driver).Camera
+    return Camera
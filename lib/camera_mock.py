@@ -1,28 +1,184 @@
+import os
 import pathlib
+import re
+import struct
 import time
 
-from lib.camera_base import Camera
+from lib.camera_base import Camera, encode_budget
 from lib.data_provider import get_data_path
+from lib.overlay import TimestampOverlay, is_overlay_enabled
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+# the capture time is embedded into every frame as JPG comment, so clients can measure the latency
+TIMESTAMP_MARKER = b'camerapi-ts:'
+TIMESTAMP_PATTERN = re.compile(re.escape(TIMESTAMP_MARKER) + rb'(\d+\.\d+);')
+MAX_COMMENT_BYTES = 0xFFFF - 2
+
+
+def get_mock_fps() -> float:
+    """
+    Returns:
+        float: Frames per second of the mock camera, MOCK_FPS defaults to 1, 0 is as fast as possible.
+    """
+    return float(os.environ.get('MOCK_FPS', 1))
+
+
+def get_mock_warm_up() -> float:
+    """
+    Returns:
+        float: Seconds before the first frame of the mock camera, MOCK_WARM_UP defaults to 0,
+            e.g. 2 like the warm up of the Pi camera.
+    """
+    return float(os.environ.get('MOCK_WARM_UP', 0))
+
+
+def is_mock_static() -> bool:
+    """
+    Returns:
+        bool: True if the mock camera films a static scene, i.e. MOCK_STATIC=1 re-yields the first image unchanged.
+    """
+    return os.environ.get('MOCK_STATIC', '0') not in ('0', '')
+
+
+def get_mock_scene_seconds() -> float:
+    """
+    Returns:
+        float: Seconds the mock camera films the same image before the scene changes, MOCK_SCENE_SECONDS
+            defaults to 3, 0 changes the image with every frame.
+    """
+    return float(os.environ.get('MOCK_SCENE_SECONDS', 3))
+
+
+def load_images() -> list:
+    """
+    Returns:
+        list: The mock images read from the data folder.
+    """
+    return [pathlib.Path(get_data_path(), f + '.jpg').read_bytes() for f in ['1', '2', '3']]
+
+
+def get_mock_frame_bytes() -> int:
+    """
+    Returns:
+        int: Size of the mock frames, MOCK_FRAME_BYTES defaults to 0, i.e. the size of the mock images.
+    """
+    return int(os.environ.get('MOCK_FRAME_BYTES', 0))
+
+
+def make_synthetic_frame(image: bytes, timestamp: float, frame_bytes: int = 0) -> bytes:
+    """
+    Inserts comment segments with the timestamp and padding after the start marker of the JPG image.
+
+    Returns:
+        bytes: A valid JPG of at least frame_bytes bytes that carries the timestamp.
+    """
+    payload = TIMESTAMP_MARKER + '{:.6f};'.format(timestamp).encode()
+    segments = [payload]
+    padding = frame_bytes - len(image) - len(payload) - 4
+    while padding > 0:
+        size = min(MAX_COMMENT_BYTES, max(0, padding - 4))
+        segments.append(b'\0' * size)
+        padding -= size + 4
+
+    comments = b''.join(b'\xff\xfe' + struct.pack('>H', len(segment) + 2) + segment for segment in segments)
+    return image[:2] + comments + image[2:]
+
+
+def overlay_frames(images: list):
+    """
+    Decodes the images once and stamps the timestamp overlay onto a copy of them per frame.
+
+    Returns:
+        Generator that returns the JPG encoded images with the overlay, in turn.
+    """
+    raw_images = [cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR) for image in images]
+    buffers = [np.empty_like(image) for image in raw_images]
+    overlay = TimestampOverlay.for_frame(raw_images[0])
+    index = 0
+    while True:
+        buffer = buffers[index % len(buffers)]
+        np.copyto(buffer, raw_images[index % len(raw_images)])
+        overlay.draw(buffer)
+        with encode_budget:
+            frame = cv2.imencode('.jpg', buffer)[1].tobytes()
+        yield frame
+        index += 1
+
+
+def parse_frame_timestamp(data: bytes):
+    """
+    Returns:
+        float: The timestamp embedded by the mock camera, None if there is none.
+    """
+    match = TIMESTAMP_PATTERN.search(data)
+    return float(match.group(1)) if match else None
 
 
 class Camera(Camera):
     """
     A mock camera that replays images from disk, i.e. mocks the streaming functionality.
 
+    The frames are paced against deadlines on a monotonic clock, so the
+    frame rate does not drift with the time spent per frame. Like a real
+    camera filming a mostly still scene, the same frame is re-yielded until
+    the scene changes, so the detection of unchanged frames is exercised.
+    Every frame carries the capture time of its scene, see
+    make_synthetic_frame.
+
     Attributes:
-        The mock image frames.
+        images: The mock image frames, read by the camera thread on first use.
+        fps: Frames per second, 0 is as fast as possible.
+        warm_up: Seconds before the first frame.
+        static: True if the same image object is yielded every frame, like a static scene.
+        scene_seconds: Seconds until the next image is filmed, 0 changes the image with every frame.
+        frame_bytes: Minimal size of the frames, the images are padded.
+        overlay_enabled: True if the images get a timestamp overlay.
     """
 
-    images = [open(pathlib.Path(get_data_path(), f + '.jpg'), 'rb').read() for f in ['1', '2', '3']]
+    images = None
+    fps = get_mock_fps()
+    warm_up = get_mock_warm_up()
+    static = is_mock_static()
+    scene_seconds = get_mock_scene_seconds()
+    frame_bytes = get_mock_frame_bytes()
+    overlay_enabled = is_overlay_enabled()
 
-    @staticmethod
-    def frames() -> bytes:
+    def frames(self) -> bytes:
         """
 
         Returns:
             str: The bytes representation of the mock images.
 
         """
+        if Camera.images is None:
+            Camera.images = load_images()
+        time.sleep(self.warm_up)
+
+        interval = 1 / self.fps if self.fps > 0 else 0
+        deadline = time.perf_counter()
+        images = overlay_frames(self.images) if self.overlay_enabled and not self.static else None
+        frame = None
+        scene_started = 0
+        index = 0
         while True:
-            time.sleep(1)
-            yield Camera.images[int(time.time()) % 3]
+            if interval:
+                deadline += interval
+                delay = deadline - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # skip the missed frames instead of catching up in a burst
+                    deadline = time.perf_counter()
+
+            now = time.time()
+            if frame is None or not self.static and now - scene_started >= self.scene_seconds:
+                image = next(images) if images else self.images[index % len(self.images)]
+                frame = make_synthetic_frame(image, now, self.frame_bytes)
+                scene_started = now
+                index += 1
+            yield frame
@@ -1,29 +1,269 @@
+import logging
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
-from lib.camera_base import Camera
+from lib import metrics
+from lib.camera_base import Camera, encode_budget
+from lib.overlay import TimestampOverlay, is_overlay_enabled
+
+
+def get_jpeg_quality() -> int:
+    """
+    Returns:
+        int: The JPG quality of the frames, OPENCV_JPEG_QUALITY defaults to 95 like OpenCV.
+    """
+    return int(os.environ.get('OPENCV_JPEG_QUALITY', 95))
+
+
+def get_resolution():
+    """
+    Returns:
+        tuple: The (width, height) of the frames given as OPENCV_RESOLUTION=640x480, None for the camera default.
+    """
+    if not os.environ.get('OPENCV_RESOLUTION'):
+        return None
+    width, height = os.environ['OPENCV_RESOLUTION'].lower().split('x')
+    return int(width), int(height)
+
+
+def get_target_fps() -> float:
+    """
+    Returns:
+        float: The maximal frames per second that are encoded, OPENCV_FPS defaults to 0, i.e. as many as captured.
+    """
+    return float(os.environ.get('OPENCV_FPS', 0))
+
+
+def get_encode_threads() -> int:
+    """
+    Returns:
+        int: The number of encoder threads, OPENCV_ENCODE_THREADS defaults to 2.
+    """
+    return max(1, int(os.environ.get('OPENCV_ENCODE_THREADS', 2)))
+
+
+class LatestFrame(object):
+    """
+    Capture thread that always holds the latest raw frame of the capture.
+
+    The frames are read into reused arrays. An array is only reused when it
+    is neither the latest frame nor still used by an encoder.
+
+    Attributes:
+        capture: The cv2.VideoCapture or any object with read(image) and release()
+        seq: Sequence number of the latest frame
+        failed: True if the capture could not be read
+    """
+
+    def __init__(self, capture):
+        """ constructor """
+        self.capture = capture
+        self.condition = threading.Condition()
+        self.image = None
+        self.seq = 0
+        self.failed = False
+        self.running = True
+        self.free = []
+        self.users = {}
+        self.thread = threading.Thread(target=self._thread, daemon=True)
+        self.thread.start()
+
+    def _thread(self):
+        """Capture background thread."""
+        while self.running:
+            with self.condition:
+                buffer = self.free.pop() if self.free else None
+
+            started = time.perf_counter()
+            ok, image = self.capture.read(buffer)
+            if not ok:
+                logging.error('Could not read from the OpenCV camera')
+                with self.condition:
+                    self.failed = True
+                    self.condition.notify_all()
+                return
+            if metrics.enabled:
+                metrics.stage_seconds.observe(time.perf_counter() - started, ('capture',))
+
+            with self.condition:
+                previous = self.image
+                self.image = image
+                self.seq += 1
+                if previous is not None and previous is not image and id(previous) not in self.users:
+                    self.free.append(previous)
+                self.condition.notify_all()
+
+    def acquire(self, after_seq: int):
+        """
+        Waits for a frame newer than the sequence number and marks it as used.
+
+        Returns:
+            tuple: The sequence number and the image, None if the capture failed.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > after_seq or self.failed)
+            if self.failed:
+                return None
+            self.users[id(self.image)] = self.users.get(id(self.image), 0) + 1
+            return self.seq, self.image
+
+    def release(self, image):
+        """Marks the image as no longer used by the encoder, so it can be reused."""
+        with self.condition:
+            count = self.users.pop(id(image)) - 1
+            if count:
+                self.users[id(image)] = count
+            elif image is not self.image:
+                self.free.append(image)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.capture.release()
+
+
+class FrameEncoder(object):
+    """
+    Encodes the raw frames to JPG, resized to the resolution and with the timestamp overlay if enabled.
+
+    Every encoder thread reuses its own resize buffer. The encoders of all
+    cameras share the encode budget.
+
+    Attributes:
+        jpeg_quality: The JPG quality
+        resolution: The (width, height) of the frames, None to keep the captured size
+        overlay_enabled: True if the timestamp overlay is stamped onto the frames
+    """
+
+    def __init__(self, jpeg_quality: int = 95, resolution: tuple = None, overlay_enabled: bool = False):
+        """ constructor """
+        self.jpeg_quality = jpeg_quality
+        self.resolution = resolution
+        self.overlay_enabled = overlay_enabled
+        self.overlay = None
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self.buffers = threading.local()
+
+    def encode(self, image) -> bytes:
+        """
+        Returns:
+            bytes: The JPG encoded image.
+        """
+        with encode_budget:
+            started = time.perf_counter()
+            if self.resolution is not None and (image.shape[1], image.shape[0]) != self.resolution:
+                buffer = getattr(self.buffers, 'resized', None)
+                image = cv2.resize(image, self.resolution, dst=buffer, interpolation=cv2.INTER_AREA)
+                self.buffers.resized = image
+            if self.overlay_enabled:
+                if self.overlay is None:
+                    self.overlay = TimestampOverlay.for_frame(image)
+                self.overlay.draw(image)
+            frame = cv2.imencode('.jpg', image, self.params)[1].tobytes()
+        if metrics.enabled:
+            metrics.stage_seconds.observe(time.perf_counter() - started, ('encode',))
+        return frame
+
+
+def encoded_frames(capture, encoder: FrameEncoder, target_fps: float = 0, threads: int = 2):
+    """
+    Captures and encodes the frames in a pipeline.
+
+    The capture thread always holds the latest raw frame. Only the frames
+    that are taken at the target frame rate are encoded, up to the given
+    number at the same time on a thread pool, as OpenCV releases the GIL
+    while encoding. The frames are returned in capture order.
+
+    Returns:
+        Generator that returns the JPG encoded frames.
+    """
+    latest = LatestFrame(capture)
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='encoder')
+    pending = deque()
+    interval = 1 / target_fps if target_fps > 0 else 0
+    deadline = time.perf_counter()
+    last_seq = 0
+
+    def encode(image):
+        try:
+            return encoder.encode(image)
+        finally:
+            latest.release(image)
+
+    try:
+        while True:
+            if interval:
+                deadline = max(deadline + interval, time.perf_counter())
+                time.sleep(max(0.0, deadline - time.perf_counter()))
+
+            acquired = latest.acquire(last_seq)
+            if acquired is None:
+                raise RuntimeError('Could not read from camera')
+            last_seq, image = acquired
+            try:
+                pending.append(executor.submit(encode, image))
+            except RuntimeError:
+                # the interpreter is shutting down
+                latest.release(image)
+                return
+
+            # keep the encoders busy, return the frames in order
+            while pending and (len(pending) >= threads or pending[0].done()):
+                yield pending.popleft().result()
+    finally:
+        latest.stop()
+        executor.shutdown(wait=True)
 
 
 class Camera(Camera):
+    """
+    OpenCV camera driver.
+
+    Attributes:
+        video_source: The device index or the file of the video
+        jpeg_quality: The JPG quality of the frames
+        resolution: The (width, height) of the frames, None for the camera default
+        target_fps: The maximal frames per second that are encoded, 0 is unlimited
+        encode_threads: The number of encoder threads
+        overlay_enabled: True if the frames get a timestamp overlay
+    """
+
     video_source = 0
+    jpeg_quality = get_jpeg_quality()
+    resolution = get_resolution()
+    target_fps = get_target_fps()
+    encode_threads = get_encode_threads()
+    overlay_enabled = is_overlay_enabled()
 
-    def __init__(self):
-        if os.environ.get('OPENCV_CAMERA_SOURCE'):
-            Camera.set_video_source(int(os.environ['OPENCV_CAMERA_SOURCE']))
-        super(Camera, self).__init__()
+    def __init__(self, camera_id: str = 'default', recordings_subdirectory: str = '', source: str = None):
+        """
+        constructor
 
-    @staticmethod
-    def set_video_source(source):
-        Camera.video_source = source
+        Args:
+            source: The device index or the file of the video, defaults to OPENCV_CAMERA_SOURCE or device 0.
+        """
+        if source is None:
+            source = os.environ.get('OPENCV_CAMERA_SOURCE')
+        if source is not None:
+            self.set_video_source(int(source) if str(source).isdigit() else source)
+        super(Camera, self).__init__(camera_id, recordings_subdirectory)
 
-    @staticmethod
-    def frames():
-        camera = cv2.VideoCapture(Camera.video_source)
+    def set_video_source(self, source):
+        self.video_source = source
+
+    def frames(self):
+        camera = cv2.VideoCapture(self.video_source)
         if not camera.isOpened():
             raise RuntimeError('Could not start camera')
 
-        while True:
-            # read current frame
-            _, img = camera.read()
+        if self.resolution is not None:
+            # the encoder resizes if the camera does not support the resolution
+            camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+            camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
 
-            # encode as a jpeg image and return it
-            yield cv2.imencode('.jpg', img)[1].tobytes()
+        yield from encoded_frames(camera, FrameEncoder(self.jpeg_quality, self.resolution, self.overlay_enabled),
+                                  self.target_fps, self.encode_threads)
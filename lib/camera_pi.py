@@ -1,93 +1,395 @@
 import io
 import logging
+import os
 import threading
 import time
 
+from lib import metrics
 from lib.camera_base import Camera
+from lib.chunk_writer import ChunkWriter
+from lib.hls import H264Segmenter, SegmentRing, is_hls_enabled, get_hls_resolution, get_hls_bitrate, \
+    get_hls_segment_seconds, get_hls_segments
+from lib.mjpeg import MJPEGFrameSplitter
 import atexit
 import picamera
-from lib.recordings_folder import RecordingsFolder
-from lib.utils import get_env_recordings_path, get_datetime_now_log_string
+from lib.pre_event_buffer import PreEventBuffer, PreEventOutput, get_pre_event_seconds, \
+    get_pre_event_max_bytes
+from lib.utils import get_datetime_now_log_string
+
+
+def get_stream_mode() -> str:
+    """
+    Returns:
+        str: PI_STREAM_MODE, recording (default) for an MJPEG recording on a splitter port
+            or capture for continuous still captures from the video port.
+    """
+    return os.environ.get('PI_STREAM_MODE', 'recording')
+
+
+def get_jpeg_quality() -> int:
+    """
+    Returns:
+        int: The JPG quality of the MJPEG stream, PI_JPEG_QUALITY defaults to 85.
+    """
+    return int(os.environ.get('PI_JPEG_QUALITY', 85))
+
+
+class StreamOutput(object):
+    """
+    Custom picamera output of the MJPEG recording that holds the latest frame.
+
+    The encoder writes into the output from its own thread. The frames are
+    split by their JPG markers and handed to the camera thread by reference.
+    Frames that the camera thread did not take in time are replaced by newer
+    ones.
+
+    Attributes:
+        splitter: Splits the written bytes into frames
+    """
+
+    def __init__(self):
+        """ constructor """
+        self.condition = threading.Condition()
+        self.frame = None
+        self.splitter = MJPEGFrameSplitter(self.on_frame)
+
+    def write(self, data: bytes) -> int:
+        return self.splitter.write(data)
+
+    def flush(self):
+        self.splitter.flush()
+
+    def on_frame(self, frame: bytes):
+        with self.condition:
+            self.frame = frame
+            self.condition.notify_all()
+
+    def wait_for_frame(self, timeout: float):
+        """
+        Returns:
+            bytes: The latest frame that was not taken yet, None if none arrived in time.
+        """
+        with self.condition:
+            if self.frame is None:
+                self.condition.wait(timeout)
+            frame, self.frame = self.frame, None
+            return frame
 
 
 class Camera(Camera):
     """
     Raspberry Pi camera driver.
+
+    There is only one sensor, so its state is shared by the class, while the
+    recordings folder belongs to the camera instance.
+
+    With HLS=1, a third encoder records a low-resolution, low-bitrate H.264
+    stream on its own splitter port while the camera thread runs. It is
+    split into the live segments served by the HLS routes.
     """
 
     camera = None
+    camera_lock = threading.Lock()
+    warm_up = 2
     recording = False
+    stream_splitter_port = 1
     record_splitter_port = 2
+    stream_mode = get_stream_mode()
+    jpeg_quality = get_jpeg_quality()
+
+    # the low-bandwidth live stream of the HLS routes
+    hls_splitter_port = 3
+    hls_resolution = get_hls_resolution()
+    hls_bitrate = get_hls_bitrate()
+    hls_segment_seconds = get_hls_segment_seconds()
+    live_segments = SegmentRing(get_hls_segments()) if is_hls_enabled() else None
+    live_segmenter = None
 
-    recordings_folder = RecordingsFolder(get_env_recordings_path())
+    # the chunk writer of the last recording
+    chunk_writer = None
+
+    # the pre-event video is buffered as H.264 by the encoder in the circular stream
+    pre_event_seconds = get_pre_event_seconds()
+    circular_stream = None
+
+    def create_pre_event_buffer(self) -> PreEventBuffer:
+        """
+        inherited
+        """
+        return PreEventBuffer(seconds=0)
+
+    @staticmethod
+    def open_camera():
+        """
+        Opens the Pi camera if it isn't open yet. Only a newly opened camera needs to warm up.
+        """
+        with Camera.camera_lock:
+            if Camera.camera and not Camera.camera.closed:
+                return
+
+            Camera.camera = picamera.PiCamera()
+            Camera.camera.resolution = 1200, 900
+            Camera.camera.framerate = 30
+
+            # let camera warm up
+            time.sleep(Camera.warm_up)
+
+            if Camera.pre_event_seconds > 0:
+                Camera.circular_stream = picamera.PiCameraCircularIO(
+                    Camera.camera, size=get_pre_event_max_bytes(), splitter_port=Camera.record_splitter_port)
+                Camera.camera.start_recording(Camera.circular_stream, format='h264',
+                                              splitter_port=Camera.record_splitter_port)
+
+    @staticmethod
+    def close_camera():
+        """
+        Closes the Pi camera to release the sensor.
+        """
+        with Camera.camera_lock:
+            if Camera.camera and not Camera.camera.closed:
+                Camera.camera.close()
+                logging.info("Camera closed")
+            Camera.circular_stream = None
+
+    @staticmethod
+    def update_annotation(last_second: int) -> int:
+        """
+        Updates the timestamp overlay only when the second changed.
+
+        Returns:
+            int: The second of the overlay.
+        """
+        second = int(time.time())
+        if second != last_second:
+            Camera.camera.annotate_text = get_datetime_now_log_string()
+        return second
 
     @staticmethod
     def frames():
         """
         inherited
         """
+        Camera.open_camera()
+        try:
+            Camera.start_live_stream()
+            if Camera.stream_mode == 'capture':
+                yield from Camera.capture_frames()
+            else:
+                yield from Camera.recording_frames()
+        finally:
+            Camera.stop_live_stream()
+            # a running recording keeps the sensor open
+            if not Camera.recording:
+                Camera.close_camera()
 
-        if not Camera.camera or Camera.camera.closed:
-            Camera.camera = picamera.PiCamera()
+    @staticmethod
+    def start_live_stream():
+        """
+        Starts the H.264 encoder of the HLS live stream if it is enabled.
+
+        The encoder repeats the parameter sets at every keyframe and inserts
+        a keyframe every segment duration, so the segments can be split on
+        keyframes.
+        """
+        if Camera.live_segments is None:
+            return
+        framerate = float(Camera.camera.framerate)
+        Camera.live_segmenter = H264Segmenter(Camera.live_segments, framerate, Camera.hls_segment_seconds)
+        Camera.camera.start_recording(Camera.live_segmenter, format='h264', splitter_port=Camera.hls_splitter_port,
+                                      resize=Camera.hls_resolution, bitrate=Camera.hls_bitrate,
+                                      intra_period=max(1, round(framerate * Camera.hls_segment_seconds)),
+                                      inline_headers=True, sps_timing=True)
+
+    @staticmethod
+    def stop_live_stream():
+        """
+        Stops the H.264 encoder of the HLS live stream, the last segment is completed.
+        """
+        if Camera.live_segmenter is None:
+            return
+        try:
+            Camera.camera.stop_recording(splitter_port=Camera.hls_splitter_port)
+        except picamera.PiCameraError as e:
+            logging.info(e)
+        Camera.live_segmenter.flush()
+        Camera.live_segmenter = None
 
-        Camera.camera.resolution = 1200, 900
-        Camera.camera.framerate = 30
+    @staticmethod
+    def recording_frames():
+        """
+        Returns:
+            Generator that returns the frames of an MJPEG recording on the stream splitter port.
+        """
+        output = StreamOutput()
+        Camera.camera.start_recording(output, format='mjpeg', splitter_port=Camera.stream_splitter_port,
+                                      quality=Camera.jpeg_quality, bitrate=0)
+        try:
+            second = 0
+            requested = time.perf_counter()
+            while True:
+                frame = output.wait_for_frame(timeout=5)
+                if frame is None:
+                    raise RuntimeError('No frame from the MJPEG encoder')
+                if metrics.enabled:
+                    metrics.stage_seconds.observe(time.perf_counter() - requested, ('capture',))
 
-        # let camera warm up
-        time.sleep(2)
+                second = Camera.update_annotation(second)
+                yield frame
+                requested = time.perf_counter()
+        finally:
+            try:
+                Camera.camera.stop_recording(splitter_port=Camera.stream_splitter_port)
+            except picamera.PiCameraError as e:
+                logging.info(e)
 
+    @staticmethod
+    def capture_frames():
+        """
+        Returns:
+            Generator that returns continuous still captures from the video port.
+        """
         stream = io.BytesIO()
+        second = 0
+        requested = time.perf_counter()
         for _ in Camera.camera.capture_continuous(stream, 'jpeg', use_video_port=True):
-            Camera.camera.annotate_text = get_datetime_now_log_string()
+            measure = metrics.enabled
+            if measure:
+                # the GPU captures and encodes the frame
+                captured = time.perf_counter()
+                metrics.stage_seconds.observe(captured - requested, ('capture',))
+
+            second = Camera.update_annotation(second)
+
+            if measure:
+                metrics.stage_seconds.observe(time.perf_counter() - captured, ('annotate',))
+
             # return current frame
-            stream.seek(0)
-            yield stream.read()
+            yield stream.getvalue()
 
             # reset stream for next frame
             stream.seek(0)
             stream.truncate()
+            requested = time.perf_counter()
 
-    @staticmethod
-    def record():
-        record_thread = threading.Thread(target=Camera.record_thread)
+    def get_status(self) -> dict:
+        """
+        inherited
+        """
+        status = super(Camera, self).get_status()
+        status['chunk_writer'] = self.chunk_writer.get_status() if self.chunk_writer else None
+        status['storage'] = self.recordings_folder.storage_manager.get_status()
+        return status
+
+    def record(self):
+        if Camera.recording:
+            # the running recording keeps its chunk writer
+            logging.info('Recording is already on')
+            return
+        Camera.recording = True
+        record_thread = threading.Thread(target=self.record_thread)
         record_thread.daemon = True
         record_thread.start()
 
-    @staticmethod
-    def record_thread():
+    def record_thread(self):
+        # the encoder writes into the memory buffer of the chunk writer, a slow drive does not block it
+        chunk_writer = self.chunk_writer = ChunkWriter(self.recordings_folder)
         try:
-            chunk = 60 * 5
-            step = 0.5
+            # the recording works independent of a suspended stream
+            Camera.open_camera()
 
             logging.info("Recording is on")
-            for _ in Camera.camera.record_sequence(
-                    (Camera.recordings_folder.get_next_chunk_path() for _ in range(10000000)),
-                    splitter_port=Camera.record_splitter_port):
-                Camera.recording = True
-                for i in range(int(chunk / step)):
-                    if not Camera.recording:
-                        Camera.stop_recording()
-                        return
-                    Camera.camera.wait_recording(step, splitter_port=Camera.record_splitter_port)
-            Camera.stop_recording()
+            if Camera.circular_stream is not None:
+                self.record_with_pre_event()
+            else:
+                self.record_chunks()
         except picamera.PiCameraAlreadyRecording as e:
-            logging.info(e)
-        except AttributeError as e:
-            logging.info(e)
+            # the splitter port belongs to another recording, stopping it would end that one
+            logging.error('Recording failed: {}'.format(e))
+        except (AttributeError, picamera.PiCameraError) as e:
+            logging.error('Recording failed: {}'.format(e))
+            self.stop_recording()
+        finally:
+            # unless a new recording started in the meantime
+            if self.chunk_writer is chunk_writer:
+                Camera.recording = False
+            chunk_writer.close(timeout=60)
 
     @staticmethod
-    def stop_recording():
+    def wait_chunk() -> bool:
+        """
+        Records until the chunk is full.
+
+        Returns:
+            bool: False if the recording was stopped in the meantime.
+        """
+        chunk = 60 * 5
+        step = 0.5
+        for i in range(int(chunk / step)):
+            if not Camera.recording:
+                return False
+            Camera.camera.wait_recording(step, splitter_port=Camera.record_splitter_port)
+        return True
+
+    def record_chunks(self):
+        """
+        Records chunks from the encoder into the chunk writer.
+        """
+        previous = None
+        for output in Camera.camera.record_sequence(
+                (self.chunk_writer.open_chunk() for _ in range(10000000)),
+                splitter_port=Camera.record_splitter_port):
+            # the encoder moved on to the new chunk
+            if previous is not None:
+                previous.close()
+            previous = output
+            if not Camera.wait_chunk():
+                break
+        self.stop_recording()
+        if previous is not None:
+            previous.close()
+
+    def record_with_pre_event(self):
+        """
+        Switches the running encoder from the circular stream to chunks.
+        The first chunk starts with the buffered pre-event video.
+        """
+        output = PreEventOutput(self.chunk_writer.open_chunk())
         try:
-            Camera.camera.stop_recording(splitter_port=Camera.record_splitter_port)
-        except picamera.PiCameraNotRecording as e:
-            logging.info(e)
-        except AttributeError as e:
-            logging.info(e)
+            Camera.camera.split_recording(output, splitter_port=Camera.record_splitter_port)
+            output.flush_pre_event(
+                lambda first_chunk: Camera.circular_stream.copy_to(first_chunk, seconds=Camera.pre_event_seconds))
+            Camera.circular_stream.clear()
+
+            while Camera.wait_chunk():
+                next_output = self.chunk_writer.open_chunk()
+                Camera.camera.split_recording(next_output, splitter_port=Camera.record_splitter_port)
+                output.close()
+                output = next_output
+        finally:
+            try:
+                # continue buffering the pre-event video
+                if Camera.circular_stream is not None:
+                    Camera.camera.split_recording(Camera.circular_stream, splitter_port=Camera.record_splitter_port)
+            finally:
+                output.close()
+
+    def stop_recording(self):
+        if Camera.circular_stream is None:
+            try:
+                Camera.camera.stop_recording(splitter_port=Camera.record_splitter_port)
+            except picamera.PiCameraNotRecording as e:
+                logging.info(e)
+            except AttributeError as e:
+                logging.info(e)
         Camera.recording = False
-        Camera.recordings_folder.needs_new_recording = True
+        self.recordings_folder.close_chunk()
+        self.recordings_folder.needs_new_recording = True
 
         logging.info("Recording is off")
 
-    @staticmethod
-    def is_recording():
+        if self.thread is None:
+            # the stream is suspended as well
+            Camera.close_camera()
+
+    def is_recording(self):
         return Camera.recording
@@ -0,0 +1,186 @@
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+from lib.camera_base import get_camera_class
+from lib.utils import get_env_recordings_path, split_path_list
+
+DEFAULT_CAMERA_ID = 'default'
+CAMERA_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class CameraUnavailable(Exception):
+    """Raised if a camera could not be created, e.g. because its driver is missing."""
+
+
+CameraConfig = namedtuple('CameraConfig', ['camera_id', 'driver', 'source', 'recordings_subdirectory'])
+
+
+def parse_camera_configs(cameras: str) -> list:
+    """
+    Parses the cameras given as comma separated id:driver[:source], e.g. garden:pi,stable:opencv:1.
+
+    Returns:
+        list: The CameraConfig of every camera, their recordings are kept in a subdirectory named by the id.
+
+    Raises:
+        ValueError: If a camera id is invalid or used twice.
+    """
+    configs = []
+    for entry in cameras.split(','):
+        if not entry.strip():
+            continue
+        parts = entry.strip().split(':', 2)
+        camera_id = parts[0]
+        if not CAMERA_ID_PATTERN.match(camera_id):
+            raise ValueError('Invalid camera id: ' + camera_id)
+        if any(config.camera_id == camera_id for config in configs):
+            raise ValueError('Camera id used twice: ' + camera_id)
+        driver = parts[1] if len(parts) > 1 else ''
+        source = parts[2] if len(parts) > 2 else None
+        configs.append(CameraConfig(camera_id, driver, source, camera_id))
+    return configs
+
+
+def get_camera_configs() -> list:
+    """
+    Returns:
+        list: The cameras given as CAMERAS, by default the single camera selected by CAMERA
+            that keeps its recordings directly in the recordings paths.
+    """
+    if os.environ.get('CAMERAS'):
+        return parse_camera_configs(os.environ['CAMERAS'])
+    return [CameraConfig(DEFAULT_CAMERA_ID, None, None, '')]
+
+
+class CameraRegistry(object):
+    """
+    The cameras of the process by their id.
+
+    A camera is created with its driver on first use or by the startup
+    thread, its camera thread is suspended and restarted on its own like for
+    a single camera.
+
+    Attributes:
+        configs: The CameraConfig of the cameras by their id
+        default_id: The id of the camera that is served by the routes without camera id
+        errors: The error of the last failed creation of a camera by its id
+    """
+
+    def __init__(self, configs: list = None):
+        """ constructor """
+        configs = get_camera_configs() if configs is None else configs
+        self.configs = OrderedDict((config.camera_id, config) for config in configs)
+        self.default_id = next(iter(self.configs), None)
+        self.cameras = {}
+        self.errors = {}
+        # a driver might take long to import, the other cameras stay available meanwhile
+        self.locks = {camera_id: threading.Lock() for camera_id in self.configs}
+
+    def __contains__(self, camera_id: str) -> bool:
+        return camera_id in self.configs
+
+    def get_ids(self) -> list:
+        """
+        Returns:
+            list: The ids of all configured cameras.
+        """
+        return list(self.configs)
+
+    def get_cameras(self) -> list:
+        """
+        Returns:
+            list: The cameras that were created so far.
+        """
+        return list(self.cameras.values())
+
+    def get(self, camera_id: str = None):
+        """
+        Returns:
+            Camera: The camera of the id, the default camera if no id is given, None if the id is unknown.
+
+        Raises:
+            CameraUnavailable: If the camera could not be created.
+        """
+        camera_id = camera_id or self.default_id
+        config = self.configs.get(camera_id)
+        if config is None:
+            return None
+
+        with self.locks[camera_id]:
+            camera = self.cameras.get(camera_id)
+            if camera is None:
+                logging.info('Creating camera {}'.format(camera_id))
+                kwargs = {'source': config.source} if config.source is not None else {}
+                try:
+                    camera = get_camera_class(config.driver)(camera_id, config.recordings_subdirectory, **kwargs)
+                except Exception as e:
+                    logging.error('Could not create camera {}: {}'.format(camera_id, e))
+                    self.errors[camera_id] = str(e)
+                    raise CameraUnavailable('Camera {} is not available: {}'.format(camera_id, e)) from e
+                self.cameras[camera_id] = camera
+                self.errors.pop(camera_id, None)
+            return camera
+
+    def start_background(self):
+        """Creates all cameras in a background thread, so the server does not wait for them."""
+        threading.Thread(target=self.create_all, name='camera-startup', daemon=True).start()
+
+    def create_all(self):
+        """Creates all cameras, a camera that fails, e.g. because its driver is missing, does not stop the others."""
+        for camera_id in self.configs:
+            try:
+                self.get(camera_id)
+            except CameraUnavailable:
+                pass
+
+    def is_ready(self) -> bool:
+        """
+        Returns:
+            bool: True if all cameras were created and delivered a frame.
+        """
+        return all(camera_id in self.cameras and self.cameras[camera_id].is_ready() for camera_id in self.configs)
+
+    def get_recordings_paths(self, camera_id: str = None):
+        """
+        Returns:
+            list: The recordings paths of the camera without creating it, None if the id is unknown.
+        """
+        config = self.configs.get(camera_id or self.default_id)
+        if config is None:
+            return None
+        base_paths = split_path_list(get_env_recordings_path())
+        if not config.recordings_subdirectory:
+            return base_paths
+        return [os.path.join(base_path, config.recordings_subdirectory) for base_path in base_paths]
+
+    def get_status(self) -> dict:
+        """
+        Returns:
+            dict: The driver and the startup state of all configured cameras.
+        """
+        return {camera_id: {
+            'driver': config.driver or os.environ.get('CAMERA', 'base'),
+            'created': camera_id in self.cameras,
+            'ready': camera_id in self.cameras and self.cameras[camera_id].is_ready(),
+            'error': self.errors.get(camera_id),
+            'default': camera_id == self.default_id,
+        } for camera_id, config in self.configs.items()}
+
+
+registry = None
+registry_lock = threading.Lock()
+
+
+def get_registry() -> CameraRegistry:
+    """
+    Returns:
+        CameraRegistry: The shared registry of the cameras configured in the environment.
+    """
+    global registry
+    with registry_lock:
+        if registry is None:
+            registry = CameraRegistry()
+        return registry
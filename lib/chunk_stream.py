@@ -0,0 +1,161 @@
+import io
+import os
+
+from lib.recordings_index import CHUNK_EXTENSIONS
+
+MIMETYPES = {
+    '.h264': 'video/h264',
+    '.mjpeg': 'video/x-motion-jpeg',
+    '.avi': 'video/x-msvideo',
+}
+
+# Chunks of these formats can be appended to each other and still be played.
+CONCATENABLE_EXTENSIONS = ('.h264', '.mjpeg')
+
+
+def find_chunk(base_paths: list, session: str, name: str):
+    """
+    Locates a chunk in the recording folders of the base paths.
+
+    Returns:
+        str: The path of the chunk, None if there is no such chunk or the name points outside of the recordings.
+    """
+    if os.path.splitext(name)[1] not in CHUNK_EXTENSIONS:
+        return None
+    for base_path in base_paths:
+        root = os.path.realpath(base_path)
+        path = os.path.realpath(os.path.join(root, session, name))
+        if os.path.dirname(os.path.dirname(path)) != root:
+            continue
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+class ConcatenatedFile(object):
+    """
+    Read only file object over a sequence of chunks.
+
+    The sizes of the chunks are fixed when the object is created, so a chunk
+    that is still being recorded is only served up to that size. Only the
+    currently read chunk is open at any time.
+
+    Attributes:
+        parts: (path, size) of the chunks
+        length: Sum of the sizes of the chunks
+    """
+
+    def __init__(self, parts: list):
+        """ constructor """
+        self.parts = parts
+        self.length = sum(size for _, size in parts)
+        self.position = 0
+        self.file = None
+        self.file_index = -1
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = min(max(0, offset), self.length)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def locate(self) -> tuple:
+        """
+        Returns:
+            tuple: Index of the chunk that contains the current position and the offset in it.
+        """
+        offset = self.position
+        for index, (_, size) in enumerate(self.parts):
+            if offset < size:
+                return index, offset
+            offset -= size
+        return len(self.parts), 0
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Returns:
+            bytes: At most size bytes from the current position, never crosses a chunk boundary.
+        """
+        if self.position >= self.length:
+            return b''
+        index, offset = self.locate()
+        path, part_size = self.parts[index]
+        if index != self.file_index:
+            self.close()
+            self.file = open(path, 'rb')
+            self.file_index = index
+        self.file.seek(offset)
+
+        remaining = part_size - offset
+        data = self.file.read(remaining if size is None or size < 0 else min(size, remaining))
+        if not data:
+            # the chunk was truncated or removed by the retention in the meantime
+            raise IOError('Chunk ended early: ' + path)
+        self.position += len(data)
+        return data
+
+    def fileno(self):
+        raise io.UnsupportedOperation('Concatenated chunks have no file descriptor')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.file_index = -1
+
+
+class FileRange(object):
+    """
+    Limits a file object to the given number of bytes from its current position.
+
+    The file descriptor of the wrapped file is exposed, so WSGI servers like
+    gunicorn send the range with sendfile and the bytes never pass through
+    Python. The servers limit sendfile to the Content-Length of the response.
+
+    Attributes:
+        file: The wrapped file object
+        remaining: Bytes that are left to read
+    """
+
+    def __init__(self, file, length: int):
+        """ constructor """
+        self.file = file
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining <= 0:
+            return b''
+        data = self.file.read(self.remaining if size is None or size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def open_chunks(paths: list) -> ConcatenatedFile:
+    """
+    Returns:
+        ConcatenatedFile: The chunks with their current sizes, chunks that vanished in the meantime are skipped.
+    """
+    parts = []
+    for path in paths:
+        try:
+            parts.append((path, os.path.getsize(path)))
+        except OSError:
+            continue
+    return ConcatenatedFile(parts)
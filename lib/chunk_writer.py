@@ -0,0 +1,470 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from lib import metrics
+from lib.recordings_folder import RecordingsFolder
+
+
+def get_buffer_bytes() -> int:
+    """
+    Returns:
+        int: Maximal bytes held in memory before they are written, RECORDING_BUFFER_MB defaults to 32 MB.
+    """
+    return int(float(os.environ.get('RECORDING_BUFFER_MB', 32)) * 1024 * 1024)
+
+
+def get_block_bytes() -> int:
+    """
+    Returns:
+        int: Bytes written to the disk at once, RECORDING_BLOCK_KB defaults to 1024 kB.
+    """
+    return max(4096, int(float(os.environ.get('RECORDING_BLOCK_KB', 1024)) * 1024))
+
+
+def get_fsync_policy() -> str:
+    """
+    Returns:
+        str: RECORDING_FSYNC, chunk (default) to sync every chunk when it is closed, block to sync every block,
+            a number of seconds to sync at most that often or none to leave it to the operating system.
+    """
+    policy = os.environ.get('RECORDING_FSYNC', 'chunk')
+    if policy not in ('none', 'chunk', 'block'):
+        try:
+            float(policy)
+        except ValueError:
+            raise ValueError('Unknown fsync policy: ' + policy)
+    return policy
+
+
+def get_stall_seconds() -> float:
+    """
+    Returns:
+        float: Seconds a single write may take before the drive is considered stalled,
+            RECORDING_STALL_SECONDS defaults to 2.
+    """
+    return float(os.environ.get('RECORDING_STALL_SECONDS', 2))
+
+
+def open_chunk_file(path: str):
+    """
+    Returns:
+        The unbuffered file of the chunk, the writer does the buffering.
+    """
+    return open(path, 'wb', buffering=0)
+
+
+class ChunkOutput(object):
+    """
+    File-like encoder output of a single chunk, the bytes are written behind by the chunk writer.
+
+    Attributes:
+        writer: The chunk writer
+        path: The path of the chunk once the writer opened it, the last one if it failed over
+        closed: True once the chunk was closed by the encoder
+    """
+
+    def __init__(self, writer):
+        """ constructor """
+        self.writer = writer
+        self.path = ''
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        return self.writer.write(self, data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close_chunk(self)
+
+
+class PendingChunk(object):
+    """
+    The buffered bytes of a chunk that are not written yet.
+
+    Attributes:
+        output: The output of the chunk
+        data: The buffered bytes
+        closed: True if no more bytes follow
+        since: Time the oldest of the buffered bytes arrived
+    """
+
+    __slots__ = ('output', 'data', 'closed', 'since')
+
+    def __init__(self, output: ChunkOutput):
+        """ constructor """
+        self.output = output
+        self.data = bytearray()
+        self.closed = False
+        self.since = 0
+
+
+class ChunkWriter(object):
+    """
+    Write-behind recording output that decouples the encoder from the drives.
+
+    The encoder writes into the chunk outputs, which only append to a
+    bounded memory buffer and never wait for the disk. A writer thread
+    writes the buffer in blocks of the block size, so every write but the
+    last of a chunk is a full, aligned block. Bytes that wait for longer
+    than the maximal delay are written anyway. The block being written
+    stays in the buffer until the write returned.
+
+    Every write is reported to the storage manager, which keeps the
+    throughput and latency per drive. If a write takes longer than the stall
+    timeout, the buffer fills beyond the high watermark or the drive fails,
+    the drive is reported as stalled and the writer fails over: a new writer
+    thread continues the chunk in a new recording on the next recordings
+    base path with the buffered bytes, while the old thread is abandoned
+    with its pending write. The block of that write is written again, so
+    nothing that was buffered gets lost. Only if the buffer is full anyway,
+    the newest bytes are dropped and counted.
+
+    The continuation starts in the middle of a GOP of the encoder, so it
+    cannot be decoded on its own. It is linked to the previous part in the
+    recordings index and plays after it, its first block may repeat the
+    last block of the previous part if the abandoned write returned.
+
+    Attributes:
+        recordings_folder: Provides the paths of the chunks
+        extension: The file extension of the chunks
+        block_bytes: Bytes written at once
+        buffer_bytes: Maximal bytes held in memory
+        fsync_policy: none, chunk, block or the minimal seconds between two syncs
+        stall_seconds: Seconds a write may take before the drive is considered stalled
+        max_delay: Seconds after which buffered bytes are written even if the block is not full
+        opener: Opens the file of a chunk path, e.g. a throttled fake file
+        buffered: Bytes in the buffer
+        written_bytes: Bytes written to the drives
+        dropped_bytes: Bytes dropped because the buffer was full
+        dropped_writes: Number of encoder writes dropped because the buffer was full
+        failovers: Number of times the writer moved to another drive
+    """
+
+    def __init__(self, recordings_folder: RecordingsFolder, extension: str = '.h264', block_bytes: int = None,
+                 buffer_bytes: int = None, fsync_policy: str = None, stall_seconds: float = None,
+                 max_delay: float = 5, opener=open_chunk_file):
+        """ constructor """
+        self.recordings_folder = recordings_folder
+        self.extension = extension
+        self.block_bytes = block_bytes or get_block_bytes()
+        self.buffer_bytes = max(buffer_bytes or get_buffer_bytes(), 2 * self.block_bytes)
+        self.fsync_policy = fsync_policy or get_fsync_policy()
+        self.stall_seconds = stall_seconds if stall_seconds is not None else get_stall_seconds()
+        self.max_delay = max_delay
+        self.opener = opener
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.buffered = 0
+        self.written_bytes = 0
+        self.dropped_bytes = 0
+        self.dropped_writes = 0
+        self.failovers = 0
+        self.failed_over_at = 0
+        self.write_started_at = 0
+        self.stopping = False
+        self.generation = 0
+        self.thread = None
+        self.path = ''
+        self.start_thread()
+
+    def start_thread(self):
+        """Starts a new writer thread, a previous one is abandoned."""
+        self.generation += 1
+        self.write_started_at = 0
+        self.thread = threading.Thread(target=self._thread, args=(self.generation,), name='chunk-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def open_chunk(self) -> ChunkOutput:
+        """
+        Returns:
+            ChunkOutput: The output of the next chunk, its file is opened once the first bytes are written.
+        """
+        return ChunkOutput(self)
+
+    def write(self, output: ChunkOutput, data: bytes) -> int:
+        """
+        Invoked by the encoder, appends the bytes to the buffer.
+
+        Returns:
+            int: The number of bytes written, i.e. all, also if they were dropped.
+        """
+        length = len(data)
+        with self.condition:
+            self.check_stall()
+            if self.buffered + length > self.buffer_bytes:
+                self.dropped_bytes += length
+                self.dropped_writes += 1
+                if self.dropped_writes == 1 or self.dropped_writes % 100 == 0:
+                    logging.warning('Recording buffer is full, dropped {} bytes'.format(self.dropped_bytes))
+                return length
+
+            if not self.pending or self.pending[-1].output is not output or self.pending[-1].closed:
+                self.pending.append(PendingChunk(output))
+            chunk = self.pending[-1]
+            # the writer waits for a full block or for the maximal delay of the first bytes
+            notify = not chunk.data or len(chunk.data) + length >= self.block_bytes
+            if not chunk.data:
+                chunk.since = time.time()
+            chunk.data += data
+            self.buffered += length
+            if notify:
+                self.condition.notify_all()
+        return length
+
+    def close_chunk(self, output: ChunkOutput):
+        """Invoked when the encoder moved on from the chunk, its last bytes are written and the file closed."""
+        with self.condition:
+            for chunk in self.pending:
+                if chunk.output is output:
+                    chunk.closed = True
+            self.condition.notify_all()
+
+    def check_stall(self):
+        """Fails over to the next drive if the current one stalled or fell behind, invoked with the lock held."""
+        now = time.time()
+        stalled = self.write_started_at and now - self.write_started_at > self.stall_seconds
+        behind = self.buffered > 3 * self.buffer_bytes // 4
+        # the new drive gets a stall timeout to catch up
+        if not (stalled or behind) or not self.path or now - self.failed_over_at < self.stall_seconds:
+            return
+        logging.warning('Recording drive of {} {}, failing over'.format(
+            self.path, 'stalled' if stalled else 'fell behind'))
+        self.recordings_folder.storage_manager.report_stall(self.path)
+        if self.is_failover_possible():
+            self.fail_over()
+        else:
+            # stay on the drive, the next check is after a stall timeout
+            self.failed_over_at = now
+
+    def is_failover_possible(self) -> bool:
+        """
+        Returns:
+            bool: True if another drive is ranked before the current one.
+        """
+        target = self.recordings_folder.storage_manager.select_target()
+        return target is not None and self.recordings_folder.storage_manager.get_target(self.path) is not \
+            self.recordings_folder.storage_manager.get_target(target)
+
+    def fail_over(self):
+        """Abandons the writer thread, a new one continues the chunk in a new recording, invoked with the lock held."""
+        self.failovers += 1
+        self.failed_over_at = time.time()
+        self.path = ''
+        self.recordings_folder.needs_new_recording = True
+        self.start_thread()
+        self.condition.notify_all()
+
+    def close(self, timeout: float = None) -> bool:
+        """
+        Closes all chunks and waits until the buffer is written.
+
+        Returns:
+            bool: False if the buffer could not be written in time.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            for chunk in self.pending:
+                chunk.closed = True
+            self.stopping = True
+            self.condition.notify_all()
+            while self.pending:
+                remaining = deadline - time.time() if deadline is not None else self.stall_seconds
+                if remaining <= 0:
+                    logging.warning('Recording buffer of {} bytes could not be written'.format(self.buffered))
+                    return False
+                # the encoder does not write anymore, so the drive is checked here
+                self.condition.wait(min(remaining, self.stall_seconds))
+                self.check_stall()
+        return True
+
+    def take_block(self, generation: int):
+        """
+        Waits for the next bytes to write, invoked with the lock held.
+
+        Returns:
+            tuple: The pending chunk and the bytes to write, None if the thread was abandoned or is done.
+        """
+        while True:
+            if generation != self.generation:
+                return None
+            if self.pending:
+                chunk = self.pending[0]
+                if len(chunk.data) >= self.block_bytes:
+                    return chunk, bytes(chunk.data[:self.block_bytes])
+                # the rest of a closed chunk, or bytes that waited too long or would hold up the next chunk
+                if chunk.closed or chunk.data and (self.stopping or len(self.pending) > 1 or
+                                                   time.time() - chunk.since >= self.max_delay):
+                    return chunk, bytes(chunk.data)
+            elif self.stopping:
+                return None
+            self.condition.wait(self.max_delay if self.pending else None)
+
+    def _thread(self, generation: int):
+        """Writer background thread."""
+        file = None
+        output = None
+        last_sync = time.time()
+        try:
+            while True:
+                with self.condition:
+                    taken = self.take_block(generation)
+                if taken is None:
+                    return
+                chunk, block = taken
+
+                if not block and chunk.output is not output:
+                    # a chunk without any bytes gets no file
+                    with self.condition:
+                        if generation != self.generation:
+                            return
+                        self.pending.popleft()
+                        self.condition.notify_all()
+                    continue
+                if chunk.output is not output or file is None:
+                    file = self.close_file(file)
+                    output = chunk.output
+                    file = self.open_file(output, generation)
+                    if file is None:
+                        return
+
+                if block:
+                    try:
+                        written = self.write_block(file, block, generation)
+                    except OSError as e:
+                        logging.error('Could not write the recording to {}: {}'.format(output.path, e))
+                        self.recordings_folder.storage_manager.report_write_error(output.path)
+                        self.recordings_folder.storage_manager.report_stall(output.path)
+                        with self.condition:
+                            if generation == self.generation:
+                                self.fail_over()
+                        return
+                    if written is None:
+                        # abandoned during the write, the new thread writes the block again
+                        return
+                    if self.fsync_policy == 'block' or self.fsync_policy not in ('none', 'chunk') and \
+                            time.time() - last_sync >= float(self.fsync_policy):
+                        sync(file)
+                        last_sync = time.time()
+
+                with self.condition:
+                    if generation != self.generation:
+                        return
+                    del chunk.data[:len(block)]
+                    self.buffered -= len(block)
+                    if chunk.data:
+                        chunk.since = time.time()
+                    done = chunk.closed and not chunk.data
+                    if done:
+                        self.pending.popleft()
+                        self.condition.notify_all()
+                if done:
+                    if self.fsync_policy == 'chunk':
+                        sync(file)
+                    file = self.close_file(file)
+                    self.recordings_folder.close_chunk()
+                    output = None
+        finally:
+            self.close_file(file)
+
+    def open_file(self, output: ChunkOutput, generation: int):
+        """
+        Opens the next chunk, on the next drive if the current one fails.
+
+        Returns:
+            The file of the chunk, None if the thread was abandoned.
+        """
+        # set if the chunk is continued after a failover
+        continues = output.path
+        while True:
+            path = self.recordings_folder.get_next_chunk_path(self.extension, continues)
+            try:
+                file = self.opener(path)
+            except OSError as e:
+                logging.error('Could not open the recording chunk {}: {}'.format(path, e))
+                self.recordings_folder.storage_manager.report_write_error(path)
+                self.recordings_folder.storage_manager.report_stall(path)
+                self.recordings_folder.needs_new_recording = True
+                with self.condition:
+                    self.condition.wait(1)
+                    if generation != self.generation:
+                        return None
+                continue
+            with self.condition:
+                if generation != self.generation:
+                    file.close()
+                    return None
+                self.path = output.path = path
+            logging.info('Recording to ' + path)
+            return file
+
+    def write_block(self, file, block: bytes, generation: int):
+        """
+        Writes the whole block, also if the file only takes a part at a time.
+
+        Returns:
+            int: The number of bytes written, None if the thread was abandoned in the meantime.
+        """
+        with self.condition:
+            self.write_started_at = time.time()
+            path = self.path
+        started = time.perf_counter()
+        view = memoryview(block)
+        while view:
+            written = file.write(view)
+            view = view[written if written is not None else len(view):]
+        duration = time.perf_counter() - started
+        # a stalled write counts for the drive, also if the thread was abandoned
+        self.recordings_folder.storage_manager.report_write(path, len(block), duration)
+        with self.condition:
+            if generation != self.generation:
+                return None
+            self.write_started_at = 0
+            self.written_bytes += len(block)
+        if metrics.enabled:
+            metrics.recording_write_seconds.observe(duration)
+            metrics.recording_bytes_total.inc(len(block))
+        return len(block)
+
+    @staticmethod
+    def close_file(file):
+        if file is not None:
+            try:
+                file.close()
+            except OSError as e:
+                logging.info(e)
+        return None
+
+    def get_status(self) -> dict:
+        """
+        Returns:
+            dict: The state of the buffer and the drive that is written.
+        """
+        with self.condition:
+            return {
+                'path': self.path,
+                'buffered': self.buffered,
+                'buffer_bytes': self.buffer_bytes,
+                'block_bytes': self.block_bytes,
+                'fsync': self.fsync_policy,
+                'writing_since': self.write_started_at or None,
+                'written_bytes': self.written_bytes,
+                'dropped_bytes': self.dropped_bytes,
+                'dropped_writes': self.dropped_writes,
+                'failovers': self.failovers,
+            }
+
+
+def sync(file):
+    """Flushes the file to the drive, files without descriptor, e.g. fake files, are skipped."""
+    try:
+        os.fsync(file.fileno())
+    except (AttributeError, OSError, ValueError) as e:
+        logging.debug(e)
@@ -0,0 +1,191 @@
+import threading
+import time
+import zlib
+
+try:
+    from greenlet import getcurrent as get_ident
+except ImportError:
+    try:
+        from thread import get_ident
+    except ImportError:
+        from _thread import get_ident
+
+
+class Frame(object):
+    """
+    A published camera frame.
+
+    Attributes:
+        seq: Monotonic sequence number of the frame, starting at 1
+        timestamp: Time the frame was published
+        data: The encoded image bytes
+        part: The multipart part of the image that is sent to the stream clients
+        digest: CRC32 of the image bytes
+        content_seq: Sequence number of the first frame with the same image,
+            equal to seq if the image changed
+    """
+
+    __slots__ = ('seq', 'timestamp', 'data', 'part', 'digest', 'content_seq')
+
+    def __init__(self, seq: int, timestamp: float, data: bytes, part: bytes = None, digest: int = None,
+                 content_seq: int = None):
+        """ constructor """
+        self.seq = seq
+        self.timestamp = timestamp
+        self.data = data
+        self.part = part
+        self.digest = digest
+        self.content_seq = content_seq if content_seq is not None else seq
+
+    def is_duplicate_of(self, data: bytes, digest: int) -> bool:
+        """
+        Returns:
+            bool: True if the image is the same object or has the same size and digest as the image of this frame.
+        """
+        return data is self.data or (digest == self.digest and len(data) == len(self.data))
+
+
+class FrameBroadcaster(object):
+    """
+    Hands the newest frame of the camera thread to any number of clients.
+
+    Every published frame gets a sequence number. Clients wait for the first
+    frame newer than the last one they have seen, so they never miss the
+    latest frame or read the same frame twice. All waiters are woken with a
+    single notify.
+
+    Frames whose image did not change, e.g. a re-yielded static image, keep
+    the content sequence number of the first frame with that image. The
+    change is detected once per frame by identity or by a CRC32 of the
+    image, so clients can skip unchanged frames.
+
+    Attributes:
+        frame: The latest published frame
+        clients: Client identity -> [last delivered sequence number, last access time]
+        client_timeout: Seconds after which a client without access is considered gone
+        listeners: Callbacks that are invoked with every published frame
+        epoch: Creation time of the broadcaster, distinguishes sequence numbers of different processes
+    """
+
+    def __init__(self, client_timeout: float = 5):
+        """ constructor """
+        self.condition = threading.Condition()
+        self.frame = None
+        self.clients = {}
+        self.client_timeout = client_timeout
+        self.last_eviction = 0
+        self.listeners = []
+        self.epoch = int(time.time())
+
+    def add_listener(self, callback):
+        """
+        Registers a callback that is invoked by the camera thread with every published frame.
+        The callback must not block.
+        """
+        self.listeners = self.listeners + [callback]
+
+    def remove_listener(self, callback):
+        """Unregisters a callback added by add_listener."""
+        self.listeners = [listener for listener in self.listeners if listener != callback]
+
+    def get_digest(self, data: bytes) -> int:
+        """
+        Returns:
+            int: The CRC32 of the image, taken from the latest frame if the image is the same object.
+        """
+        previous = self.frame
+        if previous is not None and data is previous.data:
+            return previous.digest
+        return zlib.crc32(data)
+
+    def is_duplicate(self, data: bytes, digest: int) -> bool:
+        """
+        Returns:
+            bool: True if the image is the same as the one of the latest frame, i.e. its part can be reused.
+        """
+        previous = self.frame
+        return previous is not None and previous.is_duplicate_of(data, digest)
+
+    def publish(self, data: bytes, part: bytes = None, digest: int = None) -> Frame:
+        """
+        Invoked by the camera thread when a new frame is available.
+
+        Args:
+            data: The encoded image.
+            part: The encoded image prepared for sending to the clients, not needed for an unchanged image.
+            digest: The digest of the image if it was already taken by get_digest.
+
+        Returns:
+            Frame: The published frame.
+        """
+        now = time.time()
+        previous = self.frame
+        digest = self.get_digest(data) if digest is None else digest
+        with self.condition:
+            seq = self.frame.seq + 1 if self.frame else 1
+            if previous is not None and previous.is_duplicate_of(data, digest):
+                # the clients that resend the unchanged image share the part of the first frame
+                self.frame = Frame(seq, now, previous.data, previous.part, digest, previous.content_seq)
+            else:
+                self.frame = Frame(seq, now, data, part, digest)
+            self.condition.notify_all()
+
+            if now - self.last_eviction > self.client_timeout:
+                self.evict_stale_clients(now)
+            frame = self.frame
+
+        for listener in self.listeners:
+            listener(frame)
+        return frame
+
+    def wait_for_frame(self, after_seq: int = None, timeout: float = None):
+        """
+        Invoked from each client's thread to wait for the next frame.
+
+        Args:
+            after_seq: Return the first frame newer than this sequence number.
+                Defaults to the last frame delivered to the calling client.
+            timeout: Maximal seconds to wait, None waits forever.
+
+        Returns:
+            Frame: The next frame or None if the timeout expired.
+        """
+        ident = get_ident()
+        with self.condition:
+            client = self.clients.get(ident)
+            if after_seq is None:
+                after_seq = client[0] if client else 0
+
+            available = self.condition.wait_for(
+                lambda: self.frame is not None and self.frame.seq > after_seq, timeout)
+            frame = self.frame if available else None
+
+            self.clients[ident] = [frame.seq if frame else after_seq, time.time()]
+            return frame
+
+    def get_latest_frame(self):
+        """
+        Returns:
+            Frame: The latest published frame without waiting, None if there is none yet.
+        """
+        return self.frame
+
+    def remove_client(self, ident=None):
+        """Invoked when a client disconnects."""
+        with self.condition:
+            self.clients.pop(ident if ident is not None else get_ident(), None)
+
+    def evict_stale_clients(self, now: float = None):
+        """Removes all clients that did not ask for a frame within the client timeout."""
+        now = now if now is not None else time.time()
+        with self.condition:
+            self.clients = {ident: client for ident, client in self.clients.items()
+                            if now - client[1] <= self.client_timeout}
+            self.last_eviction = now
+
+    def get_client_count(self) -> int:
+        """
+        Returns:
+            int: The number of clients that asked for a frame within the client timeout.
+        """
+        return len(self.clients)
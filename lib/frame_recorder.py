@@ -0,0 +1,257 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from lib import metrics
+from lib.recordings_folder import RecordingsFolder
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+POLL_INTERVAL = 0.5
+STOP_TIMEOUT = 10
+
+FORMATS = {
+    'mjpeg': '.mjpeg',
+    'avi': '.avi',
+}
+
+
+def get_recording_format() -> str:
+    """
+    Returns:
+        str: mjpeg (default) for raw concatenated JPG frames or avi for MJPG encoded AVI files via OpenCV.
+    """
+    recording_format = os.environ.get('RECORDING_FORMAT', 'mjpeg')
+    if recording_format not in FORMATS:
+        raise ValueError('Unknown recording format: ' + recording_format)
+    if recording_format == 'avi' and cv2 is None:
+        logging.warning('OpenCV is not available, recording raw mjpeg')
+        return 'mjpeg'
+    return recording_format
+
+
+def open_recording_file(path: str):
+    """
+    Returns:
+        The file of a raw mjpeg chunk.
+    """
+    return open(path, 'wb')
+
+
+class FrameRecorder(object):
+    """
+    Records the JPG frames of the camera into chunks.
+
+    The camera thread submits the frames into a bounded queue, a dedicated
+    writer thread writes them into the chunks given by the recordings folder.
+    A new chunk is started every chunk length. If the disk falls behind and
+    the queue is full, frames are dropped and counted. If a chunk cannot be
+    written, e.g. because the drive is full, the frame is written into a new
+    chunk in a new recording on the next recordings base path instead.
+
+    Attributes:
+        recordings_folder: Provides the paths of the chunks
+        chunk_length: Seconds per chunk
+        recording_format: mjpeg or avi
+        fps: Frame rate written into the avi files
+        recording: True while a recording is running
+        dropped: Number of frames dropped because the writer fell behind
+        written_frames: Number of frames written in the current recording
+        written_bytes: Number of bytes written in the current recording
+        failovers: Number of times the recording moved to another drive
+        opener: Opens the file of a raw mjpeg chunk path
+    """
+
+    def __init__(self, recordings_folder: RecordingsFolder, chunk_length: float = 60 * 5, queue_size: int = 90,
+                 recording_format: str = None, fps: float = 30, opener=open_recording_file):
+        """ constructor """
+        self.recordings_folder = recordings_folder
+        self.opener = opener
+        self.chunk_length = chunk_length
+        self.recording_format = recording_format or get_recording_format()
+        self.fps = fps
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.recording = False
+        self.thread = None
+        self.dropped = 0
+        self.written_frames = 0
+        self.written_bytes = 0
+        self.failovers = 0
+        self.chunk = None
+        self.chunk_path = ''
+        self.chunk_started_at = 0
+
+    def start(self, pre_event_frames: list = None):
+        """
+        Starts a recording.
+
+        Args:
+            pre_event_frames: (timestamp, data) tuples that are written at the start of the first chunk.
+        """
+        if self.recording:
+            return
+        if self.thread is not None:
+            # let the previous recording finish writing
+            self.thread.join(timeout=STOP_TIMEOUT)
+            if self.thread.is_alive():
+                logging.warning('Recording writer is still writing the previous recording, not starting')
+                return
+        self.dropped = 0
+        self.written_frames = 0
+        self.written_bytes = 0
+        self.recording = True
+        self.stopped.clear()
+        self.recordings_folder.needs_new_recording = True
+
+        self.thread = threading.Thread(target=self._thread, args=(pre_event_frames or [],), daemon=True)
+        self.thread.start()
+        logging.info("Recording is on")
+
+    def stop(self):
+        """Stops the recording after the queued frames were written."""
+        if not self.recording:
+            return
+        self.recording = False
+        self.stopped.set()
+        logging.info("Recording is off")
+
+    def submit(self, timestamp: float, data: bytes):
+        """Invoked by the camera thread with every frame, never blocks."""
+        if not self.recording:
+            return
+        try:
+            self.queue.put_nowait((timestamp, data))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logging.warning('Recording fell behind, dropped {} frames'.format(self.dropped))
+
+    def open_chunk(self, timestamp: float):
+        """Closes the current chunk and opens the next one."""
+        self.close_chunk()
+        self.chunk_path = self.recordings_folder.get_next_chunk_path(FORMATS[self.recording_format])
+        self.chunk_started_at = timestamp
+        if self.recording_format == 'avi':
+            self.chunk = None
+        else:
+            self.chunk = self.opener(self.chunk_path)
+        logging.info('Recording to ' + self.chunk_path)
+
+    def close_chunk(self):
+        """Closes the current chunk."""
+        if self.chunk is None:
+            return
+        if self.recording_format == 'avi':
+            self.chunk.release()
+        else:
+            self.chunk.close()
+        self.chunk = None
+
+    def fail_over(self, error: OSError):
+        """Abandons the chunk that could not be written, the next one starts on the next recordings base path."""
+        logging.error('Could not write the recording to {}: {}'.format(self.chunk_path, error))
+        storage_manager = self.recordings_folder.storage_manager
+        storage_manager.report_write_error(self.chunk_path)
+        storage_manager.report_stall(self.chunk_path)
+        try:
+            self.close_chunk()
+        except OSError:
+            self.chunk = None
+        self.recordings_folder.close_chunk()
+        self.recordings_folder.needs_new_recording = True
+        self.chunk_path = ''
+        self.failovers += 1
+
+    def write(self, timestamp: float, data: bytes):
+        """
+        Writes a frame, on every recordings base path at most once if the writes fail.
+
+        Raises:
+            OSError: If the frame could not be written on any recordings base path.
+        """
+        attempts = max(1, len(self.recordings_folder.storage_manager.targets))
+        for attempt in range(attempts):
+            try:
+                self.write_chunk(timestamp, data)
+                return
+            except OSError as e:
+                self.fail_over(e)
+                if attempt == attempts - 1:
+                    raise
+
+    def write_chunk(self, timestamp: float, data: bytes):
+        """Writes a frame into the current chunk, starts a new chunk every chunk length."""
+        if not self.chunk_path or timestamp - self.chunk_started_at >= self.chunk_length:
+            self.open_chunk(timestamp)
+
+        if self.recording_format == 'avi':
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                return
+            if self.chunk is None:
+                self.chunk = cv2.VideoWriter(self.chunk_path, cv2.VideoWriter_fourcc(*'MJPG'), self.fps,
+                                             (image.shape[1], image.shape[0]))
+            started = time.perf_counter()
+            self.chunk.write(image)
+        else:
+            started = time.perf_counter()
+            self.chunk.write(data)
+        duration = time.perf_counter() - started
+        self.recordings_folder.storage_manager.report_write(self.chunk_path, len(data), duration)
+        if metrics.enabled:
+            metrics.recording_write_seconds.observe(duration)
+
+        self.written_frames += 1
+        self.written_bytes += len(data)
+        if metrics.enabled:
+            metrics.recording_bytes_total.inc(len(data))
+
+    def _thread(self, pre_event_frames: list):
+        """Writer background thread."""
+        self.chunk_path = ''
+        try:
+            for timestamp, data in pre_event_frames:
+                self.write(timestamp, data)
+
+            while True:
+                try:
+                    item = self.queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if self.stopped.is_set():
+                        break
+                    continue
+                self.write(*item)
+        except Exception as e:
+            logging.error('Recording failed: {}'.format(e))
+            self.recordings_folder.storage_manager.report_write_error(self.chunk_path)
+            self.recording = False
+        finally:
+            self.close_chunk()
+            self.recordings_folder.close_chunk()
+            self.recordings_folder.needs_new_recording = True
+            # discard what could not be written anymore
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+    def get_status(self) -> dict:
+        """
+        Returns:
+            dict: The state of the recording.
+        """
+        return {
+            'recording': self.recording,
+            'format': self.recording_format,
+            'chunk': self.chunk_path,
+            'queued': self.queue.qsize(),
+            'dropped': self.dropped,
+            'written_frames': self.written_frames,
+            'written_bytes': self.written_bytes,
+            'failovers': self.failovers,
+        }
@@ -0,0 +1,385 @@
+import math
+import os
+import threading
+from collections import deque, namedtuple
+
+PLAYLIST_MIMETYPE = 'application/vnd.apple.mpegurl'
+SEGMENT_MIMETYPE = 'video/mp2t'
+
+START_CODE = b'\x00\x00\x01'
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+# access unit delimiter of an access unit with any slice types
+AUD = b'\x09\xf0'
+
+TS_PACKET_SIZE = 188
+TS_PAYLOAD_SIZE = 184
+PAT_PID = 0x0000
+PMT_PID = 0x1000
+VIDEO_PID = 0x0100
+STREAM_TYPE_H264 = 0x1B
+STREAM_ID_VIDEO = 0xE0
+# 90 kHz clock of the timestamps
+CLOCK_RATE = 90000
+# the presentation time of the frames is ahead of the program clock, i.e. the decoder buffers for this long
+PTS_OFFSET = CLOCK_RATE * 7 // 10
+
+
+def is_hls_enabled() -> bool:
+    """
+    Returns:
+        bool: True if the Pi camera encodes a low-bandwidth H.264 live stream served as HLS, i.e. HLS=1.
+    """
+    return os.environ.get('HLS', '0') not in ('0', '')
+
+
+def get_hls_resolution() -> tuple:
+    """
+    Returns:
+        tuple: The (width, height) of the HLS stream given as HLS_RESOLUTION, defaults to 640x480.
+    """
+    width, height = os.environ.get('HLS_RESOLUTION', '640x480').lower().split('x')
+    return int(width), int(height)
+
+
+def get_hls_bitrate() -> int:
+    """
+    Returns:
+        int: The bits per second of the HLS stream, HLS_BITRATE defaults to 500000.
+    """
+    return int(os.environ.get('HLS_BITRATE', 500000))
+
+
+def get_hls_segment_seconds() -> float:
+    """
+    Returns:
+        float: The target duration of the segments, HLS_SEGMENT_SECONDS defaults to 2.
+    """
+    return float(os.environ.get('HLS_SEGMENT_SECONDS', 2))
+
+
+def get_hls_segments() -> int:
+    """
+    Returns:
+        int: The number of segments kept in memory and listed in the playlist, HLS_SEGMENTS defaults to 6.
+    """
+    return max(3, int(os.environ.get('HLS_SEGMENTS', 6)))
+
+
+def crc32_mpeg2(data: bytes) -> int:
+    """
+    Returns:
+        int: The CRC of the MPEG-2 program specific information, i.e. not reflected and without final xor.
+    """
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x04C11DB7 if crc & 0x80000000 else crc << 1
+        crc &= 0xFFFFFFFF
+    return crc
+
+
+def encode_pcr(pcr: int) -> bytes:
+    """
+    Returns:
+        bytes: The program clock reference of the adaptation field with an extension of 0.
+    """
+    pcr &= (1 << 33) - 1
+    return bytes([pcr >> 25 & 0xFF, pcr >> 17 & 0xFF, pcr >> 9 & 0xFF, pcr >> 1 & 0xFF, (pcr & 1) << 7 | 0x7E, 0])
+
+
+def encode_pts(pts: int) -> bytes:
+    """
+    Returns:
+        bytes: The presentation timestamp of the PES header without decoding timestamp.
+    """
+    pts &= (1 << 33) - 1
+    return bytes([0x20 | (pts >> 30 & 0x07) << 1 | 1, pts >> 22 & 0xFF, (pts >> 15 & 0x7F) << 1 | 1,
+                  pts >> 7 & 0xFF, (pts & 0x7F) << 1 | 1])
+
+
+def ts_packet(pid: int, counter: int, payload: bytes, unit_start: bool = False, adaptation: bytes = None) -> bytes:
+    """
+    Builds a transport stream packet, a payload shorter than the packet is padded in the adaptation field.
+
+    Args:
+        adaptation: The adaptation field after its length byte, None for none.
+
+    Returns:
+        bytes: The packet of TS_PACKET_SIZE bytes.
+    """
+    stuffing = TS_PAYLOAD_SIZE - len(payload) - (1 + len(adaptation) if adaptation is not None else 0)
+    if stuffing > 0:
+        if adaptation is None:
+            adaptation = b'' if stuffing == 1 else b'\x00' + b'\xff' * (stuffing - 2)
+        else:
+            adaptation += b'\xff' * stuffing
+    header = bytes([0x47, (0x40 if unit_start else 0) | pid >> 8, pid & 0xFF,
+                    (0x30 if adaptation is not None else 0x10) | counter])
+    if adaptation is not None:
+        header += bytes([len(adaptation)]) + adaptation
+    return header + payload
+
+
+def psi_section(table_id: int, table_id_extension: int, data: bytes) -> bytes:
+    """
+    Returns:
+        bytes: The payload of a packet with a single program specific information section and its CRC.
+    """
+    length = 5 + len(data) + 4
+    section = bytes([table_id, 0xB0 | length >> 8, length & 0xFF, table_id_extension >> 8,
+                     table_id_extension & 0xFF, 0xC1, 0, 0]) + data
+    section += crc32_mpeg2(section).to_bytes(4, 'big')
+    # pointer field before the section, the rest of the packet is stuffed
+    return (b'\x00' + section).ljust(TS_PAYLOAD_SIZE, b'\xff')
+
+
+class TSMuxer(object):
+    """
+    Minimal MPEG transport stream muxer of a single H.264 stream.
+
+    Every segment starts with the program association and program map
+    tables, so it can be decoded on its own. The video packets carry the
+    program clock.
+    """
+
+    PAT = psi_section(0x00, 1, bytes([0, 1, 0xE0 | PMT_PID >> 8, PMT_PID & 0xFF]))
+    PMT = psi_section(0x02, 1, bytes([0xE0 | VIDEO_PID >> 8, VIDEO_PID & 0xFF, 0xF0, 0,
+                                      STREAM_TYPE_H264, 0xE0 | VIDEO_PID >> 8, VIDEO_PID & 0xFF, 0xF0, 0]))
+
+    def __init__(self):
+        """ constructor """
+        self.counters = {}
+
+    def next_counter(self, pid: int) -> int:
+        counter = self.counters.get(pid, -1) + 1 & 0x0F
+        self.counters[pid] = counter
+        return counter
+
+    def tables(self) -> bytes:
+        """
+        Returns:
+            bytes: The packets of the program association and program map tables.
+        """
+        return ts_packet(PAT_PID, self.next_counter(PAT_PID), self.PAT, unit_start=True) + \
+            ts_packet(PMT_PID, self.next_counter(PMT_PID), self.PMT, unit_start=True)
+
+    def access_unit(self, nal_units: list, pts: int, keyframe: bool) -> bytes:
+        """
+        Returns:
+            bytes: The packets of the PES packet of the access unit, the first one carries the program clock.
+        """
+        pes = b''.join([bytes([0, 0, 1, STREAM_ID_VIDEO, 0, 0, 0x80, 0x80, 5]), encode_pts(pts + PTS_OFFSET)] +
+                       [b'\x00\x00\x00\x01' + nal for nal in nal_units])
+        # the random access indicator marks the keyframes, the PCR flag the clock
+        adaptation = bytes([0x50 if keyframe else 0x10]) + encode_pcr(pts)
+        packets = []
+        position = 0
+        while position < len(pes):
+            size = TS_PAYLOAD_SIZE - (1 + len(adaptation) if adaptation is not None else 0)
+            packets.append(ts_packet(VIDEO_PID, self.next_counter(VIDEO_PID), pes[position:position + size],
+                                     unit_start=position == 0, adaptation=adaptation))
+            position += size
+            adaptation = None
+        return b''.join(packets)
+
+
+Segment = namedtuple('Segment', ['sequence', 'duration', 'data', 'discontinuity'])
+
+
+class SegmentRing(object):
+    """
+    The most recent segments of the live stream in memory.
+
+    The sequence numbers of the segments keep increasing over restarts of
+    the encoder, the first segment after a restart is marked as
+    discontinuity.
+
+    Attributes:
+        max_segments: Number of segments kept, older ones are dropped
+        segments: The kept segments, oldest first
+        next_sequence: Sequence number of the next segment
+        discontinuities: Number of discontinuities that were dropped with their segments
+    """
+
+    def __init__(self, max_segments: int = 6):
+        """ constructor """
+        self.max_segments = max_segments
+        self.condition = threading.Condition()
+        self.segments = deque()
+        self.next_sequence = 0
+        self.discontinuities = 0
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def add(self, data: bytes, duration: float, discontinuity: bool = False):
+        """Adds the segment and drops the oldest one if the ring is full."""
+        with self.condition:
+            self.segments.append(Segment(self.next_sequence, duration, data, discontinuity and self.next_sequence > 0))
+            self.next_sequence += 1
+            while len(self.segments) > self.max_segments:
+                self.discontinuities += self.segments.popleft().discontinuity
+            self.condition.notify_all()
+
+    def get(self, sequence: int) -> Segment:
+        """
+        Returns:
+            Segment: The segment of the sequence number, None if it was dropped or does not exist yet.
+        """
+        with self.condition:
+            for segment in self.segments:
+                if segment.sequence == sequence:
+                    return segment
+        return None
+
+    def wait_for_segment(self, timeout: float) -> bool:
+        """
+        Returns:
+            bool: True if there is a segment, False if none arrived in time.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.segments, timeout)
+
+    def get_playlist(self, segment_uri: str = '{}.ts') -> str:
+        """
+        Args:
+            segment_uri: The uri of a segment relative to the playlist, formatted with the sequence number.
+
+        Returns:
+            str: The live playlist of the kept segments.
+        """
+        with self.condition:
+            segments = list(self.segments)
+            discontinuities = self.discontinuities
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            '#EXT-X-TARGETDURATION:{}'.format(max([math.ceil(segment.duration) for segment in segments] or [1])),
+            '#EXT-X-MEDIA-SEQUENCE:{}'.format(segments[0].sequence if segments else 0),
+            '#EXT-X-DISCONTINUITY-SEQUENCE:{}'.format(discontinuities),
+        ]
+        for segment in segments:
+            if segment.discontinuity:
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines.append('#EXTINF:{:.3f},'.format(segment.duration))
+            lines.append(segment_uri.format(segment.sequence))
+        return '\n'.join(lines) + '\n'
+
+
+class H264Segmenter(object):
+    """
+    Splits an H.264 Annex-B byte stream written in arbitrary pieces into MPEG-TS segments.
+
+    Implements the write and flush methods of a picamera custom output, so
+    the encoder of a splitter port writes directly into it. The NAL units
+    are grouped into access units, i.e. frames, and muxed on the fly. A
+    segment is closed at the first keyframe after the segment duration,
+    so every segment starts with a keyframe and its parameter sets, which
+    the encoder has to repeat inline. The frames are timed by the frame
+    rate, as the raw stream has no timestamps. Frames before the first
+    keyframe are dropped.
+
+    Attributes:
+        segments: The ring the completed segments are added to
+        fps: Frames per second of the stream
+        segment_seconds: Minimal duration of a segment
+        frames: Number of frames muxed so far
+        max_buffer_bytes: A NAL unit that grows larger is dropped
+    """
+
+    def __init__(self, segments: SegmentRing, fps: float, segment_seconds: float = 2,
+                 max_buffer_bytes: int = 4 * 1024 * 1024):
+        """ constructor """
+        self.segments = segments
+        self.fps = fps
+        self.segment_seconds = segment_seconds
+        self.max_buffer_bytes = max_buffer_bytes
+        self.frames = 0
+        self.muxer = TSMuxer()
+        self.buffer = bytearray()
+        self.nal_units = []
+        self.has_slice = False
+        self.segment = None
+        self.segment_frames = 0
+        self.discontinuity = True
+
+    def write(self, data: bytes) -> int:
+        """
+        Returns:
+            int: The number of bytes written, i.e. all.
+        """
+        self.buffer += data
+        start = self.buffer.find(START_CODE)
+        if start < 0:
+            if len(self.buffer) > self.max_buffer_bytes:
+                self.buffer.clear()
+            return len(data)
+
+        while True:
+            end = self.buffer.find(START_CODE, start + 3)
+            if end < 0:
+                break
+            # the zero byte of a four byte start code is not part of the NAL unit
+            self.on_nal_unit(bytes(self.buffer[start + 3:end]).rstrip(b'\x00'))
+            start = end
+        del self.buffer[:start]
+        if len(self.buffer) > self.max_buffer_bytes:
+            self.buffer.clear()
+        return len(data)
+
+    def flush(self):
+        """Completes the last frame and the last segment, e.g. when the encoder stops."""
+        if self.buffer.startswith(START_CODE):
+            self.on_nal_unit(bytes(self.buffer[3:]).rstrip(b'\x00'))
+        self.buffer.clear()
+        self.finish_access_unit()
+        self.finish_segment()
+        self.discontinuity = True
+
+    def on_nal_unit(self, nal_unit: bytes):
+        if not nal_unit:
+            return
+        nal_type = nal_unit[0] & 0x1F
+        # a new frame starts with a delimiter, parameter sets, SEI or a slice with first_mb_in_slice 0
+        starts_access_unit = nal_type in (NAL_AUD, NAL_SPS, NAL_PPS, NAL_SEI) or \
+            (nal_type in (NAL_SLICE, NAL_IDR_SLICE) and len(nal_unit) > 1 and nal_unit[1] & 0x80)
+        if starts_access_unit and self.has_slice:
+            self.finish_access_unit()
+        if nal_type != NAL_AUD:
+            self.nal_units.append(nal_unit)
+        self.has_slice = self.has_slice or nal_type in (NAL_SLICE, NAL_IDR_SLICE)
+
+    def finish_access_unit(self):
+        """Muxes the NAL units of the completed frame into the current segment."""
+        nal_units, self.nal_units = self.nal_units, []
+        has_slice, self.has_slice = self.has_slice, False
+        if not has_slice:
+            return
+        keyframe = any(nal_unit[0] & 0x1F == NAL_IDR_SLICE for nal_unit in nal_units)
+        if keyframe and self.segment is not None and self.segment_frames >= self.segment_seconds * self.fps:
+            self.finish_segment()
+        if self.segment is None:
+            if not keyframe:
+                return
+            self.segment = [self.muxer.tables()]
+            self.segment_frames = 0
+
+        # players expect an access unit delimiter before every frame
+        pts = round(self.frames * CLOCK_RATE / self.fps)
+        self.segment.append(self.muxer.access_unit([AUD] + nal_units, pts, keyframe))
+        self.segment_frames += 1
+        self.frames += 1
+
+    def finish_segment(self):
+        """Adds the current segment to the ring."""
+        if self.segment is None:
+            return
+        self.segments.add(b''.join(self.segment), self.segment_frames / self.fps, self.discontinuity)
+        self.segment = None
+        self.discontinuity = False
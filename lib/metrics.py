@@ -0,0 +1,209 @@
+import bisect
+import logging
+import os
+import threading
+
+from lib.utils import read_cpu_temperature, TEMPERATURE_CHIP_KEY
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def is_metrics_enabled() -> bool:
+    """
+    Returns:
+        bool: True if the metrics are collected from the start, i.e. METRICS=1.
+    """
+    return os.environ.get('METRICS', '0') not in ('0', '')
+
+
+# The instrumented code checks this flag before it takes any time or touches a metric,
+# so the metrics cost nothing but the check while they are disabled.
+enabled = is_metrics_enabled()
+
+
+def set_enabled(value: bool):
+    """Enables or disables the collection of the metrics at runtime."""
+    global enabled
+    enabled = bool(value)
+    logging.info('Metrics are ' + ('on' if enabled else 'off'))
+
+
+def format_labels(label_names: tuple, labels: tuple, extra: str = '') -> str:
+    """
+    Returns:
+        str: The labels in the Prometheus text format, e.g. {stage="encode"}.
+    """
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(object):
+    """
+    Base class of the metrics.
+
+    Attributes:
+        name: The name of the metric
+        documentation: The description of the metric
+        label_names: The names of the labels, the values are passed as tuple in the same order
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        """ constructor """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def render_samples(self) -> list:
+        """
+        Returns:
+            list: The sample lines of the metric.
+        """
+        with self.lock:
+            values = list(self.values.items())
+        return ['{}{} {}'.format(self.name, format_labels(self.label_names, labels), value)
+                for labels, value in values]
+
+    def render(self) -> str:
+        """
+        Returns:
+            str: The metric in the Prometheus text format.
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        return '\n'.join(lines + self.render_samples())
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+
+    type = 'gauge'
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+
+class CallbackGauge(Metric):
+    """
+    Gauge whose value is read when the metrics are rendered.
+
+    Attributes:
+        callback: Returns the value, None if there is none
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback):
+        """ constructor """
+        super(CallbackGauge, self).__init__(name, documentation)
+        self.callback = callback
+
+    def render_samples(self) -> list:
+        try:
+            value = self.callback()
+        except (OSError, ValueError) as e:
+            logging.debug(e)
+            return []
+        return [] if value is None else ['{} {}'.format(self.name, value)]
+
+
+class Histogram(Metric):
+    """
+    Distribution of the observed values in buckets.
+
+    Attributes:
+        buckets: The upper bounds of the buckets
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = ()):
+        """ constructor """
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: tuple = ()):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # counts per bucket, the last one is +Inf, the sum and the count
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render_samples(self) -> list:
+        with self.lock:
+            values = [(labels, (list(state[0]), state[1], state[2])) for labels, state in self.values.items()]
+        lines = []
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else bound)
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(self.label_names, labels, le), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.label_names, labels), total))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.label_names, labels), count))
+        return lines
+
+
+def read_cpu_celsius():
+    """
+    Returns:
+        float: The CPU temperature in degree celsius.
+    """
+    return float(read_cpu_temperature()[TEMPERATURE_CHIP_KEY].split()[0])
+
+
+registry = []
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+stage_seconds = Histogram(
+    'camerapi_stage_seconds', 'Latency of the stages of the frame pipeline.', ('stage',), LATENCY_BUCKETS)
+frames_total = Counter('camerapi_frames_total', 'Frames published by the camera thread.', ('camera',))
+frame_bytes_total = Counter(
+    'camerapi_frame_bytes_total', 'Bytes of the frames published by the camera thread.', ('camera',))
+frame_bytes = Gauge('camerapi_frame_bytes', 'Bytes of the last published frame.', ('camera',))
+capture_fps = Gauge('camerapi_capture_fps', 'Moving average of the frames per second of the camera thread.', ('camera',))
+client_send_seconds = Histogram(
+    'camerapi_client_send_seconds', 'Time to write a frame to a stream client.', ('quality',), LATENCY_BUCKETS)
+client_ack_seconds = Histogram(
+    'camerapi_client_ack_seconds', 'Time from the publication of a frame to its acknowledgement by a WebSocket client.',
+    ('quality',), LATENCY_BUCKETS)
+recording_bytes_total = Counter('camerapi_recording_bytes_total', 'Bytes written to the recording chunks.')
+recording_write_seconds = Histogram(
+    'camerapi_recording_write_seconds', 'Time to write a frame to the recording chunk.', (), LATENCY_BUCKETS)
+cpu_temperature = CallbackGauge('camerapi_cpu_temperature_celsius', 'Temperature of the CPU.', read_cpu_celsius)
+
+
+def render(extra_gauges: dict = None) -> str:
+    """
+    Args:
+        extra_gauges: Name to (help, value) of gauges that are only known by the caller, e.g. the connected clients.
+
+    Returns:
+        str: All metrics in the Prometheus text format.
+    """
+    parts = [metric.render() for metric in registry]
+    for name, (documentation, value) in (extra_gauges or {}).items():
+        parts.append('# HELP {0} {1}\n# TYPE {0} gauge\n{0} {2}'.format(name, documentation, value))
+    parts.append('# HELP camerapi_metrics_enabled 1 if the metrics are collected.\n'
+                 '# TYPE camerapi_metrics_enabled gauge\ncamerapi_metrics_enabled {}'.format(int(enabled)))
+    return '\n'.join(parts) + '\n'
@@ -0,0 +1,174 @@
+import logging
+
+BOUNDARY = b'frame'
+MIMETYPE = 'multipart/x-mixed-replace; boundary=' + BOUNDARY.decode()
+
+
+def encode_part(jpeg: bytes) -> bytes:
+    """
+    Builds the multipart part of a single JPG image of the MJPEG stream.
+
+    The part is built once per frame by the camera thread and shared by all stream clients.
+
+    Returns:
+        bytes: The boundary, headers and image of the part.
+    """
+    return b''.join((b'--', BOUNDARY, b'\r\n'
+                     b'Content-Type: image/jpeg\r\n'
+                     b'Content-Length: ', str(len(jpeg)).encode(), b'\r\n\r\n',
+                     jpeg, b'\r\n'))
+
+
+# Sent instead of an unchanged frame to keep idle connections and proxies alive.
+# Multipart parsers treat the line break as padding after the previous part.
+KEEPALIVE_PART = b'\r\n'
+
+SOI = b'\xff\xd8'
+EOI = 0xD9
+SOS = 0xDA
+# markers without length, the restart markers may appear inside the entropy coded data
+STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+
+
+def find_frame_end(data, start: int, position: int, in_scan: bool) -> tuple:
+    """
+    Parses the JPG that starts at start in data from the given position on.
+
+    The segments up to the start of scan are skipped by their length, so
+    embedded thumbnails do not end the frame. In the entropy coded data
+    every 0xFF byte is stuffed, so the next marker other than a restart
+    marker ends the scan.
+
+    Returns:
+        tuple: The index after the end of image marker, None if the frame is incomplete,
+            and the position and scan state to continue parsing once more data arrived.
+    """
+    length = len(data)
+    while True:
+        if in_scan:
+            marker = data.find(b'\xff', position)
+            while marker >= 0 and marker + 1 < length and \
+                    (data[marker + 1] in (0x00, 0xFF) or data[marker + 1] in STANDALONE_MARKERS):
+                marker = data.find(b'\xff', marker + 1)
+            if marker < 0:
+                return None, length, True
+            if marker + 1 >= length:
+                return None, marker, True
+            if data[marker + 1] == EOI:
+                return marker + 2, marker + 2, False
+            # e.g. the tables of the next scan of a progressive JPG
+            position = marker
+            in_scan = False
+
+        if position + 2 > length:
+            return None, position, False
+        if data[position] != 0xFF:
+            raise ValueError('No JPG marker at {}'.format(position - start))
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # fill byte
+            position += 1
+            continue
+        if marker == EOI:
+            return position + 2, position + 2, False
+        if marker in STANDALONE_MARKERS:
+            position += 2
+            continue
+        if position + 4 > length:
+            return None, position, False
+        position += 2 + (data[position + 2] << 8 | data[position + 3])
+        in_scan = marker == SOS
+
+
+class MJPEGFrameSplitter(object):
+    """
+    Splits an MJPEG byte stream written in arbitrary pieces into JPG frames.
+
+    Implements the write and flush methods of a picamera custom output. A
+    write that contains exactly one complete frame, which is the common case
+    for the MJPEG encoder of the Pi, is passed on without copying. Bytes
+    before the start of a frame and frames that are corrupt or exceed the
+    maximal size are dropped.
+
+    Attributes:
+        on_frame: Invoked with every completed frame
+        max_frame_bytes: Frames that grow larger are dropped
+        frames: Number of completed frames
+        dropped_bytes: Number of bytes that were dropped
+    """
+
+    def __init__(self, on_frame, max_frame_bytes: int = 8 * 1024 * 1024):
+        """ constructor """
+        self.on_frame = on_frame
+        self.max_frame_bytes = max_frame_bytes
+        self.frames = 0
+        self.dropped_bytes = 0
+        self.buffer = bytearray()
+        self.position = 0
+        self.in_scan = False
+
+    def write(self, data: bytes) -> int:
+        """
+        Returns:
+            int: The number of bytes written, i.e. all.
+        """
+        if self.buffer:
+            self.buffer += data
+            stream = self.buffer
+        else:
+            stream = data
+
+        start = 0
+        length = len(stream)
+        while start < length:
+            if self.position == 0:
+                # synchronize to the start of the next frame
+                frame_start = stream.find(SOI, start)
+                if frame_start < 0:
+                    keep = 1 if stream[-1] == 0xFF else 0
+                    self.dropped_bytes += length - start - keep
+                    start = length - keep
+                    break
+                self.dropped_bytes += frame_start - start
+                start = frame_start
+                self.position = 2
+
+            try:
+                end, position, self.in_scan = find_frame_end(stream, start, start + self.position, self.in_scan)
+            except ValueError as e:
+                logging.debug(e)
+                self.drop_frame(1)
+                start += 1
+                continue
+
+            if end is None:
+                self.position = position - start
+                if self.position > self.max_frame_bytes:
+                    self.drop_frame(length - start)
+                    start = length
+                break
+
+            if start == 0 and end == length and stream is data:
+                frame = data
+            else:
+                frame = bytes(stream[start:end])
+            self.position = 0
+            self.in_scan = False
+            self.frames += 1
+            self.on_frame(frame)
+            start = end
+
+        if stream is self.buffer:
+            del self.buffer[:start]
+        else:
+            self.buffer = bytearray(data[start:])
+        return len(data)
+
+    def drop_frame(self, size: int):
+        """Drops the current frame and synchronizes to the next one."""
+        self.dropped_bytes += size
+        self.position = 0
+        self.in_scan = False
+
+    def flush(self):
+        pass
@@ -0,0 +1,209 @@
+import logging
+import os
+import threading
+import time
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+
+def is_motion_detection_enabled() -> bool:
+    """
+    Returns:
+        bool: True if recordings are started by motion, i.e. MOTION_DETECTION=1 and OpenCV is available.
+    """
+    if os.environ.get('MOTION_DETECTION', '0') in ('0', ''):
+        return False
+    if cv2 is None:
+        logging.warning('OpenCV is not available, motion detection is disabled')
+        return False
+    return True
+
+
+def parse_region_of_interest(roi: str) -> tuple:
+    """
+    Parses a region of interest given as 'left,top,right,bottom' fractions of the image, e.g. '0,0.5,1,1'.
+
+    Returns:
+        tuple: The (left, top, right, bottom) fractions, the full image if no region is given.
+    """
+    if not roi:
+        return 0.0, 0.0, 1.0, 1.0
+    left, top, right, bottom = [min(1.0, max(0.0, float(value))) for value in roi.split(',')]
+    return left, top, right, bottom
+
+
+class MotionDetector(object):
+    """
+    Frame differencing against a running average background model.
+
+    The JPG frames are decoded downscaled to grayscale. All other arrays are
+    allocated once per frame size and reused for every frame.
+
+    Attributes:
+        threshold: Minimal gray value difference of a pixel to the background to count as changed
+        learning_rate: Weight of the current frame in the running average background
+        region_of_interest: (left, top, right, bottom) fractions of the image that are monitored
+    """
+
+    def __init__(self, threshold: int = 25, learning_rate: float = 0.05, region_of_interest: tuple = None):
+        """ constructor """
+        self.threshold = threshold
+        self.learning_rate = learning_rate
+        self.region_of_interest = region_of_interest or (0.0, 0.0, 1.0, 1.0)
+        self.background = None
+        self.difference = None
+        self.changed = None
+        self.mask = None
+        self.mask_pixels = 0
+
+    def allocate(self, shape: tuple):
+        """Allocates the reused arrays for the given frame size."""
+        self.background = np.zeros(shape, dtype=np.float32)
+        self.difference = np.zeros(shape, dtype=np.float32)
+        self.changed = np.zeros(shape, dtype=bool)
+        self.mask = np.zeros(shape, dtype=bool)
+
+        left, top, right, bottom = self.region_of_interest
+        height, width = shape
+        self.mask[int(top * height):int(bottom * height), int(left * width):int(right * width)] = True
+        self.mask_pixels = max(1, int(np.count_nonzero(self.mask)))
+
+    def detect(self, jpeg: bytes) -> float:
+        """
+        Compares the frame with the background model and updates the model.
+
+        Returns:
+            float: The fraction of the region of interest that changed.
+        """
+        gray = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if gray is None:
+            return 0.0
+
+        if self.background is None or self.background.shape != gray.shape:
+            self.allocate(gray.shape)
+            self.background[:] = gray
+            return 0.0
+
+        np.subtract(gray, self.background, out=self.difference)
+        np.abs(self.difference, out=self.difference)
+        np.greater(self.difference, self.threshold, out=self.changed)
+        np.logical_and(self.changed, self.mask, out=self.changed)
+        cv2.accumulateWeighted(gray, self.background, self.learning_rate)
+
+        return np.count_nonzero(self.changed) / self.mask_pixels
+
+
+class MotionMonitor(object):
+    """
+    Runs the motion detection on the frames of the camera and controls the recording.
+
+    Only every n-th frame is analyzed. n is adapted so the detection uses at
+    most the CPU budget, i.e. the fraction of the time between two analyzed
+    frames. A recording is started if motion was seen for the trigger
+    seconds and stopped after the quiet seconds without motion.
+
+    Attributes:
+        min_changed: Minimal changed fraction of the region of interest that counts as motion
+        trigger_seconds: Seconds of sustained motion that start a recording
+        quiet_seconds: Seconds without motion after which a motion triggered recording is stopped
+        cpu_budget: Maximal fraction of the time spent on motion detection
+        every: Only every n-th frame is analyzed
+        score: The changed fraction of the last analyzed frame
+    """
+
+    def __init__(self, camera, detector: MotionDetector = None, min_changed: float = 0.01,
+                 trigger_seconds: float = 1, quiet_seconds: float = 30, cpu_budget: float = 0.1, every: int = 3):
+        """ constructor """
+        self.camera = camera
+        self.detector = detector or MotionDetector(
+            region_of_interest=parse_region_of_interest(os.environ.get('MOTION_ROI')))
+        self.min_changed = min_changed
+        self.trigger_seconds = trigger_seconds
+        self.quiet_seconds = quiet_seconds
+        self.cpu_budget = cpu_budget
+        self.every = every
+        self.score = 0.0
+        self.motion_since = None
+        self.last_motion = 0
+        self.triggered_recording = False
+        self.thread = None
+
+    def start(self):
+        """Starts the motion detection thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._thread, daemon=True)
+            self.thread.start()
+
+    def update(self, motion: bool, now: float):
+        """Starts or stops the recording depending on the motion."""
+        if motion:
+            self.last_motion = now
+            if self.motion_since is None:
+                self.motion_since = now
+            if now - self.motion_since >= self.trigger_seconds and not self.camera.is_recording():
+                logging.info('Motion detected, starting recording')
+                self.triggered_recording = True
+                self.camera.record()
+            return
+
+        self.motion_since = None
+        if self.triggered_recording and now - self.last_motion > self.quiet_seconds:
+            self.triggered_recording = False
+            if self.camera.is_recording():
+                logging.info('No motion for {} s, stopping recording'.format(self.quiet_seconds))
+                self.camera.stop_recording()
+
+    def adapt(self, cost: float, interval: float):
+        """Adapts the analyzed frame interval to the CPU budget."""
+        if interval <= 0:
+            return
+        load = cost / interval
+        if load > self.cpu_budget:
+            self.every += 1
+        elif load < self.cpu_budget / 2 and self.every > 1:
+            self.every -= 1
+
+    def _thread(self):
+        """Motion detection background thread."""
+        logging.info('Starting motion detection')
+        last_seq = 0
+        skipped = 0
+        last_analyzed = time.time()
+        while True:
+            frame = self.camera.next_frame(after_seq=last_seq)
+            if frame is None:
+                continue
+            skipped += frame.seq - last_seq if last_seq else 1
+            last_seq = frame.seq
+            if skipped < self.every:
+                continue
+            skipped = 0
+
+            start = time.perf_counter()
+            try:
+                self.score = self.detector.detect(frame.data)
+            except cv2.error as e:
+                logging.info(e)
+                continue
+            cost = time.perf_counter() - start
+
+            now = time.time()
+            self.adapt(cost, now - last_analyzed)
+            last_analyzed = now
+            self.update(self.score >= self.min_changed, now)
+
+    def get_status(self) -> dict:
+        """
+        Returns:
+            dict: The state of the motion detection.
+        """
+        return {
+            'score': self.score,
+            'every': self.every,
+            'motion': self.motion_since is not None,
+            'triggered_recording': self.triggered_recording,
+        }
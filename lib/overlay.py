@@ -0,0 +1,224 @@
+import logging
+import os
+import time
+
+from lib.utils import get_datetime_now_log_string, read_cpu_temperature, TEMPERATURE_CHIP_KEY
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+
+def is_overlay_enabled() -> bool:
+    """
+    Returns:
+        bool: True if the OpenCV and mock frames get a timestamp overlay, i.e. OVERLAY=1.
+    """
+    if os.environ.get('OVERLAY', '0') in ('0', ''):
+        return False
+    if cv2 is None:
+        logging.warning('OpenCV is not available, the overlay is disabled')
+        return False
+    return True
+
+
+def get_overlay_scale(width: int) -> float:
+    """
+    Returns:
+        float: The font scale that fits the timestamp into about a third of the frame width.
+    """
+    return min(1.0, max(0.25, width / 1600))
+
+
+class GlyphCache(object):
+    """
+    Bitmaps of the characters rendered once with cv2.putText.
+
+    All glyphs have the same cell size, so a text of a given length always
+    covers the same region.
+
+    Attributes:
+        scale: The font scale
+        thickness: The stroke thickness
+        cell: The (width, height) of a glyph
+    """
+
+    def __init__(self, scale: float = 0.5, thickness: int = 1, font: int = None):
+        """ constructor """
+        self.font = cv2.FONT_HERSHEY_SIMPLEX if font is None else font
+        self.scale = scale
+        self.thickness = thickness
+        (width, height), baseline = cv2.getTextSize('W', self.font, scale, thickness)
+        self.baseline = baseline + thickness
+        self.cell = (width + thickness, height + self.baseline + thickness)
+        self.glyphs = {}
+
+    def get_glyph(self, character: str):
+        """
+        Returns:
+            np.ndarray: The anti-aliased coverage of the character, 0 to 255.
+        """
+        glyph = self.glyphs.get(character)
+        if glyph is None:
+            width, height = self.cell
+            canvas = np.zeros((height, width), dtype=np.uint8)
+            text_width = cv2.getTextSize(character, self.font, self.scale, self.thickness)[0][0]
+            cv2.putText(canvas, character, ((width - text_width) // 2, height - self.baseline),
+                        self.font, self.scale, 255, self.thickness, cv2.LINE_AA)
+            glyph = self.glyphs[character] = canvas
+        return glyph
+
+    def render(self, text: str):
+        """
+        Returns:
+            np.ndarray: The coverage of the text composed from the glyphs.
+        """
+        if not text:
+            return np.zeros((self.cell[1], 0), dtype=np.uint8)
+        return np.hstack([self.get_glyph(character) for character in text])
+
+
+class TextOverlay(object):
+    """
+    Stamps lines of text onto raw BGR frames before they are encoded.
+
+    The coverage of the text is composed from the cached glyphs only when
+    the text changes. Per frame, the color is alpha-blended into the frame
+    through the coverage with two saturating OpenCV array operations, which
+    is much cheaper than a cv2.putText pass and keeps the image around the
+    characters visible. Text that does not fit into the frame is clipped.
+
+    The overlay is shared by the encoder threads, so the rendered lines are
+    replaced as a whole and every frame is drawn from one of them.
+
+    Attributes:
+        glyphs: The glyph cache
+        position: The (x, y) of the top left corner of the overlay
+        color: The BGR color of the text
+        rendered: The lines, the tile of the color premultiplied by the coverage and the inverse alpha
+            of the coverage, the arrays are None if there is no text
+    """
+
+    def __init__(self, scale: float = 0.5, thickness: int = 1, position: tuple = (8, 8),
+                 color: tuple = (255, 255, 255)):
+        """ constructor """
+        self.glyphs = GlyphCache(scale, thickness)
+        self.position = position
+        self.color = np.array(color, dtype=np.float32) / 255
+        self.rendered = ((), None, None)
+
+    def set_lines(self, lines: tuple) -> tuple:
+        """
+        Composes the tile of the lines if they changed.
+
+        Returns:
+            tuple: The rendered lines.
+        """
+        lines = tuple(lines)
+        rendered = self.rendered
+        if lines == rendered[0]:
+            return rendered
+        coverages = [self.glyphs.render(line) for line in lines]
+        width = max(coverage.shape[1] for coverage in coverages) if coverages else 0
+        if width:
+            coverage = np.vstack([np.pad(coverage, ((0, 0), (0, width - coverage.shape[1])))
+                                  for coverage in coverages])
+            # the color premultiplied by the coverage and the weight of the frame behind it
+            rendered = (lines, np.rint(coverage[:, :, np.newaxis] * self.color).astype(np.uint8),
+                        cv2.merge([255 - coverage] * 3))
+        else:
+            rendered = (lines, None, None)
+        self.rendered = rendered
+        return rendered
+
+    def draw(self, frame, lines: tuple):
+        """Stamps the lines onto the frame in place."""
+        _, tile, inverse_alpha = self.set_lines(lines)
+        if tile is None:
+            return
+        x, y = self.position
+        height = min(tile.shape[0], frame.shape[0] - y)
+        width = min(tile.shape[1], frame.shape[1] - x)
+        if height <= 0 or width <= 0:
+            return
+        region = frame[y:y + height, x:x + width]
+        cv2.multiply(region, inverse_alpha[:height, :width], dst=region, scale=1 / 255)
+        cv2.add(region, tile[:height, :width], dst=region)
+
+
+def get_overlay_text() -> str:
+    """
+    Returns:
+        str: The static text of the second overlay line given as OVERLAY_TEXT, e.g. the location of the camera.
+    """
+    return os.environ.get('OVERLAY_TEXT', '')
+
+
+def is_temperature_overlay_enabled() -> bool:
+    """
+    Returns:
+        bool: True if the CPU temperature is added to the overlay, i.e. OVERLAY_TEMPERATURE=1.
+    """
+    return os.environ.get('OVERLAY_TEMPERATURE', '0') not in ('0', '')
+
+
+class TimestampOverlay(object):
+    """
+    Overlay with the current date and time and optional sensor text.
+
+    The lines are only rebuilt when the second changes.
+
+    Attributes:
+        overlay: Draws the lines
+        text: Static text of the second line
+        temperature: True if the CPU temperature is added to the second line
+    """
+
+    @classmethod
+    def for_frame(cls, frame):
+        """
+        Returns:
+            TimestampOverlay: An overlay with a font scale that fits the frame.
+        """
+        return cls(TextOverlay(get_overlay_scale(frame.shape[1])))
+
+    def __init__(self, overlay: TextOverlay = None, text: str = None, temperature: bool = None):
+        """ constructor """
+        self.overlay = overlay or TextOverlay()
+        self.text = get_overlay_text() if text is None else text
+        self.temperature = is_temperature_overlay_enabled() if temperature is None else temperature
+        self.second = None
+        self.lines = ()
+        self.sensor_text = self.text
+        self.sensor_read_at = 0
+
+    def get_lines(self) -> tuple:
+        """
+        Returns:
+            tuple: The lines of the current second.
+        """
+        second = int(time.time())
+        if second != self.second:
+            self.second = second
+            if self.temperature and second - self.sensor_read_at >= 10:
+                self.sensor_text = ' '.join(filter(None, [self.text, read_temperature_text()]))
+                self.sensor_read_at = second
+            self.lines = tuple(filter(None, [get_datetime_now_log_string(), self.sensor_text]))
+        return self.lines
+
+    def draw(self, frame):
+        """Stamps the overlay onto the frame in place."""
+        self.overlay.draw(frame, self.get_lines())
+
+
+def read_temperature_text() -> str:
+    """
+    Returns:
+        str: The CPU temperature, empty if it can not be read.
+    """
+    try:
+        return read_cpu_temperature()[TEMPERATURE_CHIP_KEY]
+    except (OSError, ValueError):
+        return ''
@@ -0,0 +1,149 @@
+import collections
+import os
+import threading
+import time
+
+
+def get_pre_event_seconds() -> float:
+    """
+    Returns:
+        float: Seconds of video before the start of a recording that are added to the recording, 0 disables it.
+    """
+    if os.environ.get('PRE_EVENT_SECONDS'):
+        return float(os.environ['PRE_EVENT_SECONDS'])
+    return 5
+
+
+def get_pre_event_max_bytes() -> int:
+    """
+    Returns:
+        int: Maximal memory in bytes used to buffer the video before the start of a recording.
+    """
+    if os.environ.get('PRE_EVENT_MAX_BYTES'):
+        return int(os.environ['PRE_EVENT_MAX_BYTES'])
+    return 16 * 1024 * 1024
+
+
+class PreEventBuffer(object):
+    """
+    Circular in-memory buffer of the most recent encoded frames.
+
+    Frames older than the configured seconds are dropped, and the oldest
+    frames are dropped as soon as the buffered bytes exceed the limit.
+
+    Attributes:
+        seconds: Maximal age of the buffered frames
+        max_bytes: Maximal size of the buffered frames
+        size: Current size of the buffered frames in bytes
+    """
+
+    def __init__(self, seconds: float = None, max_bytes: int = None):
+        """ constructor """
+        self.seconds = seconds if seconds is not None else get_pre_event_seconds()
+        self.max_bytes = max_bytes if max_bytes is not None else get_pre_event_max_bytes()
+        self.frames = collections.deque()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def is_enabled(self) -> bool:
+        """
+        Returns:
+            bool: True if frames are buffered at all.
+        """
+        return self.seconds > 0 and self.max_bytes > 0
+
+    def append(self, timestamp: float, data: bytes):
+        """Invoked by the camera thread with every frame."""
+        if not self.is_enabled():
+            return
+
+        with self.lock:
+            self.frames.append((timestamp, data))
+            self.size += len(data)
+            while self.frames and (self.size > self.max_bytes or timestamp - self.frames[0][0] > self.seconds):
+                self.size -= len(self.frames.popleft()[1])
+
+    def drain(self) -> list:
+        """
+        Removes all buffered frames.
+
+        Returns:
+            list: The buffered (timestamp, data) tuples of the last seconds, oldest first.
+        """
+        now = time.time()
+        with self.lock:
+            frames = [frame for frame in self.frames if now - frame[0] <= self.seconds]
+            self.frames.clear()
+            self.size = 0
+        return frames
+
+    def write_to(self, output) -> int:
+        """
+        Flushes the buffered frames into the output, e.g. the first chunk of a recording.
+
+        Returns:
+            int: The number of written bytes.
+        """
+        written = 0
+        for _, data in self.drain():
+            output.write(data)
+            written += len(data)
+        return written
+
+    def get_duration(self) -> float:
+        """
+        Returns:
+            float: Seconds between the oldest and the newest buffered frame.
+        """
+        with self.lock:
+            if not self.frames:
+                return 0
+            return self.frames[-1][0] - self.frames[0][0]
+
+
+class PreEventOutput(object):
+    """
+    File-like encoder output that starts with the buffered pre-event video.
+
+    The encoder may already write to the output before the buffered video
+    has been copied into it. These writes are held back until the pre-event
+    video has been flushed.
+    """
+
+    def __init__(self, output):
+        """ constructor """
+        self.output = output
+        self.pending = []
+        self.flushed = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def write(self, b) -> int:
+        with self.lock:
+            if not self.flushed:
+                self.pending.append(bytes(b))
+                return len(b)
+        return self.output.write(b)
+
+    def flush_pre_event(self, copy_pre_event):
+        """
+        Writes the pre-event video followed by the held back writes.
+
+        Args:
+            copy_pre_event: Callable that writes the pre-event video into the given output,
+                e.g. PreEventBuffer.write_to.
+        """
+        with self.lock:
+            copy_pre_event(self.output)
+            for b in self.pending:
+                self.output.write(b)
+            self.pending = []
+            self.flushed = True
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.output.close()
@@ -1,36 +1,53 @@
+import logging
 import os
+import sqlite3
 from datetime import datetime
 from pathlib import Path
 
+from lib.recordings_index import get_recordings_index
+from lib.storage_manager import StorageManager
 from lib.utils import get_datetime_now_file_string, \
-    can_write_to_dir, get_default_recordings_path, split_path_list
+    get_default_recordings_path, split_path_list
 
 
 class RecordingsFolder:
     """
     Wrapper that holds all necessary file paths for logging and recording.
+
+    The recordings of a camera of a multi camera setup are kept in the
+    subdirectory of the camera on every base path.
     """
 
-    def __init__(self, base_path_list: str = get_default_recordings_path()):
+    def __init__(self, base_path_list: str = get_default_recordings_path(),
+                 storage_manager: StorageManager = None,
+                 subdirectory: str = ''):
         """ constructor """
         self.datetime_now: datetime = datetime.now()
-        self.base_paths: list = split_path_list(base_path_list)
+        self.subdirectory: str = subdirectory
+        self.base_paths: list = [
+            os.path.join(base_path, subdirectory) if subdirectory
+            else base_path for base_path in split_path_list(base_path_list)]
+        self.storage_manager: StorageManager = \
+            storage_manager or StorageManager(self.base_paths)
         self.log_dir: str = ''
         self.current_recordings_folder: str = ''
+        self.current_chunk_path: str = ''
         self.needs_new_recording: bool = True
+        self.storage_manager.on_delete = self.chunk_deleted
 
-    def create_new_recording(self):
+    def select_base_path(self) -> str:
         """
-        Creates a new folder for recordings.
+        Returns the best storage target, the default recordings path if
+        no target is usable.
         """
-        if not self.log_dir or not can_write_to_dir(self.log_dir):
-            for path in self.base_paths:
-                if can_write_to_dir(path):
-                    self.log_dir = path
-                    break
+        return self.storage_manager.select_target() or \
+            os.path.join(get_default_recordings_path(), self.subdirectory)
 
-        if not self.log_dir:
-            self.log_dir = get_default_recordings_path()
+    def create_new_recording(self):
+        """
+        Creates a new folder for recordings on the best storage target.
+        """
+        self.log_dir = self.select_base_path()
 
         self.current_recordings_folder = \
             os.path.join(self.log_dir, get_datetime_now_file_string())
@@ -38,13 +55,60 @@ class RecordingsFolder:
         Path(self.current_recordings_folder).mkdir(parents=True,
                                                    exist_ok=True)
         self.needs_new_recording = False
+        self.storage_manager.start_retention(self.current_recordings_folder)
 
-    def get_next_chunk_path(self):
+    def get_next_chunk_path(self, extension: str = '.h264', continues: str = ''):
         """
         Returns the full path to the current chunk.
+        :param extension: The file extension of the chunk.
+        :param continues: The path of the previous part if the chunk is continued after a failover.
         :return:
         """
-        if not self.current_recordings_folder or self.needs_new_recording:
+        self.close_chunk()
+        if not self.current_recordings_folder or self.needs_new_recording \
+                or not self.storage_manager.is_path_usable(self.log_dir):
+            # switches the target on the chunk boundary if it became full
             self.create_new_recording()
-        return os.path.join(self.current_recordings_folder,
-                            get_datetime_now_file_string() + '.h264')
+
+        name = get_datetime_now_file_string()
+        self.current_chunk_path = os.path.join(
+            self.current_recordings_folder, name + extension)
+        counter = 0
+        while os.path.exists(self.current_chunk_path):
+            # a chunk started within the same second, e.g. after a failover
+            counter += 1
+            self.current_chunk_path = os.path.join(
+                self.current_recordings_folder,
+                '{}_{}{}'.format(name, counter, extension))
+        try:
+            get_recordings_index(self.log_dir).chunk_opened(
+                self.current_chunk_path, continues)
+        except (OSError, sqlite3.Error) as e:
+            logging.info(e)
+        return self.current_chunk_path
+
+    def close_chunk(self):
+        """
+        Marks the current chunk as finished in the recordings index.
+        """
+        if not self.current_chunk_path:
+            return
+        try:
+            get_recordings_index(self.log_dir).chunk_closed(
+                self.current_chunk_path)
+        except (OSError, sqlite3.Error) as e:
+            logging.info(e)
+        self.current_chunk_path = ''
+
+    def chunk_deleted(self, path: str):
+        """
+        Removes a chunk deleted by the retention from the recordings index.
+        :param path: The path of the deleted chunk.
+        """
+        target = self.storage_manager.get_target(path)
+        if target is None:
+            return
+        try:
+            get_recordings_index(target.path).chunk_deleted(path)
+        except (OSError, sqlite3.Error) as e:
+            logging.info(e)
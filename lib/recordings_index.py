@@ -0,0 +1,218 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from lib.utils import file_date_format_string
+
+INDEX_FILE_NAME = 'recordings_index.sqlite'
+CHUNK_EXTENSIONS = ('.h264', '.mjpeg', '.avi')
+# seconds without a write after which an open chunk belongs to a crashed process
+STALE_SECONDS = 60
+
+
+class RecordingsIndex(object):
+    """
+    SQLite index of the chunks below one recordings base path.
+
+    The index is stored next to the recording folders and is updated when
+    chunks are opened and closed. It is rebuilt from the files on disk if it
+    is missing. A chunk continued on another drive after a failover links
+    to its previous part, which it cannot be decoded without. Chunks that
+    were left open by a crashed process are finished with the time of their
+    last write.
+
+    Attributes:
+        root: The recordings base path
+        path: The path of the SQLite database
+    """
+
+    def __init__(self, root: str):
+        """ constructor """
+        self.root = root
+        self.path = os.path.join(root, INDEX_FILE_NAME)
+        self.lock = threading.Lock()
+        self.last_closed = ''
+        self.migrated = False
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def ensure(self):
+        """Creates the index and fills it from disk if it is missing."""
+        if self.migrated and os.path.exists(self.path):
+            return
+        with self.lock:
+            exists = os.path.exists(self.path)
+            if self.migrated and exists:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            with self.connect() as connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS chunks ('
+                                   'path TEXT PRIMARY KEY, session TEXT, start REAL, end REAL, size INTEGER, '
+                                   'continues TEXT)')
+                connection.execute('CREATE INDEX IF NOT EXISTS chunks_start ON chunks (start)')
+                connection.execute('CREATE INDEX IF NOT EXISTS chunks_end ON chunks (end)')
+                if 'continues' not in [row['name'] for row in connection.execute('PRAGMA table_info(chunks)')]:
+                    # an index of an older version
+                    connection.execute('ALTER TABLE chunks ADD COLUMN continues TEXT')
+                if exists:
+                    finish_stale_chunks(connection, self.root)
+                else:
+                    self.rebuild(connection)
+            self.migrated = True
+
+    def rebuild(self, connection: sqlite3.Connection):
+        """Adds all chunks in the recording folders below the root."""
+        started = time.time()
+        rows = []
+        for folder in os.scandir(self.root):
+            if not folder.is_dir() or not is_recording_folder(folder.name):
+                continue
+            for entry in os.scandir(folder.path):
+                chunk_start = parse_chunk_start(entry.name)
+                if not entry.is_file() or chunk_start is None:
+                    continue
+                stat = entry.stat()
+                rows.append((os.path.relpath(entry.path, self.root), folder.name, chunk_start,
+                             stat.st_mtime, stat.st_size, None))
+        connection.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)', rows)
+        logging.info('Rebuilt recordings index of {} with {} chunks in {:.3f} s'.format(
+            self.root, len(rows), time.time() - started))
+
+    def chunk_opened(self, path: str, continues: str = ''):
+        """Invoked when a chunk is opened for writing, continues is the previous part after a failover."""
+        self.ensure()
+        with self.lock, self.connect() as connection:
+            if self.last_closed:
+                # the encoder might have still written to the previous chunk when it was closed
+                update_size(connection, self.root, self.last_closed)
+            finish_stale_chunks(connection, self.root)
+            connection.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, NULL, NULL, ?)', (
+                os.path.relpath(path, self.root), os.path.basename(os.path.dirname(path)), time.time(),
+                os.path.abspath(continues) if continues else None))
+
+    def chunk_closed(self, path: str):
+        """Invoked when a chunk is finished."""
+        self.ensure()
+        with self.lock, self.connect() as connection:
+            connection.execute('UPDATE chunks SET end = ? WHERE path = ?',
+                               (time.time(), os.path.relpath(path, self.root)))
+            update_size(connection, self.root, path)
+        self.last_closed = path
+
+    def chunk_deleted(self, path: str):
+        """Invoked when a chunk was deleted, e.g. by the retention."""
+        if not os.path.exists(self.path):
+            return
+        with self.lock, self.connect() as connection:
+            connection.execute('DELETE FROM chunks WHERE path = ?', (os.path.relpath(path, self.root),))
+
+    def query(self, start: float = None, end: float = None) -> list:
+        """
+        Returns:
+            list: The chunks that overlap the time range, ordered by their start.
+        """
+        self.ensure()
+        with self.connect() as connection:
+            rows = connection.execute(
+                'SELECT * FROM chunks WHERE start <= ? AND COALESCE(end, ?) >= ? ORDER BY start',
+                (end if end is not None else float('inf'), time.time(), start if start is not None else 0)
+            ).fetchall()
+        return [{
+            'path': os.path.join(self.root, row['path']),
+            'drive': self.root,
+            'session': row['session'],
+            'start': row['start'],
+            'end': row['end'],
+            'size': row['size'],
+            'continues': row['continues'],
+        } for row in rows]
+
+
+def is_recording_folder(name: str) -> bool:
+    """
+    Returns:
+        bool: True if the name is the timestamp of a recording folder.
+    """
+    try:
+        datetime.strptime(name, file_date_format_string)
+    except ValueError:
+        return False
+    return True
+
+
+def parse_chunk_start(file_name: str):
+    """
+    Returns:
+        float: The start time encoded in the chunk file name, None if it is no chunk.
+            A chunk started in the same second as the previous one has a counter suffix, e.g. _1.
+    """
+    stem, extension = os.path.splitext(file_name)
+    if extension not in CHUNK_EXTENSIONS:
+        return None
+    for candidate in (stem, stem.rpartition('_')[0]):
+        try:
+            return datetime.strptime(candidate, file_date_format_string).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def finish_stale_chunks(connection: sqlite3.Connection, root: str):
+    """Finishes the open chunks that were not written for the stale time, chunks that are gone are removed."""
+    now = time.time()
+    for row in connection.execute('SELECT path, start FROM chunks WHERE end IS NULL').fetchall():
+        try:
+            stat = os.stat(os.path.join(root, row['path']))
+        except OSError:
+            if now - row['start'] > STALE_SECONDS:
+                connection.execute('DELETE FROM chunks WHERE path = ?', (row['path'],))
+            continue
+        if now - stat.st_mtime > STALE_SECONDS:
+            connection.execute('UPDATE chunks SET end = ?, size = ? WHERE path = ?',
+                               (stat.st_mtime, stat.st_size, row['path']))
+
+
+def update_size(connection: sqlite3.Connection, root: str, path: str):
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    connection.execute('UPDATE chunks SET size = ? WHERE path = ?', (size, os.path.relpath(path, root)))
+
+
+indexes = {}
+indexes_lock = threading.Lock()
+
+
+def get_recordings_index(root: str) -> RecordingsIndex:
+    """
+    Returns:
+        RecordingsIndex: The shared index of the recordings base path.
+    """
+    root = os.path.abspath(root)
+    with indexes_lock:
+        if root not in indexes:
+            indexes[root] = RecordingsIndex(root)
+        return indexes[root]
+
+
+def query_recordings(base_paths: list, start: float = None, end: float = None) -> list:
+    """
+    Returns:
+        list: The chunks of all recordings base paths that overlap the time range, ordered by their start.
+    """
+    chunks = []
+    for base_path in base_paths:
+        if not os.path.isdir(base_path):
+            continue
+        try:
+            chunks += get_recordings_index(base_path).query(start, end)
+        except (OSError, sqlite3.Error) as e:
+            logging.info(e)
+    return sorted(chunks, key=lambda chunk: chunk['start'])
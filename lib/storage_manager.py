@@ -0,0 +1,368 @@
+import logging
+import os
+import shutil
+import threading
+import time
+
+from lib.recordings_index import CHUNK_EXTENSIONS, is_recording_folder
+from lib.utils import can_write_to_dir
+
+
+def get_min_free_bytes() -> int:
+    """
+    Returns:
+        int: Free bytes a recordings target needs to be used, RECORDINGS_MIN_FREE_MB defaults to 512 MB.
+    """
+    return int(float(os.environ.get('RECORDINGS_MIN_FREE_MB', 512)) * 1024 * 1024)
+
+
+def get_retention_max_bytes():
+    """
+    Returns:
+        int: Maximal bytes of recordings per target, None if unlimited.
+    """
+    if os.environ.get('RETENTION_MAX_GB'):
+        return int(float(os.environ['RETENTION_MAX_GB']) * 1024 * 1024 * 1024)
+    return None
+
+
+def get_retention_max_age():
+    """
+    Returns:
+        float: Maximal age of recordings in seconds, None if unlimited.
+    """
+    if os.environ.get('RETENTION_MAX_DAYS'):
+        return float(os.environ['RETENTION_MAX_DAYS']) * 24 * 60 * 60
+    return None
+
+
+def get_retention_min_free() -> bool:
+    """
+    Returns:
+        bool: True if the retention deletes the oldest chunks when a target has less than the minimal free space,
+            RETENTION_MIN_FREE defaults to off.
+    """
+    return os.environ.get('RETENTION_MIN_FREE', '0') not in ('0', '')
+
+
+class StorageTarget(object):
+    """
+    Cached state of a recordings base path.
+
+    Attributes:
+        path: The base path
+        writable: Result of the last write probe
+        free_bytes: Free bytes of the file system, updated by probes and writes
+        total_bytes: Size of the file system
+        bandwidth: Moving average of the write bandwidth in bytes per second, None if unknown
+        write_latency: Moving average of the seconds per write, None if unknown
+        max_write_latency: Longest write in seconds
+        write_errors: Number of reported write errors
+        stalls: Number of times a write stalled or the writes fell behind
+        probed_at: Time of the last probe, 0 forces a new probe
+    """
+
+    def __init__(self, path: str):
+        """ constructor """
+        self.path = path
+        self.writable = False
+        self.free_bytes = 0
+        self.total_bytes = 0
+        self.bandwidth = None
+        self.write_latency = None
+        self.max_write_latency = 0
+        self.write_errors = 0
+        self.stalls = 0
+        self.probed_at = 0
+
+    def get_status(self) -> dict:
+        """
+        Returns:
+            dict: The cached state of the target.
+        """
+        return {
+            'path': self.path,
+            'writable': self.writable,
+            'free_bytes': self.free_bytes,
+            'total_bytes': self.total_bytes,
+            'bandwidth': self.bandwidth,
+            'write_latency': self.write_latency,
+            'max_write_latency': self.max_write_latency,
+            'write_errors': self.write_errors,
+            'stalls': self.stalls,
+            'probed_at': self.probed_at,
+        }
+
+
+class StorageManager(object):
+    """
+    Selects the recordings target and frees space on the targets.
+
+    The targets are ranked by their cached free space and write bandwidth.
+    A target is only probed again, i.e. checked for write access and its
+    free space, after the probe interval or after a write error. A retention
+    thread deletes the oldest chunks when a target exceeds the maximal
+    bytes, the chunks exceed the maximal age or, if opted in, the free space
+    gets low. Only chunks in recording folders are ever deleted.
+
+    Attributes:
+        targets: The storage targets in configuration order
+        probe_interval: Seconds after which a target is probed again
+        min_free_bytes: Free bytes a target needs to be used
+        min_bandwidth: Targets with a lower measured write bandwidth in bytes per second are ranked last
+        retention_max_bytes: Maximal bytes of recordings per target, None if unlimited
+        retention_max_age: Maximal age of recordings in seconds, None if unlimited
+        retention_min_free: True if chunks are deleted while the free space is below the minimal free bytes
+        retention_interval: Seconds between two retention runs
+        on_delete: Callback that is invoked with the path of every chunk deleted by the retention
+    """
+
+    def __init__(self, base_paths: list, probe_interval: float = 60, min_free_bytes: int = None,
+                 min_bandwidth: float = 1024 * 1024, retention_max_bytes: int = None,
+                 retention_max_age: float = None, retention_min_free: bool = None, retention_interval: float = 60,
+                 disk_usage=shutil.disk_usage, can_write=can_write_to_dir):
+        """ constructor """
+        self.targets = [StorageTarget(path) for path in base_paths]
+        self.probe_interval = probe_interval
+        self.min_free_bytes = min_free_bytes if min_free_bytes is not None else get_min_free_bytes()
+        self.min_bandwidth = min_bandwidth
+        self.retention_max_bytes = retention_max_bytes if retention_max_bytes is not None \
+            else get_retention_max_bytes()
+        self.retention_max_age = retention_max_age if retention_max_age is not None else get_retention_max_age()
+        self.retention_min_free = retention_min_free if retention_min_free is not None \
+            else get_retention_min_free()
+        self.retention_interval = retention_interval
+        self.disk_usage = disk_usage
+        self.can_write = can_write
+        self.lock = threading.Lock()
+        self.retention_thread = None
+        self.protected_path = ''
+        self.on_delete = None
+
+    def get_target(self, path: str):
+        """
+        Returns:
+            StorageTarget: The target the path belongs to, None if it belongs to none.
+        """
+        path = os.path.abspath(path)
+        for target in self.targets:
+            base = os.path.abspath(target.path)
+            if path == base or path.startswith(base.rstrip(os.sep) + os.sep):
+                return target
+        return None
+
+    def probe(self, target: StorageTarget):
+        """Checks the write access and free space of the target."""
+        target.writable = self.can_write(target.path)
+        if target.writable:
+            try:
+                usage = self.disk_usage(target.path)
+                target.free_bytes = usage.free
+                target.total_bytes = usage.total
+            except OSError:
+                target.writable = False
+        target.probed_at = time.time()
+
+    def refresh(self):
+        """Probes all targets whose cached state is outdated."""
+        now = time.time()
+        for target in self.targets:
+            if now - target.probed_at > self.probe_interval:
+                self.probe(target)
+
+    def is_usable(self, target: StorageTarget) -> bool:
+        """
+        Returns:
+            bool: True if the target can be written and has enough free space.
+        """
+        return target.writable and target.free_bytes >= self.min_free_bytes
+
+    def get_ranked_targets(self) -> list:
+        """
+        Returns:
+            list: The usable targets, best first. Targets that are fast enough come first, then most free space.
+        """
+        with self.lock:
+            self.refresh()
+            usable = [target for target in self.targets if self.is_usable(target)]
+        return sorted(usable, key=lambda target: (
+            target.bandwidth is not None and target.bandwidth < self.min_bandwidth, -target.free_bytes))
+
+    def select_target(self):
+        """
+        Returns:
+            str: The base path of the best target, None if no target is usable.
+        """
+        ranked = self.get_ranked_targets()
+        if not ranked:
+            logging.warning('No usable recordings target')
+            return None
+        return ranked[0].path
+
+    def is_path_usable(self, path: str) -> bool:
+        """
+        Returns:
+            bool: True if the target of the path can still be used according to the cached state,
+                paths outside of the targets, e.g. the fallback path, are not managed and always usable.
+        """
+        target = self.get_target(path)
+        if target is None:
+            return True
+        with self.lock:
+            if time.time() - target.probed_at > self.probe_interval:
+                self.probe(target)
+        return self.is_usable(target)
+
+    def report_write(self, path: str, written_bytes: int, seconds: float):
+        """Updates the cached free space, bandwidth and latency of the target of the path after a write."""
+        target = self.get_target(path)
+        if target is None:
+            return
+        target.free_bytes -= written_bytes
+        target.write_latency = seconds if target.write_latency is None else 0.8 * target.write_latency + 0.2 * seconds
+        target.max_write_latency = max(target.max_write_latency, seconds)
+        if seconds > 0 and written_bytes > 0:
+            bandwidth = written_bytes / seconds
+            target.bandwidth = bandwidth if target.bandwidth is None else 0.8 * target.bandwidth + 0.2 * bandwidth
+
+    def report_write_error(self, path: str):
+        """Forces a new probe of the target of the path."""
+        target = self.get_target(path)
+        if target is None:
+            return
+        target.write_errors += 1
+        target.probed_at = 0
+        logging.warning('Write error on recordings target ' + target.path)
+
+    def report_stall(self, path: str):
+        """Ranks the target of the path last until its measured bandwidth recovers with the next writes."""
+        target = self.get_target(path)
+        if target is None:
+            return
+        target.stalls += 1
+        target.bandwidth = 0
+        logging.warning('Recordings target {} stalled'.format(target.path))
+
+    def start_retention(self, protected_path: str = ''):
+        """
+        Starts the retention thread if a retention policy is configured.
+
+        Args:
+            protected_path: Folder whose chunks are never deleted, e.g. the current recording.
+        """
+        self.protected_path = protected_path
+        if self.retention_thread is not None or not self.is_retention_enabled():
+            return
+        self.retention_thread = threading.Thread(target=self._retention_thread, daemon=True)
+        self.retention_thread.start()
+
+    def is_retention_enabled(self) -> bool:
+        """
+        Returns:
+            bool: True if a retention policy is configured.
+        """
+        return self.retention_max_bytes is not None or self.retention_max_age is not None or self.retention_min_free
+
+    def _retention_thread(self):
+        """Retention background thread."""
+        while True:
+            try:
+                self.enforce_retention()
+            except OSError as e:
+                logging.info(e)
+            time.sleep(self.retention_interval)
+
+    def enforce_retention(self) -> int:
+        """
+        Deletes the oldest chunks of all targets until the retention policy is met.
+
+        Returns:
+            int: The number of deleted chunks.
+        """
+        deleted = 0
+        for target in self.targets:
+            deleted += self.enforce_target_retention(target)
+        return deleted
+
+    def enforce_target_retention(self, target: StorageTarget) -> int:
+        """
+        Deletes the oldest chunks of the target until the retention policy is met.
+
+        Returns:
+            int: The number of deleted chunks.
+        """
+        chunks = list_chunks(target.path)
+        if not chunks:
+            return 0
+
+        total_bytes = sum(size for _, _, size in chunks)
+        try:
+            free_bytes = self.disk_usage(target.path).free
+        except OSError:
+            return 0
+
+        now = time.time()
+        protected = os.path.abspath(self.protected_path) + os.sep if self.protected_path else None
+        deleted = 0
+        for path, modified, size in chunks:
+            too_many_bytes = self.retention_max_bytes is not None and total_bytes > self.retention_max_bytes
+            too_old = self.retention_max_age is not None and now - modified > self.retention_max_age
+            too_little_space = self.retention_min_free and free_bytes < self.min_free_bytes
+            if not (too_many_bytes or too_old or too_little_space):
+                break
+            if protected and os.path.abspath(path).startswith(protected):
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.info(e)
+                continue
+            logging.info('Retention deleted ' + path)
+            if self.on_delete is not None:
+                self.on_delete(path)
+            total_bytes -= size
+            free_bytes += size
+            deleted += 1
+            remove_empty_folder(os.path.dirname(path), target.path)
+
+        target.free_bytes = free_bytes
+        return deleted
+
+    def get_status(self) -> list:
+        """
+        Returns:
+            list: The cached state of all targets.
+        """
+        return [target.get_status() for target in self.targets]
+
+
+def list_chunks(base_path: str) -> list:
+    """
+    Returns:
+        list: (path, modification time, size) of the chunks in the recording folders of the base path, oldest first.
+            Other folders, e.g. the timelapse archives, and other files are not subject to the retention.
+    """
+    chunks = []
+    try:
+        folders = [entry for entry in os.scandir(base_path) if entry.is_dir() and is_recording_folder(entry.name)]
+    except OSError:
+        return chunks
+    for folder in folders:
+        try:
+            for entry in os.scandir(folder.path):
+                if entry.is_file() and os.path.splitext(entry.name)[1] in CHUNK_EXTENSIONS:
+                    stat = entry.stat()
+                    chunks.append((entry.path, stat.st_mtime, stat.st_size))
+        except OSError:
+            continue
+    return sorted(chunks, key=lambda chunk: chunk[1])
+
+
+def remove_empty_folder(folder: str, base_path: str):
+    """Removes the recording folder if it is empty, the base path is never removed."""
+    if os.path.abspath(folder) == os.path.abspath(base_path):
+        return
+    try:
+        os.rmdir(folder)
+    except OSError:
+        pass
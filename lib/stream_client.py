@@ -0,0 +1,266 @@
+import errno
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Generator
+
+from lib import metrics
+from lib.mjpeg import KEEPALIVE_PART
+from lib.stream_tiers import FULL_QUALITY
+
+try:
+    from gevent import Timeout
+    from gevent.monkey import is_module_patched
+except ImportError:
+    Timeout = None
+
+client_ids = itertools.count(1)
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_stall_timeout() -> float:
+    """
+    Returns:
+        float: Seconds a client may take to consume a frame before it is disconnected.
+    """
+    if os.environ.get('STREAM_STALL_TIMEOUT'):
+        return float(os.environ['STREAM_STALL_TIMEOUT'])
+    return 10
+
+
+def get_resend_interval() -> float:
+    """
+    Returns:
+        float: Maximal seconds between two full frames if the image does not change,
+            STREAM_RESEND_INTERVAL defaults to 10.
+    """
+    if os.environ.get('STREAM_RESEND_INTERVAL'):
+        return float(os.environ['STREAM_RESEND_INTERVAL'])
+    return 10
+
+
+def get_keepalive_interval() -> float:
+    """
+    Returns:
+        float: Minimal seconds between two keepalives sent instead of unchanged frames,
+            STREAM_KEEPALIVE_INTERVAL defaults to 1.
+    """
+    if os.environ.get('STREAM_KEEPALIVE_INTERVAL'):
+        return float(os.environ['STREAM_KEEPALIVE_INTERVAL'])
+    return 1
+
+
+def start_stall_timer(seconds: float):
+    """
+    Under gunicorn with the gevent worker, the server writes the part in the greenlet of the generator.
+    The timer aborts a write that blocks longer than the seconds like a connection reset by the client.
+    The threaded development server has no such hook, the stall is detected once the write returned.
+
+    Returns:
+        Timeout: The started timer to cancel after the write, None if the server does not run on gevent.
+    """
+    if Timeout is None or not is_module_patched('socket'):
+        return None
+    timer = Timeout(seconds, ConnectionResetError(errno.ECONNRESET, 'Stream client stalled'))
+    timer.start()
+    return timer
+
+
+class StreamClient(object):
+    """
+    Delivery policy of a single MJPEG stream client.
+
+    The frames are taken from a frame source, i.e. the camera or a stream
+    tier, that provides next_frame(after_seq), subscribe() and unsubscribe().
+    The client is always sent the newest frame. Frames that were published
+    while the client was still consuming the previous one, or that exceed its
+    frame rate cap, are skipped and counted as dropped. A client that takes
+    longer than the stall timeout to consume a frame is disconnected.
+
+    A frame with the same image as the last one sent is not sent again
+    until the resend interval passed. A minimal keepalive is sent instead, at
+    most every keepalive interval, so idle streams cost next to no bandwidth.
+
+    Attributes:
+        id: Unique id of the client
+        source: The frame source of the client
+        address: Remote address of the client
+        max_fps: Maximal frames per second sent to the client, None is unlimited
+        stall_timeout: Seconds after which a client that did not consume a frame is disconnected
+        resend_interval: Maximal seconds between two full frames if the image does not change
+        keepalive_interval: Minimal seconds between two keepalives
+        sent: Number of frames sent to the client
+        dropped: Number of frames skipped for the client
+        unchanged: Number of frames not sent because their image did not change
+        keepalives: Number of keepalives sent to the client
+        acked: Number of frames acknowledged by the client, only WebSocket clients acknowledge frames
+        latency: Moving average of the seconds from the publication of a frame to its acknowledgement
+        last_seq: Sequence number of the last frame sent to the client
+    """
+
+    def __init__(self, source, address: str = '', max_fps: float = None, stall_timeout: float = None,
+                 resend_interval: float = None, keepalive_interval: float = None):
+        """ constructor """
+        self.id = next(client_ids)
+        self.source = source
+        self.address = address
+        self.max_fps = max_fps if max_fps and max_fps > 0 else None
+        self.stall_timeout = stall_timeout if stall_timeout is not None else get_stall_timeout()
+        self.resend_interval = resend_interval if resend_interval is not None else get_resend_interval()
+        self.keepalive_interval = keepalive_interval if keepalive_interval is not None \
+            else get_keepalive_interval()
+        self.connected_at = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.unchanged = 0
+        self.keepalives = 0
+        self.acked = 0
+        self.latency = None
+        self.last_seq = 0
+        self.last_content_seq = 0
+        self.last_frame_sent_at = 0
+        self.last_sent_at = 0
+        self.last_send_duration = 0
+        self.sending_keepalive = False
+
+    def frames(self) -> Generator[bytes, None, None]:
+        """
+        Returns:
+            Generator[bytes, None, None]: The multipart parts of the frames sent to the client.
+        """
+        self.register()
+        try:
+            while True:
+                time.sleep(self.get_throttle_delay())
+
+                frame = self.source.next_frame(after_seq=self.last_seq)
+                if frame is None:
+                    continue
+                part = self.accept(frame)
+                if part is None:
+                    continue
+
+                # the generator resumes once the server has written the part to the client
+                timer = start_stall_timer(self.stall_timeout)
+                try:
+                    yield part
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+
+                if not self.sent_frame():
+                    return
+        finally:
+            self.unregister()
+
+    def register(self):
+        """Adds the client to the connected clients."""
+        self.source.subscribe()
+        with clients_lock:
+            clients[self.id] = self
+        logging.info('Stream client {} connected'.format(self.id))
+
+    def unregister(self):
+        """Removes the client from the connected clients."""
+        with clients_lock:
+            clients.pop(self.id, None)
+        self.source.unsubscribe()
+        logging.info('Stream client {} disconnected'.format(self.id))
+
+    def get_throttle_delay(self) -> float:
+        """
+        Returns:
+            float: Seconds to wait before the next frame is taken to respect the frame rate cap.
+        """
+        if not self.max_fps:
+            return 0
+        return max(0.0, self.last_sent_at + 1 / self.max_fps - time.time())
+
+    def accept(self, frame) -> bytes:
+        """
+        Marks the frame as the latest one of the client and counts the frames skipped since the last one.
+
+        Returns:
+            bytes: The part of the frame, the keepalive if the image did not change, None if nothing is sent.
+        """
+        if self.last_seq:
+            self.dropped += frame.seq - self.last_seq - 1
+        self.last_seq = frame.seq
+        now = time.time()
+
+        part = frame.part
+        if frame.content_seq == self.last_content_seq and now - self.last_frame_sent_at < self.resend_interval:
+            self.unchanged += 1
+            if now - self.last_sent_at < self.keepalive_interval:
+                return None
+            part = KEEPALIVE_PART
+        else:
+            self.last_content_seq = frame.content_seq
+            self.last_frame_sent_at = now
+
+        self.sending_keepalive = part is KEEPALIVE_PART
+        self.last_sent_at = now
+        return part
+
+    def sent_frame(self) -> bool:
+        """
+        Invoked after the accepted frame or the keepalive has been written to the client.
+
+        Returns:
+            bool: False if the client stalled and has to be disconnected.
+        """
+        self.last_send_duration = time.time() - self.last_sent_at
+        if self.sending_keepalive:
+            self.keepalives += 1
+        else:
+            self.sent += 1
+        if metrics.enabled and not self.sending_keepalive:
+            metrics.client_send_seconds.observe(self.last_send_duration,
+                                                (getattr(self.source, 'name', FULL_QUALITY),))
+        if self.last_send_duration > self.stall_timeout:
+            logging.info('Stream client {} stalled for {:.1f} s, disconnecting'.format(
+                self.id, self.last_send_duration))
+            return False
+        return True
+
+    def acknowledged(self, timestamp: float):
+        """Invoked when the client acknowledged the frame published at the timestamp."""
+        latency = time.time() - timestamp
+        self.acked += 1
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+        if metrics.enabled:
+            metrics.client_ack_seconds.observe(latency, (getattr(self.source, 'name', FULL_QUALITY),))
+
+    def get_stats(self) -> dict:
+        """
+        Returns:
+            dict: The delivery statistics of the client.
+        """
+        return {
+            'id': self.id,
+            'address': self.address,
+            'camera': getattr(self.source, 'camera_id', None),
+            'quality': getattr(self.source, 'name', FULL_QUALITY),
+            'max_fps': self.max_fps,
+            'connected_at': self.connected_at,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'unchanged': self.unchanged,
+            'keepalives': self.keepalives,
+            'acked': self.acked,
+            'latency': self.latency,
+            'last_seq': self.last_seq,
+            'last_send_duration': self.last_send_duration,
+        }
+
+
+def get_client_stats() -> list:
+    """
+    Returns:
+        list: The delivery statistics of all connected stream clients.
+    """
+    with clients_lock:
+        return [client.get_stats() for client in clients.values()]
@@ -0,0 +1,165 @@
+import logging
+import threading
+
+from lib.camera_base import encode_budget
+from lib.frame_broadcaster import FrameBroadcaster, Frame
+from lib.mjpeg import encode_part
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+FULL_QUALITY = 'full'
+
+# quality -> (width, JPG quality)
+TIERS = {
+    'low': (320, 50),
+    'medium': (640, 70),
+}
+
+REDUCED_DECODE_FLAGS = {
+    8: 'IMREAD_REDUCED_COLOR_8',
+    4: 'IMREAD_REDUCED_COLOR_4',
+    2: 'IMREAD_REDUCED_COLOR_2',
+}
+
+
+class StreamTier(object):
+    """
+    A downscaled variant of the camera stream.
+
+    Every camera frame is resized and re-encoded once and shared by all
+    subscribers of the tier. Unchanged camera frames are not re-encoded.
+    The tier thread only runs while at least one client is subscribed, so
+    idle tiers cost nothing.
+
+    Attributes:
+        camera_id: The id of the camera
+        name: The quality name of the tier
+        width: Width of the resized frames, the height keeps the aspect ratio
+        jpeg_quality: JPG quality of the re-encoded frames
+        broadcaster: The resized frames are published here by the tier thread
+        subscribers: Number of subscribed clients
+    """
+
+    def __init__(self, camera, name: str, width: int, jpeg_quality: int):
+        """ constructor """
+        self.camera = camera
+        self.camera_id = camera.camera_id
+        self.name = name
+        self.width = width
+        self.jpeg_quality = jpeg_quality
+        self.broadcaster = FrameBroadcaster()
+        self.subscribers = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.source_width = 0
+        self.resized = None
+
+    def subscribe(self):
+        """Registers a client and starts the tier thread if it isn't running yet."""
+        with self.lock:
+            self.subscribers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._thread, daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self):
+        """Unregisters a client, the tier thread stops after the last one left."""
+        with self.lock:
+            self.subscribers = max(0, self.subscribers - 1)
+
+    def next_frame(self, after_seq: int = None) -> Frame:
+        """
+        Returns:
+            Frame: The newest resized frame, None if it did not arrive in time.
+        """
+        return self.broadcaster.wait_for_frame(after_seq=after_seq, timeout=10)
+
+    def transcode(self, jpeg: bytes) -> bytes:
+        """
+        Resizes and re-encodes a camera frame.
+
+        Returns:
+            bytes: The JPG encoded resized frame.
+        """
+        flags = cv2.IMREAD_COLOR
+        for factor, flag in REDUCED_DECODE_FLAGS.items():
+            if self.source_width and self.source_width // factor >= self.width:
+                flags = getattr(cv2, flag)
+                break
+
+        with encode_budget:
+            image = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), flags)
+            if image is None:
+                return jpeg
+            if flags == cv2.IMREAD_COLOR:
+                self.source_width = image.shape[1]
+            if self.source_width <= self.width:
+                return jpeg
+
+            height = max(1, round(image.shape[0] * self.width / image.shape[1]))
+            if self.resized is None or self.resized.shape[:2] != (height, self.width):
+                self.resized = None
+            self.resized = cv2.resize(image, (self.width, height), dst=self.resized, interpolation=cv2.INTER_AREA)
+            return cv2.imencode('.jpg', self.resized, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])[1].tobytes()
+
+    def _thread(self):
+        """Tier background thread."""
+        logging.info('Starting {} quality stream tier'.format(self.name))
+        last_seq = 0
+        last_content_seq = 0
+        data = None
+        while True:
+            with self.lock:
+                if self.subscribers == 0:
+                    self.thread = None
+                    break
+
+            frame = self.camera.next_frame(after_seq=last_seq)
+            if frame is None:
+                continue
+            last_seq = frame.seq
+            if frame.content_seq == last_content_seq and data is not None:
+                # the image did not change, the resized frame is published again without transcoding
+                self.broadcaster.publish(data)
+                continue
+            try:
+                data = self.transcode(frame.data)
+            except cv2.error as e:
+                logging.info(e)
+                continue
+            last_content_seq = frame.content_seq
+            self.broadcaster.publish(data, encode_part(data))
+        logging.info('Stopped {} quality stream tier'.format(self.name))
+
+
+tiers = {}
+tiers_lock = threading.Lock()
+
+
+def get_stream_tier(camera, quality: str):
+    """
+    Returns:
+        StreamTier: The stream tier of the given quality of the camera, None for the full quality stream
+            or if OpenCV is not available for resizing.
+
+    Raises:
+        ValueError: If the quality is unknown.
+    """
+    if quality == FULL_QUALITY:
+        return None
+    if quality not in TIERS:
+        raise ValueError('Unknown stream quality: ' + str(quality))
+    if cv2 is None:
+        logging.warning('OpenCV is not available, streaming {} quality as full quality'.format(quality))
+        return None
+
+    key = (camera.camera_id, quality)
+    with tiers_lock:
+        if key not in tiers:
+            width, jpeg_quality = TIERS[quality]
+            tiers[key] = StreamTier(camera, quality, width, jpeg_quality)
+        return tiers[key]
@@ -0,0 +1,299 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from datetime import datetime
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+TIMELAPSE_FOLDER = 'timelapse'
+DAY_FORMAT = '%Y_%m_%d'
+DAY_PATTERN = re.compile(r'^\d{4}_\d{2}_\d{2}$')
+
+# timestamp, offset in the pack file and length of one frame
+INDEX_ENTRY = struct.Struct('<dQI')
+
+
+def get_timelapse_interval() -> float:
+    """
+    Returns:
+        float: Seconds between two timelapse frames, TIMELAPSE_INTERVAL defaults to 0, i.e. no timelapse.
+    """
+    return float(os.environ.get('TIMELAPSE_INTERVAL') or 0)
+
+
+class TimelapseArchive(object):
+    """
+    The timelapse frames of one day.
+
+    The JPG frames are appended to a pack file, a fixed size entry with the
+    timestamp, offset and length of every frame is appended to an index
+    file. The n-th frame is read via a memory map of both files. A frame is
+    only visible after its index entry was written. What a crash left behind,
+    i.e. a partial index entry, entries of frames that did not completely
+    reach the pack and frame bytes without entry, is dropped before the
+    next append.
+
+    Attributes:
+        pack_path: The path of the pack file
+        index_path: The path of the index file
+    """
+
+    def __init__(self, path: str):
+        """ constructor """
+        self.pack_path = path + '.pack'
+        self.index_path = path + '.idx'
+        self.lock = threading.Lock()
+        self.pack = None
+        self.index = None
+        self.pack_map = None
+        self.index_map = None
+
+    def append(self, timestamp: float, data: bytes):
+        """Appends a frame to the archive."""
+        with self.lock:
+            if self.pack is None:
+                self.open_for_append()
+            offset = self.pack.tell()
+            self.pack.write(data)
+            self.pack.flush()
+            self.index.write(INDEX_ENTRY.pack(timestamp, offset, len(data)))
+            self.index.flush()
+
+    def open_for_append(self):
+        """Opens the files for appending and drops the incomplete frames of a crash."""
+        os.makedirs(os.path.dirname(self.pack_path), exist_ok=True)
+        self.pack = open(self.pack_path, 'ab')
+        self.index = open(self.index_path, 'a+b')
+        pack_size = self.pack.tell()
+        count = self.index.tell() // INDEX_ENTRY.size
+        end = 0
+        while count:
+            self.index.seek((count - 1) * INDEX_ENTRY.size)
+            _, offset, length = INDEX_ENTRY.unpack(self.index.read(INDEX_ENTRY.size))
+            if offset + length <= pack_size:
+                end = offset + length
+                break
+            count -= 1
+        self.index.truncate(count * INDEX_ENTRY.size)
+        self.pack.truncate(end)
+        # the positions of append mode files are not moved by truncate
+        self.index.seek(0, os.SEEK_END)
+        self.pack.seek(0, os.SEEK_END)
+
+    def __len__(self) -> int:
+        try:
+            return os.path.getsize(self.index_path) // INDEX_ENTRY.size
+        except OSError:
+            return 0
+
+    @staticmethod
+    def remap(path: str, current: mmap.mmap, required: int):
+        """
+        Returns:
+            mmap.mmap: The current map if it covers the required bytes, else a new map of the whole file.
+        """
+        if current is not None and len(current) >= required:
+            return current
+        if current is not None:
+            current.close()
+        with open(path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get_entries(self, start: int = 0, stop: int = None) -> list:
+        """
+        Returns:
+            list: (index, timestamp, length) of the frames in the range.
+        """
+        count = len(self)
+        stop = count if stop is None else min(stop, count)
+        if start >= stop:
+            return []
+        with self.lock:
+            self.index_map = self.remap(self.index_path, self.index_map, stop * INDEX_ENTRY.size)
+            entries = []
+            for index in range(start, stop):
+                timestamp, _, length = INDEX_ENTRY.unpack_from(self.index_map, index * INDEX_ENTRY.size)
+                entries.append((index, timestamp, length))
+            return entries
+
+    def read_frame(self, index: int):
+        """
+        Returns:
+            tuple: The timestamp and the JPG data of the frame, None if there is no such frame.
+        """
+        if index < 0 or index >= len(self):
+            return None
+        with self.lock:
+            self.index_map = self.remap(self.index_path, self.index_map, (index + 1) * INDEX_ENTRY.size)
+            timestamp, offset, length = INDEX_ENTRY.unpack_from(self.index_map, index * INDEX_ENTRY.size)
+            self.pack_map = self.remap(self.pack_path, self.pack_map, offset + length)
+            return timestamp, self.pack_map[offset:offset + length]
+
+    def close(self):
+        with self.lock:
+            for file in (self.pack, self.index, self.pack_map, self.index_map):
+                if file is not None:
+                    file.close()
+            self.pack = self.index = self.pack_map = self.index_map = None
+
+
+archives = {}
+archives_lock = threading.Lock()
+
+
+def get_archive(path: str) -> TimelapseArchive:
+    """
+    Returns:
+        TimelapseArchive: The shared archive at the path without extension, so the memory maps are reused.
+    """
+    path = os.path.abspath(path)
+    with archives_lock:
+        if path not in archives:
+            archives[path] = TimelapseArchive(path)
+        return archives[path]
+
+
+def find_archive(base_paths: list, day: str):
+    """
+    Returns:
+        TimelapseArchive: The archive of the day in the recordings base paths, None if there is none.
+    """
+    if not DAY_PATTERN.match(day):
+        return None
+    for base_path in base_paths:
+        path = os.path.join(base_path, TIMELAPSE_FOLDER, day)
+        if os.path.isfile(path + '.idx'):
+            return get_archive(path)
+    return None
+
+
+def list_days(base_paths: list) -> list:
+    """
+    Returns:
+        list: The day, number of frames, first and last timestamp of all archives in the base paths.
+    """
+    days = []
+    for base_path in base_paths:
+        try:
+            names = os.listdir(os.path.join(base_path, TIMELAPSE_FOLDER))
+        except OSError:
+            continue
+        for name in names:
+            day, extension = os.path.splitext(name)
+            if extension != '.idx' or not DAY_PATTERN.match(day):
+                continue
+            archive = get_archive(os.path.join(base_path, TIMELAPSE_FOLDER, day))
+            count = len(archive)
+            if count == 0:
+                continue
+            first, last = archive.get_entries(0, 1)[0], archive.get_entries(count - 1)[0]
+            days.append({'day': day, 'frames': count, 'start': first[1], 'end': last[1]})
+    return sorted(days, key=lambda entry: entry['day'])
+
+
+def make_thumbnail(jpeg: bytes, factor: int = 4, jpeg_quality: int = 60) -> bytes:
+    """
+    Returns:
+        bytes: The JPG decoded downscaled by the factor and encoded again, the original without OpenCV.
+    """
+    if cv2 is None:
+        return jpeg
+    flag = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}[factor]
+    image = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), flag)
+    if image is None:
+        return jpeg
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes()
+
+
+class Timelapse(object):
+    """
+    Samples a frame of the camera every interval into the archive of the day.
+
+    The latest frame of the camera is used if it is recent, otherwise the
+    camera thread is woken up. The archive is rotated at midnight to the
+    best recordings target.
+
+    Attributes:
+        camera: The sampled camera
+        recordings_folder: Selects the recordings target of the archives
+        interval: Seconds between two frames
+        archive: The archive of the current day
+        frames: Number of frames sampled since the start
+    """
+
+    def __init__(self, camera, recordings_folder, interval: float):
+        """ constructor """
+        self.camera = camera
+        self.recordings_folder = recordings_folder
+        self.interval = interval
+        self.day = ''
+        self.archive = None
+        self.frames = 0
+        self.last_sample = 0
+        self.thread = None
+
+    def start(self):
+        """Starts the sampling thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._thread, daemon=True)
+            self.thread.start()
+
+    def get_archive(self, timestamp: float) -> TimelapseArchive:
+        """
+        Returns:
+            TimelapseArchive: The archive of the day of the timestamp.
+        """
+        day = datetime.fromtimestamp(timestamp).strftime(DAY_FORMAT)
+        if day != self.day:
+            if self.archive is not None:
+                self.archive.close()
+            base_path = self.recordings_folder.select_base_path()
+            self.archive = get_archive(os.path.join(base_path, TIMELAPSE_FOLDER, day))
+            self.day = day
+            logging.info('Timelapse to ' + self.archive.pack_path)
+        return self.archive
+
+    def sample(self):
+        """Appends the current frame of the camera to the archive."""
+        frame = self.camera.get_snapshot(max_age=min(1.0, self.interval / 2))
+        if frame is None:
+            logging.info('No frame for the timelapse')
+            return
+        self.get_archive(frame.timestamp).append(frame.timestamp, frame.data)
+        self.frames += 1
+        self.last_sample = frame.timestamp
+
+    def _thread(self):
+        """Timelapse background thread."""
+        logging.info('Starting timelapse every {} s'.format(self.interval))
+        deadline = time.time()
+        while True:
+            try:
+                self.sample()
+            except OSError as e:
+                logging.warning('Timelapse failed: {}'.format(e))
+                self.day = ''
+
+            # sample on a fixed grid, even if a sample took long
+            deadline = max(deadline + self.interval, time.time())
+            time.sleep(max(0.0, deadline - time.time()))
+
+    def get_status(self) -> dict:
+        """
+        Returns:
+            dict: The state of the timelapse.
+        """
+        return {
+            'interval': self.interval,
+            'archive': self.archive.pack_path if self.archive else None,
+            'frames': self.frames,
+            'last_sample': self.last_sample,
+        }
@@ -154,6 +154,14 @@ def expand_glob(path: str):
         return [path, ]
 
 
+def read_password() -> str:
+    """
+    Reads the password for the recording control from the .password file in the project root.
+    """
+    with open(os.path.join(dirname(dirname(__file__)), '.password')) as password_file:
+        return password_file.read().strip()
+
+
 def get_project_path():
     """
     Returns the path to the src files
@@ -0,0 +1,8 @@
+#!/bin/bash
+
+script_path='/home/pi/Repositories/CameraPi/'
+venv_path=$script_path'venv'
+virtualenv --python=/usr/bin/python3.7 $venv_path
+source $venv_path'/bin/activate'
+pip install -r $script_path'requirements.txt'
+CAMERA=pi RECORDINGS=/mnt/* uvicorn --host 0.0.0.0 --port 9090 --app-dir $script_path lib.asgi:app
@@ -0,0 +1,269 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from lib.camera_mock import Camera as MockCamera
+from lib.camera_registry import CameraRegistry, parse_camera_configs
+from lib.chunk_stream import find_chunk
+from lib.timelapse import TIMELAPSE_FOLDER, TimelapseArchive
+from lib.utils import file_date_format_string
+
+CAMERA_IDS = ('front', 'back')
+PASSWORD = 'secret'
+
+
+def stop_cameras(registry: CameraRegistry):
+    """Suspends the camera threads, they are no daemons."""
+    for camera in registry.get_cameras():
+        if camera.is_recording():
+            camera.stop_recording()
+        camera.idle_timeout = 0
+        camera.last_access = 0
+        thread = camera.thread
+        if thread is not None:
+            thread.join(timeout=5)
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    monkeypatch.setenv('RECORDINGS', str(tmp_path))
+    monkeypatch.setenv('CAMERAS', ','.join(camera_id + ':mock' for camera_id in CAMERA_IDS))
+    monkeypatch.setenv('TIMELAPSE_INTERVAL', '0')
+    monkeypatch.setenv('PRE_EVENT_SECONDS', '0')
+    # the mock camera module read its configuration on import
+    monkeypatch.setattr(MockCamera, 'fps', 30)
+    monkeypatch.setattr(MockCamera, 'static', False)
+    monkeypatch.setattr(MockCamera, 'scene_seconds', 0)
+
+    from lib import api
+    registry = CameraRegistry(parse_camera_configs(os.environ['CAMERAS']))
+    monkeypatch.setattr(api, 'registry', registry)
+    monkeypatch.setattr(api, 'password', PASSWORD)
+    # the cameras are created on demand, see test_starts_the_cameras_on_the_first_request
+    monkeypatch.setattr(api, 'cameras_started', True)
+    yield api
+    stop_cameras(registry)
+
+
+def read_parts(response, count: int) -> list:
+    parts = []
+    for part in response.response:
+        parts.append(part)
+        if len(parts) == count:
+            break
+    return parts
+
+
+def test_streams_two_cameras_concurrently(api):
+    client = api.provider.test_client()
+    connected = threading.Barrier(len(CAMERA_IDS) + 1, timeout=10)
+    parts = {}
+    errors = []
+
+    def stream(camera_id: str):
+        response = client.get('/camerapi/{}/stream/'.format(camera_id), buffered=False)
+        try:
+            parts[camera_id] = read_parts(response, 1)
+            connected.wait()
+            # both streams stay open while the other camera delivers its frames
+            parts[camera_id] += read_parts(response, 4)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            response.close()
+
+    threads = [threading.Thread(target=stream, args=(camera_id,)) for camera_id in CAMERA_IDS]
+    for thread in threads:
+        thread.start()
+    connected.wait()
+    clients = client.get('/camerapi/clients').get_json()['clients']
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert not errors
+    assert sorted(stats['camera'] for stats in clients) == sorted(CAMERA_IDS)
+    for camera_id in CAMERA_IDS:
+        assert len(parts[camera_id]) == 5
+        assert all(part.startswith(b'--frame\r\nContent-Type: image/jpeg') for part in parts[camera_id])
+        status = client.get('/camerapi/{}/status'.format(camera_id)).get_json()
+        assert status['camera'] == camera_id
+    assert client.get('/camerapi/clients').get_json()['clients'] == []
+    assert client.get('/camerapi/unknown/stream/').status_code == 404
+
+
+def test_import_does_not_start_the_cameras():
+    result = subprocess.run([sys.executable, '-c', 'import threading, lib.api; '
+                             'print(lib.api.registry.cameras, [thread.name for thread in threading.enumerate()])'],
+                            env=dict(os.environ, CAMERA='mock'), stdout=subprocess.PIPE, timeout=30, check=True)
+    assert result.stdout.decode().strip() == "{} ['MainThread']"
+
+
+def test_starts_the_cameras_on_the_first_request(api, monkeypatch):
+    monkeypatch.setattr(api, 'cameras_started', False)
+    assert not api.registry.cameras
+    client = api.provider.test_client()
+
+    assert client.get('/camerapi/health').status_code == 200
+    deadline = time.time() + 10
+    while len(api.registry.cameras) < len(CAMERA_IDS) and time.time() < deadline:
+        time.sleep(0.05)
+
+    assert sorted(api.registry.cameras) == sorted(CAMERA_IDS)
+    assert api.cameras_started
+
+
+def test_records_into_the_subdirectory_of_the_camera(api, tmp_path):
+    client = api.provider.test_client()
+
+    assert not client.post('/camerapi/front/start_recording', json={'password': 'wrong'}).get_json()['success']
+    assert client.post('/camerapi/front/start_recording', json={'password': PASSWORD}).get_json()['success']
+    camera = api.registry.get('front')
+    first_frame = camera.broadcaster.wait_for_frame(after_seq=0, timeout=5)
+    assert camera.broadcaster.wait_for_frame(after_seq=first_frame.seq + 2, timeout=5)
+    assert client.post('/camerapi/front/stop_recording', json={'password': PASSWORD}).get_json()['success']
+    camera.recorder.thread.join(timeout=5)
+
+    chunks = client.get('/camerapi/front/recordings').get_json()['chunks']
+    assert chunks
+    assert all(chunk['path'].startswith(os.path.join(str(tmp_path), 'front')) for chunk in chunks)
+    assert client.get('/camerapi/back/recordings').get_json()['chunks'] == []
+
+
+def write_session(base_path: str, session: str, chunks: list) -> list:
+    """
+    Writes the chunks of a recording session, the index is rebuilt from them.
+
+    Args:
+        chunks: (start, end, data) of the chunks.
+
+    Returns:
+        list: The paths of the chunks.
+    """
+    paths = []
+    for start, end, data in chunks:
+        path = os.path.join(base_path, session, datetime.fromtimestamp(start).strftime(file_date_format_string) + '.mjpeg')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(data)
+        os.utime(path, (end, end))
+        paths.append(path)
+    return paths
+
+
+def test_lists_the_recordings_that_overlap_the_time_range(api, tmp_path):
+    client = api.provider.test_client()
+    start = datetime(2021, 5, 1, 12).timestamp()
+    paths = write_session(str(tmp_path / 'front'), '2021_05_01_12_00_00',
+                          [(start + offset, start + offset + 60, b'chunk') for offset in (0, 60, 120)])
+
+    def query(**times) -> list:
+        response = client.get('/camerapi/front/recordings', query_string=times)
+        return [chunk['path'] for chunk in response.get_json()['chunks']]
+
+    assert query() == paths
+    assert query(**{'from': start + 90}) == paths[1:]
+    assert query(to=start + 30) == paths[:1]
+    assert query(**{'from': '2021-05-01T12:01:30', 'to': '2021-05-01T12:02:30'}) == paths[1:]
+    assert client.get('/camerapi/front/recordings?from=noon').status_code == 400
+
+
+def test_serves_byte_ranges_of_a_chunk(api, tmp_path):
+    client = api.provider.test_client()
+    data = bytes(range(256)) * 4
+    path, = write_session(str(tmp_path / 'front'), '2021_05_01_12_00_00',
+                          [(datetime(2021, 5, 1, 12).timestamp(), datetime(2021, 5, 1, 12, 1).timestamp(), data)])
+    url = '/camerapi/front/recordings/2021_05_01_12_00_00/' + os.path.basename(path)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.get_data() == data
+
+    response = client.get(url, headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 10-19/1024'
+    assert response.get_data() == data[10:20]
+
+    response = client.get(url, headers={'Range': 'bytes=-100'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 924-1023/1024'
+    assert response.get_data() == data[-100:]
+
+    response = client.get(url, headers={'Range': 'bytes=2000-2100'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */1024'
+
+    assert client.get('/camerapi/front/recordings/2021_05_01_12_00_00/missing.mjpeg').status_code == 404
+
+
+def test_rejects_chunk_paths_outside_of_the_recordings(tmp_path):
+    base_path = str(tmp_path / 'front')
+    path, = write_session(base_path, '2021_05_01_12_00_00', [(0, 60, b'chunk')])
+    secret, = write_session(str(tmp_path), 'back', [(0, 60, b'secret')])
+    name = os.path.basename(path)
+
+    assert find_chunk([base_path], '2021_05_01_12_00_00', name) == os.path.realpath(path)
+    assert find_chunk([base_path], '..', os.path.join('back', name)) is None
+    assert find_chunk([base_path], '../back', name) is None
+    assert find_chunk([base_path], '2021_05_01_12_00_00', '../../back/' + name) is None
+    assert find_chunk([base_path], '2021_05_01_12_00_00', 'notes.txt') is None
+    assert os.path.exists(secret)
+
+
+def test_concatenates_the_chunks_of_the_time_range(api, tmp_path):
+    client = api.provider.test_client()
+    start = datetime(2021, 5, 1, 12).timestamp()
+    chunks = [(start + offset, start + offset + 60, bytes([index]) * (100 + index))
+              for index, offset in enumerate((0, 60, 120))]
+    write_session(str(tmp_path / 'front'), '2021_05_01_12_00_00', chunks)
+    joined = b''.join(data for _, _, data in chunks)
+
+    response = client.get('/camerapi/front/recordings/concatenated')
+    assert response.status_code == 200
+    assert response.mimetype == 'video/x-motion-jpeg'
+    assert response.get_data() == joined
+
+    response = client.get('/camerapi/front/recordings/concatenated', query_string={'from': start + 90})
+    assert response.get_data() == joined[100:]
+
+    # the range crosses the boundary of the first two chunks
+    response = client.get('/camerapi/front/recordings/concatenated', headers={'Range': 'bytes=95-105'})
+    assert response.status_code == 206
+    assert response.get_data() == joined[95:106]
+
+    assert client.get('/camerapi/front/recordings/concatenated', query_string={'to': start - 60}).status_code == 404
+
+
+def test_pages_and_renders_the_timelapse(api, tmp_path):
+    cv2 = pytest.importorskip('cv2')
+    np = pytest.importorskip('numpy')
+    client = api.provider.test_client()
+    jpeg = cv2.imencode('.jpg', np.full((64, 96, 3), 128, dtype=np.uint8))[1].tobytes()
+    archive = TimelapseArchive(os.path.join(str(tmp_path), 'front', TIMELAPSE_FOLDER, '2021_05_01'))
+    for index in range(5):
+        archive.append(1000 + index, jpeg)
+    archive.close()
+
+    days = client.get('/camerapi/front/timelapse').get_json()['days']
+    assert [(day['day'], day['frames']) for day in days] == [('2021_05_01', 5)]
+    assert client.get('/camerapi/back/timelapse').get_json()['days'] == []
+
+    page = client.get('/camerapi/front/timelapse/2021_05_01?page=1&per_page=2').get_json()
+    assert page['total'] == 5
+    assert [frame['index'] for frame in page['frames']] == [2, 3]
+    assert client.get('/camerapi/front/timelapse/2021_05_01?page=2&per_page=2').get_json()['frames'][0]['index'] == 4
+    assert client.get('/camerapi/front/timelapse/2021_05_02').status_code == 404
+
+    assert client.get(page['frames'][0]['url']).get_data() == jpeg
+    thumbnail = cv2.imdecode(np.frombuffer(client.get(page['frames'][0]['thumbnail']).get_data(), dtype=np.uint8),
+                             cv2.IMREAD_COLOR)
+    assert thumbnail.shape == (16, 24, 3)
+    assert client.get('/camerapi/front/timelapse/2021_05_01/5').status_code == 404
+
+    rendered = client.get('/camerapi/front/timelapse/2021_05_01/render?fps=1000&start=1&stop=4').get_data()
+    assert rendered.count(jpeg) == 3
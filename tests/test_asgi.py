@@ -0,0 +1,139 @@
+import asyncio
+import json
+
+from lib.asgi import CameraApp, WEBSOCKET_HEADER, handle_websocket_ack
+from lib.frame_broadcaster import FrameBroadcaster
+from lib.mjpeg import encode_part
+from lib.stream_client import StreamClient
+
+
+class FakeCamera(object):
+    """Frame source whose frames are published by the test."""
+
+    camera_id = 'fake'
+
+    def __init__(self):
+        """ constructor """
+        self.broadcaster = FrameBroadcaster()
+        self.subscribers = 0
+
+    def publish(self, jpeg: bytes):
+        self.broadcaster.publish(jpeg, encode_part(jpeg))
+
+    def subscribe(self):
+        self.subscribers += 1
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+
+
+class FakeWebSocket(object):
+    """The ASGI receive and send of a WebSocket connection."""
+
+    def __init__(self):
+        """ constructor """
+        self.received = asyncio.Queue()
+        self.received.put_nowait({'type': 'websocket.connect'})
+        self.sent = []
+
+    async def receive(self) -> dict:
+        return await self.received.get()
+
+    async def send(self, message: dict):
+        self.sent.append(message)
+
+    def ack(self, seq: int):
+        self.received.put_nowait({'type': 'websocket.receive', 'text': json.dumps({'ack': seq})})
+
+    def disconnect(self):
+        self.received.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+
+    def get_frames(self) -> list:
+        """
+        Returns:
+            list: The sequence number and the JPG of every sent frame.
+        """
+        return [(WEBSOCKET_HEADER.unpack_from(message['bytes'])[0], message['bytes'][WEBSOCKET_HEADER.size:])
+                for message in self.sent if message['type'] == 'websocket.send']
+
+
+async def wait_until(condition, timeout: float = 5):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_event_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def start_feed(camera: FakeCamera, websocket: FakeWebSocket, query: bytes) -> asyncio.Future:
+    scope = {'type': 'websocket', 'path': '/camerapi/ws', 'query_string': query, 'client': ('127.0.0.1', 1)}
+    return asyncio.ensure_future(CameraApp().websocket_feed(camera, scope, websocket.receive, websocket.send))
+
+
+def test_cumulative_acknowledgements():
+    client = StreamClient(FakeCamera())
+    in_flight = {1: 10.0, 2: 11.0, 3: 12.0}
+
+    assert handle_websocket_ack(client, {'type': 'websocket.receive', 'text': '{"ack": 2}'}, in_flight)
+    assert in_flight == {3: 12.0}
+    assert client.acked == 1
+    assert handle_websocket_ack(client, {'type': 'websocket.receive', 'text': 'no json'}, in_flight)
+    assert in_flight == {3: 12.0}
+    assert not handle_websocket_ack(client, {'type': 'websocket.disconnect'}, in_flight)
+
+
+def test_sends_at_most_the_window_and_then_the_newest_frame():
+    async def run():
+        camera = FakeCamera()
+        websocket = FakeWebSocket()
+        feed = start_feed(camera, websocket, b'window=2')
+        await wait_until(lambda: camera.subscribers == 1)
+
+        for seq in (1, 2):
+            camera.publish(b'jpg%d' % seq)
+            await wait_until(lambda: len(websocket.get_frames()) == seq)
+        # the window is full, the frames are not sent but replaced by newer ones
+        camera.publish(b'jpg3')
+        camera.publish(b'jpg4')
+        await asyncio.sleep(0.1)
+        assert websocket.get_frames() == [(1, b'jpg1'), (2, b'jpg2')]
+
+        websocket.ack(2)
+        await wait_until(lambda: len(websocket.get_frames()) == 3)
+        assert websocket.get_frames()[-1] == (4, b'jpg4')
+
+        websocket.disconnect()
+        await asyncio.wait_for(feed, 5)
+        assert camera.subscribers == 0
+        assert websocket.sent[0] == {'type': 'websocket.accept'}
+
+    asyncio.run(run())
+
+
+def test_disconnects_a_client_that_does_not_acknowledge(monkeypatch):
+    monkeypatch.setenv('STREAM_STALL_TIMEOUT', '0.2')
+
+    async def run():
+        camera = FakeCamera()
+        websocket = FakeWebSocket()
+        feed = start_feed(camera, websocket, b'')
+        await wait_until(lambda: camera.subscribers == 1)
+        camera.publish(b'jpg1')
+
+        await asyncio.wait_for(feed, 5)
+        assert websocket.get_frames() == [(1, b'jpg1')]
+        assert camera.subscribers == 0
+
+    asyncio.run(run())
+
+
+def test_rejects_unknown_paths_and_qualities():
+    async def run():
+        websocket = FakeWebSocket()
+        await CameraApp().websocket_route(None, '/camerapi/unknown', {}, websocket.receive, websocket.send)
+        assert websocket.sent == [{'type': 'websocket.close', 'code': 1008}]
+
+        websocket = FakeWebSocket()
+        await start_feed(FakeCamera(), websocket, b'quality=unknown')
+        assert websocket.sent == [{'type': 'websocket.close', 'code': 1008}]
+
+    asyncio.run(run())
@@ -0,0 +1,61 @@
+import threading
+import time
+
+from lib.camera_base import Camera
+
+
+class SlowlyClosingCamera(Camera):
+    """
+    Camera whose sensor takes a while to close, like the Pi camera.
+
+    Attributes:
+        open_sensors: Number of frame generators that are running
+        max_open_sensors: Maximal number of frame generators that ran at the same time
+        closing: Set when a frame generator starts to close
+    """
+
+    def __init__(self):
+        """ constructor """
+        self.open_sensors = 0
+        self.max_open_sensors = 0
+        self.closing = threading.Event()
+        super().__init__('slow')
+
+    def frames(self):
+        self.open_sensors += 1
+        self.max_open_sensors = max(self.max_open_sensors, self.open_sensors)
+        try:
+            while True:
+                time.sleep(0.01)
+                yield b'frame'
+        finally:
+            self.closing.set()
+            time.sleep(0.3)
+            self.open_sensors -= 1
+
+
+def test_restarts_while_the_camera_is_suspended(monkeypatch, tmp_path):
+    monkeypatch.setenv('RECORDINGS', str(tmp_path))
+    monkeypatch.setenv('TIMELAPSE_INTERVAL', '0')
+    camera = SlowlyClosingCamera()
+    try:
+        first = camera.next_frame(after_seq=0)
+        assert first is not None
+
+        camera.idle_timeout = 0
+        camera.last_access = 0
+        assert camera.closing.wait(timeout=5)
+        # a client arrives while the sensor is still closing
+        camera.idle_timeout = 10
+        frame = camera.next_frame(after_seq=camera.broadcaster.get_latest_frame().seq)
+
+        assert frame is not None
+        assert camera.max_open_sensors == 1
+        assert camera.starts == 2
+    finally:
+        camera.idle_timeout = 0
+        camera.last_access = 0
+        thread = camera.thread
+        while thread is not None:
+            thread.join(timeout=5)
+            thread = camera.thread
@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+np = pytest.importorskip('numpy')
+
+from lib.camera_opencv import FrameEncoder, encoded_frames  # noqa: E402
+
+
+class FakeCapture(object):
+    """
+    Capture that stores the sequence number in the pixels of every frame, like cv2.VideoCapture into the given array.
+
+    Attributes:
+        seq: Sequence number of the last captured frame
+        buffers: The ids of the arrays the frames were captured into
+    """
+
+    def __init__(self, shape: tuple = (48, 64, 3)):
+        """ constructor """
+        self.shape = shape
+        self.seq = 0
+        self.buffers = set()
+        self.released = False
+
+    def read(self, image=None) -> tuple:
+        time.sleep(0.001)
+        if image is None:
+            image = np.empty(self.shape, dtype=np.uint8)
+        self.seq += 1
+        image[:] = (self.seq % 256, self.seq // 256 % 256, 0)
+        self.buffers.add(id(image))
+        return True, image
+
+    def release(self):
+        self.released = True
+
+
+class SlowEncoder(object):
+    """
+    Encoder that takes a random time per frame and checks that its frame does not change meanwhile.
+
+    Attributes:
+        changed: Values of the frames that were overwritten while they were encoded
+    """
+
+    def __init__(self):
+        """ constructor """
+        self.generator = random.Random(0)
+        self.lock = threading.Lock()
+        self.changed = []
+
+    def encode(self, image) -> bytes:
+        value = int(image[0, 0, 0]) + 256 * int(image[0, 0, 1])
+        with self.lock:
+            delay = self.generator.uniform(0, 0.01)
+        time.sleep(delay)
+        if (image[:, :, 0] != value % 256).any() or (image[:, :, 1] != value // 256).any():
+            self.changed.append(value)
+        return value.to_bytes(2, 'little')
+
+
+def test_returns_the_frames_in_capture_order_without_reusing_held_buffers():
+    capture = FakeCapture()
+    encoder = SlowEncoder()
+    frames = encoded_frames(capture, encoder, threads=4)
+    values = [int.from_bytes(next(frames), 'little') for _ in range(200)]
+    frames.close()
+
+    assert not encoder.changed
+    assert all(later > earlier for earlier, later in zip(values, values[1:]))
+    # the arrays are reused instead of allocated per frame
+    assert len(capture.buffers) < 20
+    assert capture.released
+
+
+def test_resizes_into_the_buffer_of_the_thread_and_stamps_the_overlay():
+    image = np.full((48, 64, 3), 50, dtype=np.uint8)
+    plain = FrameEncoder(resolution=(32, 24))
+    stamped = FrameEncoder(resolution=(32, 24), overlay_enabled=True)
+
+    first = cv2.imdecode(np.frombuffer(stamped.encode(image), dtype=np.uint8), cv2.IMREAD_COLOR)
+    resized = stamped.buffers.resized
+    stamped.encode(image)
+
+    assert first.shape == (24, 32, 3)
+    assert stamped.buffers.resized is resized
+    # the captured frame is neither resized nor stamped in place
+    assert (image == 50).all()
+    assert stamped.encode(image) != plain.encode(image)
@@ -0,0 +1,81 @@
+import os
+import time
+
+from benchmarks.chunk_writer import ThrottledDrive, ThrottledFile, encode, merge_chunks
+from lib.chunk_writer import ChunkWriter
+from lib.recordings_folder import RecordingsFolder
+from lib.recordings_index import query_recordings
+from lib.storage_manager import StorageManager
+
+BLOCK_BYTES = 16 * 1024
+
+
+def create_writer(tmp_path, opener_for_drive) -> tuple:
+    """
+    Returns:
+        tuple: The chunk writer on two drives, the base paths and the opened files by path.
+    """
+    base_paths = [str(tmp_path / name) for name in ('usb0', 'usb1')]
+    files = []
+
+    def opener(path: str):
+        # the chunk exists on disk like a real one, only its bytes are kept in memory
+        open(path, 'wb').close()
+        file = opener_for_drive(next(base_path for base_path in base_paths if path.startswith(base_path)))
+        files.append((path, file))
+        return file
+
+    storage_manager = StorageManager(base_paths, min_free_bytes=0)
+    folder = RecordingsFolder(';'.join(base_paths), storage_manager=storage_manager)
+    writer = ChunkWriter(folder, block_bytes=BLOCK_BYTES, stall_seconds=0.3, max_delay=0.2, opener=opener)
+    return writer, base_paths, files
+
+
+def test_fails_over_after_stall(tmp_path):
+    drives = {}
+
+    def opener_for_drive(base_path: str) -> ThrottledFile:
+        if base_path not in drives:
+            # the first drive stalls for longer than the recording
+            drives[base_path] = ThrottledDrive(50 * 1024 * 1024, 100 * 1024 if not drives else None, 2)
+        return ThrottledFile(drives[base_path])
+
+    writer, base_paths, files = create_writer(tmp_path, opener_for_drive)
+    stream, longest = encode(writer.open_chunk, 300 * 1024, 1.5, 1, 0)
+    assert writer.close(timeout=5)
+    status = writer.get_status()
+    # the abandoned write of the stalled drive returns after the stall
+    time.sleep(1)
+
+    assert status['failovers'] >= 1
+    assert status['dropped_bytes'] == 0
+    assert longest < 0.1
+    assert len({path for path, _ in files}) == len(files)
+    assert merge_chunks([bytes(file.data) for _, file in files], BLOCK_BYTES) == stream
+    assert any(path.startswith(base_paths[1]) for path, _ in files)
+
+    chunks = {chunk['path']: chunk for chunk in query_recordings(base_paths)}
+    continuation = next(path for path, _ in files if path.startswith(base_paths[1]))
+    assert chunks[continuation]['continues'] == files[0][0]
+    assert chunks[files[0][0]]['continues'] is None
+
+
+class FailingFile(ThrottledFile):
+
+    def write(self, data) -> int:
+        raise OSError(5, 'Input/output error')
+
+
+def test_fails_over_after_write_error(tmp_path):
+    writer, base_paths, files = create_writer(
+        tmp_path, lambda base_path: (FailingFile if base_path.endswith('usb0') else ThrottledFile)(
+            ThrottledDrive(50 * 1024 * 1024)))
+    stream, _ = encode(writer.open_chunk, 300 * 1024, 0.5, 1, 1)
+    assert writer.close(timeout=5)
+    status = writer.get_status()
+
+    assert status['failovers'] >= 1
+    assert status['dropped_bytes'] == 0
+    assert merge_chunks([bytes(file.data) for path, file in files if path.startswith(base_paths[1])],
+                        BLOCK_BYTES) == stream
+    assert all(os.path.exists(path) for path, _ in files)
@@ -0,0 +1,62 @@
+import threading
+
+import lib.camera_base
+from lib.camera_mock import Camera as MockCamera
+from lib.frame_broadcaster import FrameBroadcaster
+from lib.mjpeg import encode_part
+
+
+def test_unchanged_images_keep_the_content_and_the_part_of_their_first_frame():
+    broadcaster = FrameBroadcaster()
+    first = broadcaster.publish(b'image', encode_part(b'image'))
+    # an equal image that is another object is detected by its digest
+    copy = bytes(bytearray(b'image'))
+    assert broadcaster.is_duplicate(copy, broadcaster.get_digest(copy))
+    second = broadcaster.publish(copy)
+    third = broadcaster.publish(b'other', encode_part(b'other'))
+
+    assert [frame.seq for frame in (first, second, third)] == [1, 2, 3]
+    assert second.content_seq == first.content_seq == 1
+    assert second.part is first.part
+    assert third.content_seq == 3
+    assert not broadcaster.is_duplicate(b'image', broadcaster.get_digest(b'image'))
+
+
+def test_waiting_clients_get_the_newest_frame():
+    broadcaster = FrameBroadcaster()
+    received = []
+    waiter = threading.Thread(target=lambda: received.append(broadcaster.wait_for_frame(after_seq=0, timeout=5)))
+    waiter.start()
+    broadcaster.publish(b'image', encode_part(b'image'))
+    waiter.join(timeout=5)
+
+    assert received[0].data == b'image'
+    assert broadcaster.wait_for_frame(after_seq=1, timeout=0.01) is None
+
+
+def test_the_mock_scene_is_only_encoded_when_it_changes(monkeypatch, tmp_path):
+    monkeypatch.setenv('RECORDINGS', str(tmp_path))
+    monkeypatch.setenv('TIMELAPSE_INTERVAL', '0')
+    monkeypatch.setattr(MockCamera, 'fps', 100)
+    monkeypatch.setattr(MockCamera, 'static', False)
+    monkeypatch.setattr(MockCamera, 'scene_seconds', 60)
+    encoded = []
+
+    def counting_encode_part(jpeg: bytes) -> bytes:
+        encoded.append(jpeg)
+        return encode_part(jpeg)
+
+    monkeypatch.setattr(lib.camera_base, 'encode_part', counting_encode_part)
+    camera = MockCamera('scene')
+    try:
+        frames = [camera.broadcaster.wait_for_frame(after_seq=seq, timeout=5) for seq in range(5)]
+    finally:
+        camera.idle_timeout = 0
+        camera.last_access = 0
+        thread = camera.thread
+        if thread is not None:
+            thread.join(timeout=5)
+
+    assert [frame.seq for frame in frames] == [1, 2, 3, 4, 5]
+    assert {frame.content_seq for frame in frames} == {1}
+    assert len(encoded) == 1
@@ -0,0 +1,97 @@
+import errno
+import threading
+
+from lib.frame_recorder import FrameRecorder
+from lib.recordings_folder import RecordingsFolder
+from lib.storage_manager import StorageManager
+
+
+def create_recorder(path, queue_size: int = 90) -> FrameRecorder:
+    folder = RecordingsFolder(str(path), storage_manager=StorageManager([str(path)], min_free_bytes=0))
+    return FrameRecorder(folder, queue_size=queue_size, recording_format='mjpeg')
+
+
+def test_writes_the_queued_frames_after_stop(tmp_path):
+    recorder = create_recorder(tmp_path)
+    recorder.start(pre_event_frames=[(0, b'pre')])
+    for timestamp in range(1, 4):
+        recorder.submit(timestamp, bytes([timestamp]))
+    recorder.stop()
+    recorder.thread.join(timeout=5)
+
+    assert not recorder.thread.is_alive()
+    with open(recorder.chunk_path, 'rb') as file:
+        assert file.read() == b'pre\x01\x02\x03'
+    assert recorder.written_frames == 4
+
+
+def test_stops_and_restarts_with_a_full_queue(tmp_path):
+    recorder = create_recorder(tmp_path, queue_size=2)
+    write = recorder.write
+    released = threading.Event()
+
+    def blocked_write(timestamp, data):
+        released.wait(timeout=5)
+        write(timestamp, data)
+
+    recorder.write = blocked_write
+    recorder.start()
+    for timestamp in range(5):
+        recorder.submit(timestamp, b'frame')
+    assert recorder.queue.full()
+    assert recorder.dropped
+
+    recorder.stop()
+    released.set()
+    recorder.start()
+
+    assert recorder.recording
+    recorder.stop()
+    recorder.thread.join(timeout=5)
+    assert not recorder.thread.is_alive()
+
+
+class MemoryFile(object):
+    """In-memory file of a drive that runs full after the capacity in bytes, None never."""
+
+    def __init__(self, capacity: int = None):
+        """ constructor """
+        self.capacity = capacity
+        self.data = bytearray()
+
+    def write(self, data) -> int:
+        if self.capacity is not None and len(self.data) + len(data) > self.capacity:
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        self.data += data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def test_continues_on_the_next_drive_if_the_first_is_full(tmp_path):
+    base_paths = [str(tmp_path / name) for name in ('usb0', 'usb1')]
+    files = {}
+
+    def opener(path: str):
+        files[path] = MemoryFile(3 if path.startswith(base_paths[0]) else None)
+        return files[path]
+
+    storage_manager = StorageManager(base_paths, min_free_bytes=0)
+    folder = RecordingsFolder(';'.join(base_paths), storage_manager=storage_manager)
+    # the first drive is ranked first
+    storage_manager.report_write(base_paths[1], 1, 10)
+    recorder = FrameRecorder(folder, recording_format='mjpeg', opener=opener)
+    recorder.start()
+    for timestamp in range(1, 5):
+        recorder.submit(timestamp, bytes([timestamp]))
+    recorder.stop()
+    recorder.thread.join(timeout=5)
+
+    assert recorder.failovers == 1
+    assert recorder.written_frames == 4
+    first, second = files
+    assert first.startswith(base_paths[0]) and second.startswith(base_paths[1])
+    assert files[first].data == b'\x01\x02\x03'
+    assert files[second].data == b'\x04'
+    assert storage_manager.get_target(base_paths[0]).write_errors == 1
@@ -0,0 +1,154 @@
+import random
+
+from lib.hls import CLOCK_RATE, NAL_IDR_SLICE, PAT_PID, PMT_PID, PTS_OFFSET, TS_PACKET_SIZE, VIDEO_PID, \
+    H264Segmenter, SegmentRing, crc32_mpeg2
+
+SPS = b'\x67\x42\xc0\x1e\x11'
+PPS = b'\x68\xce\x3c\x80'
+
+
+def build_stream(frames: int, gop: int, leading: int = 0) -> bytes:
+    """
+    Returns:
+        bytes: A synthetic Annex-B stream with a keyframe and inline parameter sets every gop frames,
+            after the given number of leading frames that are no keyframes.
+    """
+    nal_units = []
+    for index in range(-leading, frames):
+        payload = bytes([1 + (index + leading) % 250]) * (50 + index % 400)
+        if index >= 0 and index % gop == 0:
+            nal_units += [SPS, PPS, b'\x65\x88' + payload]
+        else:
+            nal_units.append(b'\x41\x9a' + payload)
+    return b''.join(b'\x00\x00\x00\x01' + nal_unit for nal_unit in nal_units)
+
+
+def demux(data: bytes) -> dict:
+    """
+    Returns:
+        dict: The payloads of the PSI sections, the PES packets of the video with their random access indicator
+            and the continuity counters by pid.
+    """
+    assert len(data) % TS_PACKET_SIZE == 0
+    result = {'sections': [], 'pes': [], 'counters': {}}
+    for offset in range(0, len(data), TS_PACKET_SIZE):
+        packet = data[offset:offset + TS_PACKET_SIZE]
+        assert packet[0] == 0x47
+        pid = (packet[1] & 0x1F) << 8 | packet[2]
+        unit_start = bool(packet[1] & 0x40)
+        result['counters'].setdefault(pid, []).append(packet[3] & 0x0F)
+        position = 4
+        random_access = False
+        if packet[3] & 0x20:
+            random_access = packet[4] > 0 and bool(packet[5] & 0x40)
+            position += 1 + packet[4]
+        payload = packet[position:]
+        if pid in (PAT_PID, PMT_PID):
+            result['sections'].append(payload[1 + payload[0]:])
+        elif pid == VIDEO_PID:
+            if unit_start:
+                result['pes'].append([bytearray(), random_access])
+            result['pes'][-1][0] += payload
+    return result
+
+
+def decode_pts(pes: bytes) -> int:
+    assert pes[:4] == b'\x00\x00\x01\xe0' and pes[7] & 0x80
+    data = pes[9:14]
+    return (data[0] >> 1 & 0x07) << 30 | data[1] << 22 | (data[2] >> 1) << 15 | data[3] << 7 | data[4] >> 1
+
+
+def get_nal_types(pes: bytes) -> list:
+    return [nal_unit[0] & 0x1F for nal_unit in bytes(pes[9 + pes[8]:]).split(b'\x00\x00\x00\x01') if nal_unit]
+
+
+def segment_stream(stream: bytes, max_segments: int = 100, fps: float = 10, segment_seconds: float = 1,
+                   seed: int = None) -> tuple:
+    ring = SegmentRing(max_segments)
+    segmenter = H264Segmenter(ring, fps, segment_seconds)
+    if seed is None:
+        segmenter.write(stream)
+    else:
+        generator = random.Random(seed)
+        position = 0
+        while position < len(stream):
+            size = generator.randint(1, 700)
+            segmenter.write(stream[position:position + size])
+            position += size
+    segmenter.flush()
+    return ring, segmenter
+
+
+def test_crc32_mpeg2():
+    assert crc32_mpeg2(b'123456789') == 0x0376E6E7
+
+
+def test_segments_start_with_the_tables_and_a_keyframe():
+    ring, segmenter = segment_stream(build_stream(60, gop=15, leading=4))
+
+    # the leading frames without keyframe are dropped, every segment closes at the first keyframe after a second
+    assert segmenter.frames == 60
+    assert [segment.duration for segment in ring.segments] == [1.5] * 4
+    for segment in ring.segments:
+        assert (segment.data[1] & 0x1F) << 8 | segment.data[2] == PAT_PID
+        stream = demux(segment.data)
+        assert len(stream['sections']) == 2
+        for section in stream['sections']:
+            # the CRC over a section including its CRC is 0
+            length = (section[1] & 0x0F) << 8 | section[2]
+            assert crc32_mpeg2(section[:3 + length]) == 0
+        pes, random_access = stream['pes'][0]
+        assert random_access
+        assert get_nal_types(pes)[:4] == [9, 7, 8, NAL_IDR_SLICE]
+        assert not any(random_access for _, random_access in stream['pes'][1:])
+        assert all(get_nal_types(pes)[0] == 9 for pes, _ in stream['pes'])
+
+
+def test_timestamps_and_counters_are_continuous_over_the_segments():
+    ring, _ = segment_stream(build_stream(45, gop=10))
+    pts = []
+    counters = {}
+    for segment in ring.segments:
+        stream = demux(segment.data)
+        pts += [decode_pts(pes) for pes, _ in stream['pes']]
+        for pid, pid_counters in stream['counters'].items():
+            counters.setdefault(pid, []).extend(pid_counters)
+
+    assert pts == [PTS_OFFSET + frame * CLOCK_RATE // 10 for frame in range(45)]
+    for pid_counters in counters.values():
+        assert all(counter == (previous + 1) & 0x0F for previous, counter in zip(pid_counters, pid_counters[1:]))
+
+
+def test_writes_of_any_size_result_in_the_same_segments():
+    stream = build_stream(40, gop=10)
+    expected, _ = segment_stream(stream)
+    for seed in range(3):
+        ring, _ = segment_stream(stream, seed=seed)
+        assert list(ring.segments) == list(expected.segments)
+
+
+def test_ring_drops_the_oldest_segments():
+    ring = SegmentRing(max_segments=3)
+    for sequence in range(5):
+        ring.add(b'segment%d' % sequence, 2.0, discontinuity=sequence == 1)
+
+    assert [segment.sequence for segment in ring.segments] == [2, 3, 4]
+    assert ring.get(1) is None
+    assert ring.get(3).data == b'segment3'
+    playlist = ring.get_playlist('live/{}.ts')
+    assert '#EXT-X-MEDIA-SEQUENCE:2\n' in playlist
+    # the dropped discontinuity is counted, so players keep their timelines apart
+    assert '#EXT-X-DISCONTINUITY-SEQUENCE:1\n' in playlist
+    assert playlist.endswith('#EXTINF:2.000,\nlive/4.ts\n')
+
+
+def test_a_restart_of_the_encoder_is_a_discontinuity():
+    ring = SegmentRing(max_segments=10)
+    segmenter = H264Segmenter(ring, 10, 1)
+    segmenter.write(build_stream(20, gop=10))
+    segmenter.flush()
+    segmenter.write(build_stream(10, gop=10))
+    segmenter.flush()
+
+    assert [segment.discontinuity for segment in ring.segments] == [False, False, True]
+    assert '#EXT-X-DISCONTINUITY\n#EXTINF:1.000,\n2.ts' in ring.get_playlist()
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+from benchmarks.mjpeg_splitter import build_stream, with_thumbnail
+from lib.mjpeg import MJPEGFrameSplitter, encode_part
+
+
+@pytest.fixture
+def sample():
+    return build_stream([])
+
+
+def test_encode_part():
+    assert encode_part(b'jpg') == b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: 3\r\n\r\njpg\r\n'
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_splits_writes_of_random_size_into_the_frames(sample, seed):
+    frames, stream = sample
+    generator = random.Random(seed)
+    received = []
+    splitter = MJPEGFrameSplitter(received.append)
+    position = 0
+    while position < len(stream):
+        size = generator.choice([1, 2, 3, 100, 4096, 65536])
+        splitter.write(stream[position:position + size])
+        position += size
+
+    assert received == frames
+    assert splitter.frames == len(frames)
+    # the garbage before the first frame and the bytes between the frames
+    assert splitter.dropped_bytes == len(stream) - sum(map(len, frames))
+
+
+def test_an_embedded_thumbnail_does_not_end_the_frame(sample):
+    frames, _ = sample
+    frame = with_thumbnail(frames[0], frames[1])
+    received = []
+    MJPEGFrameSplitter(received.append).write(frame)
+
+    assert received == [frame]
+
+
+def test_passes_whole_frame_writes_on_without_copying(sample):
+    frames, _ = sample
+    received = []
+    splitter = MJPEGFrameSplitter(received.append)
+    for frame in frames:
+        splitter.write(frame)
+
+    assert all(frame is original for frame, original in zip(received, frames))
+    assert len(received) == len(frames)
+
+
+def test_drops_frames_above_the_max_size(sample):
+    frames, _ = sample
+    small = min(frames, key=len)
+    large = max(frames, key=len)
+    received = []
+    splitter = MJPEGFrameSplitter(received.append, max_frame_bytes=len(small) + 1)
+    for position in range(0, len(large), 100):
+        splitter.write(large[position:position + 100])
+    splitter.write(small)
+
+    assert received == [small]
+    assert splitter.dropped_bytes >= len(large) - 100
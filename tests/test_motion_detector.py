@@ -0,0 +1,101 @@
+import pytest
+
+from lib.motion_detector import MotionDetector, MotionMonitor, parse_region_of_interest
+
+cv2 = pytest.importorskip('cv2')
+np = pytest.importorskip('numpy')
+
+
+def make_frame(block_x: int = None) -> bytes:
+    """
+    Returns:
+        bytes: A JPG of a gradient scene, with a bright block at the given x if any.
+    """
+    image = np.tile(np.linspace(0, 120, 320, dtype=np.uint8), (240, 1))
+    image = cv2.merge([image] * 3)
+    if block_x is not None:
+        image[80:160, block_x:block_x + 80] = 255
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+def test_detects_a_moved_block_but_no_static_scene():
+    detector = MotionDetector()
+    static = make_frame()
+
+    assert detector.detect(static) == 0.0
+    assert max(detector.detect(static) for _ in range(5)) < 0.01
+    assert detector.detect(make_frame(block_x=40)) >= 0.05
+
+
+def test_ignores_motion_outside_of_the_region_of_interest():
+    detector = MotionDetector(region_of_interest=parse_region_of_interest('0.5,0,1,1'))
+    detector.detect(make_frame())
+
+    assert detector.detect(make_frame(block_x=20)) == 0.0
+    assert detector.detect(make_frame(block_x=200)) >= 0.05
+
+
+class FakeCamera(object):
+    """Camera that only tracks whether it is recording."""
+
+    def __init__(self):
+        """ constructor """
+        self.recording = False
+        self.records = 0
+
+    def record(self):
+        self.recording = True
+        self.records += 1
+
+    def stop_recording(self):
+        self.recording = False
+
+    def is_recording(self) -> bool:
+        return self.recording
+
+
+def test_records_on_sustained_motion_and_stops_after_the_quiet_time():
+    camera = FakeCamera()
+    monitor = MotionMonitor(camera, MotionDetector(), trigger_seconds=1, quiet_seconds=30)
+
+    # a short motion does not start a recording
+    monitor.update(True, 0)
+    monitor.update(False, 0.5)
+    monitor.update(True, 1)
+    assert not camera.recording
+
+    monitor.update(True, 2)
+    assert camera.recording and camera.records == 1
+    monitor.update(True, 3)
+    assert camera.records == 1
+
+    monitor.update(False, 20)
+    assert camera.recording
+    # motion within the quiet time extends the recording
+    monitor.update(True, 25)
+    monitor.update(False, 50)
+    assert camera.recording
+    monitor.update(False, 56)
+    assert not camera.recording
+    assert not monitor.triggered_recording
+
+
+def test_does_not_stop_a_recording_it_did_not_start():
+    camera = FakeCamera()
+    camera.record()
+    monitor = MotionMonitor(camera, MotionDetector(), trigger_seconds=0, quiet_seconds=1)
+
+    monitor.update(True, 0)
+    monitor.update(False, 10)
+
+    assert camera.recording
+    assert camera.records == 1
+
+
+def test_analyzes_fewer_frames_above_the_cpu_budget():
+    monitor = MotionMonitor(FakeCamera(), MotionDetector(), cpu_budget=0.1, every=3)
+
+    monitor.adapt(0.02, 0.1)
+    assert monitor.every == 4
+    monitor.adapt(0.001, 0.1)
+    assert monitor.every == 3
@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+from lib.overlay import TextOverlay, is_overlay_enabled
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+
+
+def test_is_disabled_by_default(monkeypatch):
+    monkeypatch.delenv('OVERLAY', raising=False)
+    assert not is_overlay_enabled()
+
+
+def test_blends_the_text_into_the_frame():
+    overlay = TextOverlay(position=(4, 4), color=(255, 255, 255))
+    frame = np.full((60, 200, 3), 100, dtype=np.uint8)
+    overlay.draw(frame, ('12:34:56',))
+    coverage = overlay.glyphs.render('12:34:56')
+    region = frame[4:4 + coverage.shape[0], 4:4 + coverage.shape[1], 0]
+
+    # the background stays visible around the characters, i.e. there is no opaque tile
+    assert (region[coverage == 0] == 100).all()
+    assert (region[coverage == 255] == 255).all()
+    partial = (coverage > 0) & (coverage < 255)
+    assert ((region[partial] > 100) & (region[partial] < 255)).all()
+    assert (frame[:4] == 100).all()
+
+
+def test_clips_the_text_at_the_frame_border():
+    overlay = TextOverlay(position=(4, 4))
+    frame = np.zeros((20, 30, 3), dtype=np.uint8)
+    overlay.draw(frame, ('a long line of text', 'second line'))
+
+    assert frame.shape == (20, 30, 3)
+    assert frame[4:, 4:].any()
+
+
+def test_draws_from_several_threads_while_the_text_width_changes():
+    overlay = TextOverlay(position=(4, 4))
+    errors = []
+
+    def draw(lines: tuple):
+        frame = np.zeros((60, 400, 3), dtype=np.uint8)
+        try:
+            for _ in range(500):
+                overlay.draw(frame, lines)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=draw, args=(('x' * (i + 1),),)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    assert not errors
@@ -0,0 +1,63 @@
+import io
+import time
+
+from lib.pre_event_buffer import PreEventBuffer, PreEventOutput
+
+
+def test_drops_frames_older_than_the_seconds():
+    buffer = PreEventBuffer(seconds=2, max_bytes=1024)
+    for timestamp in range(5):
+        buffer.append(timestamp, bytes([timestamp]))
+
+    assert [frame[0] for frame in buffer.frames] == [2, 3, 4]
+    assert buffer.size == 3
+    assert buffer.get_duration() == 2
+
+
+def test_drops_the_oldest_frames_above_the_max_bytes():
+    buffer = PreEventBuffer(seconds=60, max_bytes=10)
+    for timestamp in range(4):
+        buffer.append(timestamp, b'x' * 4)
+
+    assert [frame[0] for frame in buffer.frames] == [2, 3]
+    assert buffer.size == 8
+
+
+def test_disabled_buffer_keeps_nothing():
+    buffer = PreEventBuffer(seconds=0, max_bytes=1024)
+    buffer.append(time.time(), b'frame')
+
+    assert not buffer.is_enabled()
+    assert buffer.drain() == []
+
+
+def test_write_to_drains_the_recent_frames_in_order():
+    buffer = PreEventBuffer(seconds=5, max_bytes=1024)
+    now = time.time()
+    buffer.append(now - 60, b'stale')
+    buffer.append(now - 1, b'first')
+    buffer.append(now, b'second')
+    output = io.BytesIO()
+
+    assert buffer.write_to(output) == len(b'firstsecond')
+    assert output.getvalue() == b'firstsecond'
+    assert buffer.size == 0
+    assert buffer.drain() == []
+
+
+def test_output_holds_back_writes_until_the_pre_event_video_is_flushed():
+    buffer = PreEventBuffer(seconds=5, max_bytes=1024)
+    buffer.append(time.time(), b'before')
+    output = io.BytesIO()
+    pre_event_output = PreEventOutput(output)
+
+    assert pre_event_output.write(b'during') == len(b'during')
+    assert output.getvalue() == b''
+
+    pre_event_output.flush_pre_event(buffer.write_to)
+    pre_event_output.write(b'after')
+    assert output.getvalue() == b'beforeduringafter'
+
+    pre_event_output.close()
+    pre_event_output.close()
+    assert output.closed
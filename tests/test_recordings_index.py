@@ -0,0 +1,64 @@
+import os
+import time
+
+from lib.recordings_folder import RecordingsFolder
+from lib.recordings_index import INDEX_FILE_NAME, STALE_SECONDS, RecordingsIndex, get_recordings_index
+from lib.storage_manager import StorageManager
+
+
+def write_chunk(path: str, size: int, modified: float = None) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(b'x' * size)
+    if modified is not None:
+        os.utime(path, (modified, modified))
+    return path
+
+
+def test_rebuilds_the_missing_index_from_the_recording_folders(tmp_path):
+    root = str(tmp_path)
+    first = write_chunk(os.path.join(root, '2020_01_01_10_00_00', '2020_01_01_10_00_00.h264'), 10)
+    second = write_chunk(os.path.join(root, '2020_01_01_10_00_00', '2020_01_01_10_05_00_1.mjpeg'), 20)
+    write_chunk(os.path.join(root, '2020_01_01_10_00_00', 'notes.txt'), 5)
+    # neither the timelapse archives nor other folders are recordings
+    write_chunk(os.path.join(root, 'timelapse', '2020_01_01_10_00_00.h264'), 5)
+    write_chunk(os.path.join(root, 'other', '2020_01_01_10_00_00.h264'), 5)
+
+    chunks = RecordingsIndex(root).query()
+
+    assert os.path.exists(os.path.join(root, INDEX_FILE_NAME))
+    assert [(chunk['path'], chunk['size']) for chunk in chunks] == [(first, 10), (second, 20)]
+    assert chunks[0]['session'] == '2020_01_01_10_00_00'
+
+
+def test_finishes_the_chunks_of_a_crashed_process(tmp_path):
+    root = str(tmp_path)
+    index = RecordingsIndex(root)
+    crashed = os.path.join(root, '2020_01_01_10_00_00', '2020_01_01_10_00_00.h264')
+    index.chunk_opened(crashed)
+    write_chunk(crashed, 10, time.time() - 2 * STALE_SECONDS)
+    vanished = os.path.join(root, '2020_01_01_10_00_00', '2020_01_01_10_01_00.h264')
+    index.chunk_opened(vanished)
+    with index.connect() as connection:
+        connection.execute('UPDATE chunks SET start = ?', (time.time() - 2 * STALE_SECONDS,))
+
+    # the index is opened again by the next process
+    chunks = RecordingsIndex(root).query()
+
+    assert [(chunk['path'], chunk['end'], chunk['size']) for chunk in chunks] == [
+        (crashed, os.path.getmtime(crashed), 10)]
+
+
+def test_removes_the_chunks_deleted_by_the_retention(tmp_path):
+    root = str(tmp_path)
+    storage_manager = StorageManager([root], min_free_bytes=0, retention_max_bytes=150)
+    folder = RecordingsFolder(root, storage_manager=storage_manager)
+    paths = []
+    for age in (3, 2, 1):
+        paths.append(write_chunk(folder.get_next_chunk_path(), 100, time.time() - age))
+    folder.close_chunk()
+    # the recording ended, its chunks are not protected anymore
+    storage_manager.protected_path = ''
+
+    assert storage_manager.enforce_retention() == 2
+    assert [chunk['path'] for chunk in get_recordings_index(root).query()] == paths[2:]
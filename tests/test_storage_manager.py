@@ -0,0 +1,144 @@
+import collections
+import os
+
+from lib.recordings_folder import RecordingsFolder
+from lib.storage_manager import StorageManager, list_chunks
+
+DiskUsage = collections.namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+
+class FakeDisks(object):
+    """
+    Simulated quotas of temp directories, the free space is the quota minus the size of the files below.
+    """
+
+    def __init__(self, quotas: dict):
+        """ constructor """
+        self.quotas = quotas
+        self.read_only = set()
+
+    def disk_usage(self, path: str) -> DiskUsage:
+        used = sum(os.path.getsize(os.path.join(folder, name))
+                   for folder, _, names in os.walk(path) for name in names)
+        return DiskUsage(self.quotas[path], used, self.quotas[path] - used)
+
+    def can_write(self, path: str) -> bool:
+        os.makedirs(path, exist_ok=True)
+        return path not in self.read_only
+
+
+def create_manager(disks: FakeDisks, **kwargs) -> StorageManager:
+    kwargs.setdefault('min_free_bytes', 100)
+    kwargs.setdefault('probe_interval', -1)
+    return StorageManager(list(disks.quotas), disk_usage=disks.disk_usage, can_write=disks.can_write, **kwargs)
+
+
+def write_file(path: str, size: int, modified: float = None) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(b'x' * size)
+    if modified is not None:
+        os.utime(path, (modified, modified))
+    return path
+
+
+def test_ranks_the_targets_by_free_space_and_bandwidth(tmp_path):
+    small, large, read_only = (str(tmp_path / name) for name in ('small', 'large', 'read_only'))
+    disks = FakeDisks({small: 1000, large: 2000, read_only: 4000})
+    disks.read_only.add(read_only)
+    manager = create_manager(disks)
+
+    assert [target.path for target in manager.get_ranked_targets()] == [large, small]
+
+    # a slow target is ranked last regardless of its free space
+    manager.report_write(large, 10, 1)
+    assert manager.select_target() == small
+
+    disks.quotas[small] = 50
+    assert [target.path for target in manager.get_ranked_targets()] == [large]
+
+    disks.read_only.add(large)
+    assert manager.select_target() is None
+
+
+def test_fails_over_to_the_next_target_on_the_chunk_boundary(tmp_path):
+    first, second = str(tmp_path / 'first'), str(tmp_path / 'second')
+    disks = FakeDisks({first: 200000, second: 100000})
+    manager = create_manager(disks)
+    folder = RecordingsFolder(';'.join([first, second]), storage_manager=manager)
+
+    chunk = folder.get_next_chunk_path()
+    assert chunk.startswith(first + os.sep)
+    write_file(chunk, 1000)
+    # the drive fills up during the chunk
+    disks.quotas[first] = disks.disk_usage(first).used + 50
+
+    chunk = folder.get_next_chunk_path()
+    assert chunk.startswith(second + os.sep)
+
+    # a stalled target is ranked last until its bandwidth recovers
+    manager.report_stall(second)
+    disks.quotas[first] = 400000
+    assert manager.select_target() == first
+    assert manager.get_target(second).stalls == 1
+
+
+def test_deletes_the_oldest_chunks_above_the_max_bytes(tmp_path):
+    base = str(tmp_path / 'usb')
+    disks = FakeDisks({base: 10000})
+    manager = create_manager(disks, retention_max_bytes=250)
+    deleted = []
+    manager.on_delete = deleted.append
+    chunks = [write_file(os.path.join(base, '2024_01_01_00_00_00', '2024_01_01_00_0{}_00.h264'.format(i)), 100, i)
+              for i in range(4)]
+
+    assert manager.enforce_retention() == 2
+    assert deleted == chunks[:2]
+    assert [chunk for chunk, _, _ in list_chunks(base)] == chunks[2:]
+
+
+def test_never_deletes_the_protected_recording(tmp_path):
+    base = str(tmp_path / 'usb')
+    disks = FakeDisks({base: 10000})
+    manager = create_manager(disks, retention_max_age=60)
+    old = write_file(os.path.join(base, '2024_01_01_00_00_00', '2024_01_01_00_00_00.h264'), 100, 0)
+    current = write_file(os.path.join(base, '2024_01_02_00_00_00', '2024_01_02_00_00_00.h264'), 100, 1)
+    manager.protected_path = os.path.dirname(current)
+
+    assert manager.enforce_retention() == 1
+    assert not os.path.exists(old)
+    assert not os.path.exists(os.path.dirname(old))
+    assert os.path.exists(current)
+
+
+def test_never_deletes_files_that_are_no_chunks(tmp_path):
+    base = str(tmp_path / 'usb')
+    disks = FakeDisks({base: 1000})
+    manager = create_manager(disks, min_free_bytes=900, retention_min_free=True)
+    recording = os.path.join(base, '2024_01_01_00_00_00')
+    kept = [
+        write_file(os.path.join(recording, 'notes.txt'), 100, 0),
+        write_file(os.path.join(recording, 'recordings.db'), 100, 0),
+        write_file(os.path.join(base, 'photos', '2024_01_01_00_00_00.h264'), 100, 0),
+        write_file(os.path.join(base, 'timelapse', '2024_01_01.mjpeg'), 100, 0),
+        write_file(os.path.join(base, 'backup.h264'), 100, 0),
+    ]
+    chunk = write_file(os.path.join(recording, '2024_01_01_00_00_00.mjpeg'), 100, 1)
+
+    assert [path for path, _, _ in list_chunks(base)] == [chunk]
+    assert manager.enforce_retention() == 1
+    assert not os.path.exists(chunk)
+    assert all(os.path.exists(path) for path in kept)
+
+
+def test_keeps_the_chunks_on_low_free_space_without_opt_in(tmp_path):
+    base = str(tmp_path / 'usb')
+    disks = FakeDisks({base: 1000})
+    manager = create_manager(disks, min_free_bytes=950, retention_min_free=False)
+    chunk = write_file(os.path.join(base, '2024_01_01_00_00_00', '2024_01_01_00_00_00.h264'), 100, 0)
+
+    assert not manager.is_retention_enabled()
+    manager.start_retention()
+    assert manager.retention_thread is None
+    assert manager.enforce_retention() == 0
+    assert os.path.exists(chunk)
@@ -0,0 +1,111 @@
+import os
+from datetime import datetime
+
+from lib.timelapse import INDEX_ENTRY, TIMELAPSE_FOLDER, Timelapse, TimelapseArchive, list_days
+
+
+def frame_data(index: int) -> bytes:
+    return bytes([index % 256]) * (10 + index)
+
+
+def append_frames(archive: TimelapseArchive, start: int, stop: int):
+    for index in range(start, stop):
+        archive.append(1000 + index, frame_data(index))
+
+
+def test_reads_the_frames_after_reopening(tmp_path):
+    archive = TimelapseArchive(str(tmp_path / '2021_05_01'))
+    append_frames(archive, 0, 20)
+    archive.close()
+
+    reopened = TimelapseArchive(str(tmp_path / '2021_05_01'))
+    assert len(reopened) == 20
+    assert reopened.read_frame(7) == (1007, frame_data(7))
+    assert reopened.read_frame(20) is None
+    assert reopened.get_entries(18) == [(18, 1018, len(frame_data(18))), (19, 1019, len(frame_data(19)))]
+
+
+def test_remaps_the_files_after_appends(tmp_path):
+    archive = TimelapseArchive(str(tmp_path / '2021_05_01'))
+    append_frames(archive, 0, 2)
+    assert archive.read_frame(1) == (1001, frame_data(1))
+
+    append_frames(archive, 2, 2000)
+    assert archive.read_frame(1999) == (2999, frame_data(1999))
+    assert archive.get_entries(1998, 2005)[-1] == (1999, 2999, len(frame_data(1999)))
+    archive.close()
+
+
+def test_drops_the_incomplete_frame_of_a_crash(tmp_path):
+    archive = TimelapseArchive(str(tmp_path / '2021_05_01'))
+    append_frames(archive, 0, 3)
+    archive.close()
+    # the pack lost the end of the last frame, the index a part of a following entry
+    with open(archive.pack_path, 'r+b') as file:
+        file.truncate(os.path.getsize(archive.pack_path) - 5)
+    with open(archive.index_path, 'ab') as file:
+        file.write(b'\0' * (INDEX_ENTRY.size // 2))
+
+    recovered = TimelapseArchive(str(tmp_path / '2021_05_01'))
+    append_frames(recovered, 3, 4)
+
+    assert len(recovered) == 3
+    assert [recovered.read_frame(index) for index in range(3)] == [
+        (1000, frame_data(0)), (1001, frame_data(1)), (1003, frame_data(3))]
+    assert os.path.getsize(recovered.pack_path) == sum(len(frame_data(index)) for index in (0, 1, 3))
+    recovered.close()
+
+
+def test_drops_frame_bytes_without_index_entry(tmp_path):
+    archive = TimelapseArchive(str(tmp_path / '2021_05_01'))
+    append_frames(archive, 0, 2)
+    archive.close()
+    with open(archive.pack_path, 'ab') as file:
+        file.write(b'orphan')
+
+    append_frames(archive, 2, 3)
+
+    assert archive.read_frame(2) == (1002, frame_data(2))
+    archive.close()
+
+
+def test_lists_the_days_of_all_base_paths(tmp_path):
+    base_paths = [str(tmp_path / name) for name in ('usb0', 'usb1')]
+    for base_path, day, count in ((base_paths[0], '2021_05_02', 3), (base_paths[1], '2021_05_01', 2)):
+        archive = TimelapseArchive(os.path.join(base_path, TIMELAPSE_FOLDER, day))
+        append_frames(archive, 0, count)
+        archive.close()
+    os.makedirs(os.path.join(base_paths[1], TIMELAPSE_FOLDER, 'other'))
+
+    assert list_days(base_paths) == [
+        {'day': '2021_05_01', 'frames': 2, 'start': 1000, 'end': 1001},
+        {'day': '2021_05_02', 'frames': 3, 'start': 1000, 'end': 1002},
+    ]
+
+
+class FixedFolder(object):
+    """Recordings folder with a single base path."""
+
+    def __init__(self, base_path: str):
+        """ constructor """
+        self.base_path = base_path
+
+    def select_base_path(self) -> str:
+        return self.base_path
+
+
+def test_rotates_the_archive_at_midnight(tmp_path):
+    timelapse = Timelapse(None, FixedFolder(str(tmp_path)), 60)
+    evening = datetime(2021, 5, 1, 23, 59).timestamp()
+
+    first = timelapse.get_archive(evening)
+    first.append(evening, b'evening')
+    assert timelapse.get_archive(evening + 30) is first
+    second = timelapse.get_archive(evening + 120)
+    second.append(evening + 120, b'morning')
+
+    assert first.pack_path == os.path.join(str(tmp_path), TIMELAPSE_FOLDER, '2021_05_01.pack')
+    assert second.pack_path == os.path.join(str(tmp_path), TIMELAPSE_FOLDER, '2021_05_02.pack')
+    assert first.pack is None
+    assert second.read_frame(0) == (evening + 120, b'morning')
+    second.close()